@@ -0,0 +1,293 @@
+import os
+import time
+import math
+import asyncio
+import threading
+from typing import Callable, NamedTuple
+
+from asr_backend import split_model
+from whisper_transcribe import WM, lang_to_model, ladder_keys, model_size
+from load_controller import LoadController, get_load_controller
+
+"""
+セッションの受け付け(audioStartでデコードを始めてよいか)と、ホストの容量の見積もり
+"""
+
+# モデルの大きさ毎のパラメータ数(百万)。測っていないモデルの負荷とメモリを、測ったモデルから比例で見積もる
+MODEL_PARAMS_M:dict[str,float] = { 'tiny': 39, 'base': 74, 'small': 244, 'medium': 769, 'large': 809 }
+# エンジン毎の1パラメータあたりのバイト数(mlxはq4、cpuはint8)。ロードしたモデルのサイズが分からないときに使う
+BYTES_PER_PARAM:dict[str,float] = { 'mlx': 0.6, 'cpu': 1.1, 'fake': 0.0 }
+
+def _path_sizes() ->dict[str,str]:
+    """エンジンを除いたモデルのパス -> 大きさ"""
+    ret:dict[str,str] = {}
+    for key,val in WM.items():
+        if isinstance(val,tuple) and (size := model_size(key)) is not None:
+            ret.setdefault( split_model(val[0])[1], size )
+    return ret
+
+_PATH_SIZES:dict[str,str] = _path_sizes()
+
+def path_size(model:str) ->str|None:
+    return _PATH_SIZES.get( split_model(model)[1] )
+
+def available_memory_mb() ->float|None:
+    """使えるメモリ(MB)。分からなければNone"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')/1048576
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def cpu_busy() ->float|None:
+    """CPU1つあたりの実行待ち(1分のロードアベレージ/CPU数)"""
+    try:
+        return os.getloadavg()[0]/(os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return None
+
+class Admission(NamedTuple):
+    action:str   # admit:選んだモデルで開始 degrade:小さいモデルで開始 queue:空くのを待つ reject:断る
+    key:str      # 開始するWMのキー(rejectなら選んだもの)
+    model:str
+    reason:str
+    position:int = 0 # queueの順番(1から)
+
+class AdmissionController:
+    """
+    セッションの受け付けを、モデル毎に測ったRTFと、CPU・メモリの余裕から決める
+    セッション1つの負荷(duty: 推論ワーカーを占める割合)は、モデルのRTF * 1秒毎にデコードする音声の秒数(decode_ratio) とする
+        - 受け付けたセッションのdutyの合計 + 新しいセッションのduty が、推論ワーカーの数*target 以下なら受け付ける
+        - 選んだモデルが入らなければ、model_ladderの小さいモデルで入るものを探す(degrade)
+        - どれも入らなければ、queue_max人まで待たせて、空いたら順に受け付ける(queue_sec秒待って空かなければ断る)
+        - 待ちが一杯なら断る(reject)
+    RTFは推論だけの時間(ワーカーの待ちを含まない)を使う。混んでいるときに測った値で見積もりが膨らまないように
+    測っていないモデルは、同じエンジンで大きさが近い測ったモデルからパラメータ数の比で見積もり、それも無ければdefault_dutyとする
+        workers: 推論ワーカーの数(共有サービスならワーカー数、セッション毎のプロセスならCPU数)を返す関数
+        shared_models: Trueならモデルはワーカーが共有し(メモリはセッション数に比例しない)、Falseならセッション毎にロードする
+        model_stats: ロード済みのモデルのサイズ(AsrService.model_stats)を返す関数
+        model_rtf: モデル毎の推論だけのRTF(AsrService.model_rtf)を返す関数。Noneならデコードループが測ったRTF(LoadController)を使う
+        decode_ratio: 1秒の入力毎にデコードする音声の秒数(増分モードではウィンドウ+オーバーラップ)
+        cpu_max: ロードアベレージ/CPU数 がこれを超えていたら受け付けない
+        mem_reserve_mb: 受け付けた後に残しておくメモリ
+    """
+    def __init__(self, *, workers:Callable[[],float], shared_models:bool=True, model_stats:Callable[[],dict]|None=None,
+                 model_rtf:Callable[[],dict[str,float]]|None=None, decode_ratio:float=11.0,
+                 target:float=0.85, default_duty:float=0.5, cpu_max:float=1.5, mem_reserve_mb:float=512, session_mem_mb:float=16,
+                 queue_max:int=8, queue_sec:float=60.0, enabled:bool=True, load:LoadController|None=None):
+        self.workers:Callable[[],float] = workers
+        self.shared_models:bool = shared_models
+        self.model_stats:Callable[[],dict]|None = model_stats
+        self.model_rtf:Callable[[],dict[str,float]]|None = model_rtf
+        self.decode_ratio:float = decode_ratio
+        self.target:float = target
+        self.default_duty:float = default_duty
+        self.cpu_max:float = cpu_max
+        self.mem_reserve_mb:float = mem_reserve_mb
+        self.session_mem_mb:float = session_mem_mb
+        self.queue_max:int = queue_max
+        self.queue_sec:float = queue_sec
+        self.enabled:bool = enabled
+        self.load:LoadController = load or get_load_controller()
+        self._active:dict[str,str] = {} # session -> 受け付けたモデル
+        self._waiters:list[tuple[str,asyncio.Event]] = []
+        self._lock:threading.Lock = threading.Lock()
+        self._counts:dict[str,int] = { 'admit': 0, 'degrade': 0, 'queue': 0, 'reject': 0 }
+
+    def rtfs(self) ->dict[str,float]:
+        """測ったモデル毎のRTF"""
+        if self.model_rtf is not None:
+            try:
+                return self.model_rtf()
+            except Exception:
+                return {}
+        return { m:x['rtf'] for m,x in self.load.stats()['models'].items() if x['steps']>0 }
+
+    def predict(self, model:str, rtfs:dict[str,float]|None=None) ->tuple[float,str]:
+        """セッション1つのduty。return: (duty, measured|scaled|default)"""
+        if rtfs is None:
+            rtfs = self.rtfs()
+        if model in rtfs:
+            return rtfs[model]*self.decode_ratio, 'measured'
+        size = path_size(model)
+        if size is not None:
+            engine = split_model(model)[0].name
+            refs = [ (abs(MODEL_PARAMS_M[osize]-MODEL_PARAMS_M[size]),rtf*MODEL_PARAMS_M[size]/MODEL_PARAMS_M[osize])
+                     for other,rtf in rtfs.items() if (osize := path_size(other)) is not None and split_model(other)[0].name==engine ]
+            if refs:
+                return min(refs)[1]*self.decode_ratio, 'scaled'
+        return self.default_duty, 'default'
+
+    def model_mb(self, model:str) ->float:
+        """モデルをロードしたときのメモリ(ロード済みなら実際のサイズ)"""
+        if self.model_stats is not None:
+            try:
+                for stats in self.model_stats().values():
+                    for m in stats:
+                        if m.get('path')==model:
+                            return float(m.get('mb',0.0))
+            except Exception:
+                pass
+        size = path_size(model)
+        if size is None:
+            return 0.0
+        return MODEL_PARAMS_M[size]*BYTES_PER_PARAM.get(split_model(model)[0].name,2.0)
+
+    def _session_mb(self, model:str) ->float:
+        return self.session_mem_mb + ( 0.0 if self.shared_models else self.model_mb(model) )
+
+    def host_duty(self) ->float:
+        """受け付けたセッションの見積もりのdutyの合計"""
+        with self._lock:
+            models = list(self._active.values())
+        rtfs = self.rtfs()
+        return sum( self.predict(m,rtfs)[0] for m in models )
+
+    def _fits(self, model:str) ->str:
+        """新しいセッションをmodelで受け付けられるか。return: 受け付けられなければ理由"""
+        duty, _ = self.predict(model)
+        limit = self.workers()*self.target
+        used = self.host_duty()
+        if used+duty>limit:
+            return f"asr load {used+duty:.2f}>{limit:.2f}"
+        busy = cpu_busy()
+        if busy is not None and busy>self.cpu_max:
+            return f"cpu busy {busy:.2f}>{self.cpu_max:.2f}"
+        mem = available_memory_mb()
+        if mem is not None and mem-self._session_mb(model)<self.mem_reserve_mb:
+            return f"memory {mem:.0f}MB"
+        return ''
+
+    def decide(self, session:str, lang:str|None, backend:str|None=None, *, queued:bool=False) ->Admission:
+        """受け付けられれば登録する(終わったらrelease)
+            queued: 待っていたセッションか(Falseなら、待っているセッションがあれば後ろに並ぶ)
+        """
+        keys = ladder_keys(lang)
+        top = lang_to_model(lang,backend)[0]
+        with self._lock:
+            self._active.pop(session,None) # 録音をやり直す場合は前の分を数えない
+        if not self.enabled:
+            return self._admit( session, Admission('admit', lang or '', top, '') )
+        waiting = len(self._waiters)>0 and not queued
+        reason = f"{len(self._waiters)} sessions waiting" if waiting else self._fits(top)
+        if reason=='':
+            return self._admit( session, Admission('admit', lang or '', top, '') )
+        if not waiting:
+            for key in keys[1:]:
+                model = lang_to_model(key,backend)[0]
+                if model!=top and self._fits(model)=='':
+                    return self._admit( session, Admission('degrade', key, model, reason) )
+        if queued or len(self._waiters)<self.queue_max:
+            return Admission('queue', lang or '', top, reason, len(self._waiters)+(0 if queued else 1))
+        self._counts['reject'] += 1
+        return Admission('reject', lang or '', top, f"{reason}, queue full {len(self._waiters)}")
+
+    def _admit(self, session:str, adm:Admission) ->Admission:
+        with self._lock:
+            self._active[session] = adm.model
+            self._counts[adm.action] += 1
+        return adm
+
+    async def acquire(self, session:str, lang:str|None, backend:str|None=None, *, on_queued:Callable[[Admission],None]|None=None) ->Admission:
+        """受け付けるまで待つ(待ちが一杯か、queue_sec秒待っても空かなければreject)"""
+        adm = self.decide(session, lang, backend)
+        if adm.action!='queue':
+            return adm
+        self._counts['queue'] += 1
+        entry = (session, asyncio.Event())
+        self._waiters.append(entry)
+        t_end = time.time()+self.queue_sec
+        position = 0
+        try:
+            while True:
+                pos = self._waiters.index(entry)+1
+                if pos!=position and on_queued is not None:
+                    on_queued( adm._replace(position=pos) )
+                position = pos
+                try:
+                    # 空いたら(release)起こされる。測定値やメモリの変化にも追うように一定間隔でも見直す
+                    await asyncio.wait_for( entry[1].wait(), 1.0 )
+                except asyncio.TimeoutError:
+                    pass
+                entry[1].clear()
+                if self._waiters[0] is entry:
+                    adm = self.decide(session, lang, backend, queued=True)
+                    if adm.action!='queue':
+                        if len(self._waiters)>1:
+                            self._waiters[1][1].set() # 次の人も入れるかもしれない
+                        return adm
+                if time.time()>t_end:
+                    self._counts['reject'] += 1
+                    return Admission('reject', lang or '', adm.model, f"{adm.reason}, waited {self.queue_sec:.0f}sec")
+        finally:
+            self._waiters.remove(entry)
+
+    def release(self, session:str):
+        with self._lock:
+            if self._active.pop(session,None) is None:
+                return
+        if self._waiters:
+            self._waiters[0][1].set()
+
+    def stats(self) ->dict:
+        with self._lock:
+            active = dict(self._active)
+        return { 'enabled': self.enabled, 'workers': self.workers(), 'target': self.target, 'host_duty': round(self.host_duty(),3),
+                 'active': len(active), 'queued': len(self._waiters), 'counts': dict(self._counts),
+                 'cpu_busy': round(b,2) if (b := cpu_busy()) is not None else None,
+                 'mem_available_mb': round(m) if (m := available_memory_mb()) is not None else None }
+
+    def report(self, backend:str|None=None) ->dict:
+        """WMのモデル毎に、このホストで全セッションがそのモデルを使ったら何セッションまで持つかの見積もり
+            sessions_asr: 推論ワーカーの数*target をセッション1つのdutyで割った数
+            sessions_mem: 使えるメモリ(受け付け済みのセッションの分は戻す)からmem_reserve_mbを除いて、セッション1つのメモリで割った数
+        """
+        limit = self.workers()*self.target
+        mem = available_memory_mb()
+        with self._lock:
+            active = list(self._active.values())
+        if mem is not None:
+            mem += sum( self._session_mb(m) for m in active )
+        ret:dict = {}
+        rtfs = self.rtfs()
+        for key,val in WM.items():
+            if not isinstance(val,tuple):
+                continue
+            model = lang_to_model(key,backend)[0]
+            duty, source = self.predict(model,rtfs)
+            entry:dict = { 'model': model, 'size': model_size(key), 'rtf': round(rtfs[model],4) if model in rtfs else None, 'duty': round(duty,3), 'source': source,
+                           'model_mb': round(self.model_mb(model),1), 'sessions_asr': math.floor(limit/duty) if duty>0 else None }
+            if mem is not None:
+                # 共有ならワーカー毎に1回ずつロードする
+                shared = self.model_mb(model)*self.workers() if self.shared_models else 0.0
+                entry['sessions_mem'] = max( 0, math.floor( (mem-self.mem_reserve_mb-shared)/self._session_mb(model) ) )
+            caps = [ x for x in (entry['sessions_asr'],entry.get('sessions_mem')) if x is not None ]
+            entry['sessions'] = min(caps) if caps else None
+            ret[key] = entry
+        return { 'workers': self.workers(), 'target': self.target, 'models': ret }
+
+def make_admission_controller( *, workers:Callable[[],float], shared_models:bool, model_stats:Callable[[],dict]|None=None,
+                               model_rtf:Callable[[],dict[str,float]]|None=None ) ->AdmissionController:
+    """閾値は環境変数で設定する
+        ASR_ADMISSION=0で無効(全て受け付ける)、ASR_ADMIT_TARGET, ASR_ADMIT_DUTY, ASR_ADMIT_CPU_MAX, ASR_ADMIT_MEM_RESERVE_MB,
+        ASR_ADMIT_QUEUE(待たせる人数), ASR_ADMIT_QUEUE_SEC
+    """
+    store_sec = int(os.getenv('ASR_AUDIO_STORE_SEC','120'))
+    return AdmissionController(
+        workers=workers, shared_models=shared_models, model_stats=model_stats, model_rtf=model_rtf,
+        target=float(os.getenv('ASR_ADMIT_TARGET','0.85')),
+        default_duty=float(os.getenv('ASR_ADMIT_DUTY','0.5')),
+        cpu_max=float(os.getenv('ASR_ADMIT_CPU_MAX','1.5')),
+        mem_reserve_mb=float(os.getenv('ASR_ADMIT_MEM_RESERVE_MB','512')),
+        # セッションのバッファ(音声の保存とリングバッファ)
+        session_mem_mb=store_sec*16000*2/1048576 + 8,
+        queue_max=int(os.getenv('ASR_ADMIT_QUEUE','8')),
+        queue_sec=float(os.getenv('ASR_ADMIT_QUEUE_SEC','60')),
+        enabled=os.getenv('ASR_ADMISSION','1')!='0',
+    )
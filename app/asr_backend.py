@@ -0,0 +1,319 @@
+import os
+import re
+import time
+import zlib
+from typing import Any
+import numpy as np
+from numpy.typing import NDArray
+
+from rec_util import AudioF32, EnergyVad, zero_cross_rate
+from prompt_context import Tokenizer, SimpleTokenizer
+
+"""
+音声認識エンジンの切り替え
+モデルの文字列は "<backend>:<path>" で、接頭辞が無ければmlx
+    mlx:  mlx_whisper (Apple Silicon)
+    cpu:  faster-whisper (CTranslate2) のint8量子化モデル。x86のサーバ用
+    fake: 台本のテキストを決まった時間で返す。モデル無しでパイプラインを試験する
+transcribeはmlx_whisperと同じ形のセグメントの辞書のリストを返す
+"""
+
+SAMPLE_RATE=16000
+
+class NoBackendError(RuntimeError):
+    """音声認識エンジン(mlx-whisper, faster-whisper)がインストールされていない"""
+    pass
+
+class AsrBackend:
+    """エンジンの共通インターフェース。モデルのキャッシュはModelRegistryが持つ"""
+    name:str = ''
+
+    def available(self) ->bool:
+        return False
+
+    def load(self, path:str) ->tuple[Any,int]:
+        """モデルをロードする。return: (モデル, メモリ上のサイズ(バイト))"""
+        raise NotImplementedError()
+
+    def unload(self, model:Any):
+        pass
+
+    def transcribe(self, model:Any, path:str, audio:AudioF32, *, lang:str|None, prompt:str|None) ->list[dict]:
+        raise NotImplementedError()
+
+    def tokenizer(self, path:str) ->Tokenizer|None:
+        """promptのトークン数を数えるためのトークナイザ。モデルのロード無しで作れなければNone"""
+        return None
+
+#--------------------
+# mlx_whisper
+#--------------------
+try:
+    import mlx.core as mx
+    from mlx.utils import tree_flatten
+    import mlx_whisper
+    from mlx_whisper.load_models import load_model as mlx_load_model
+    from mlx_whisper.transcribe import ModelHolder
+    from mlx_whisper.tokenizer import get_tokenizer as mlx_get_tokenizer
+    USE_MLX_WHISPER:bool = True
+except:
+    USE_MLX_WHISPER:bool = False
+
+class MlxBackend(AsrBackend):
+    """
+    mlx_whisperはModelHolderに1つしかモデルを持たず、パスが変わると推論の途中でロードしてしまうので、
+    ロード済みのモデルを推論の直前にModelHolderへ差し替える(ModelRegistryが推論を直列にする)
+    """
+    name = 'mlx'
+
+    def available(self) ->bool:
+        return USE_MLX_WHISPER
+
+    def load(self, path:str) ->tuple[Any,int]:
+        model = mlx_load_model(path, dtype=mx.float32) # fp16=Falseで推論する
+        mx.eval(model.parameters())
+        nbytes = sum( v.nbytes for _,v in tree_flatten(model.parameters()) )
+        return model, nbytes
+
+    def unload(self, model:Any):
+        if ModelHolder.model is model:
+            ModelHolder.model = None
+            ModelHolder.model_path = None
+
+    def transcribe(self, model:Any, path:str, audio:AudioF32, *, lang:str|None, prompt:str|None) ->list[dict]:
+        ModelHolder.model = model
+        ModelHolder.model_path = path
+        result = mlx_whisper.transcribe(
+            audio, path_or_hf_repo=path,
+            language=lang,
+            initial_prompt=prompt, # decode_optionsのpromptはtranscribeの中で上書きされるので使えない
+            #hallucination_silence_threshold=0.5,
+            no_speech_threshold=0.2,
+            fp16=False,
+            verbose=None)
+        segs = result.get("segments") if isinstance(result,dict) else None
+        if not isinstance(segs,list):
+            print(f"ERROR:result={result}")
+            return []
+        return segs
+
+    def tokenizer(self, path:str) ->Tokenizer|None:
+        # テキストのトークンは言語数によらず同じなので、英語専用かどうかだけで決まる
+        multilingual = re.search( r'\.en([-_/]|$)', path ) is None
+        return mlx_get_tokenizer( multilingual )
+
+#--------------------
+# faster-whisper (CPU int8)
+#--------------------
+try:
+    from faster_whisper import WhisperModel
+    from faster_whisper.utils import download_model
+    from tokenizers import Tokenizer as HfTokenizer
+    USE_FASTER_WHISPER:bool = True
+except:
+    USE_FASTER_WHISPER:bool = False
+
+class CpuBackend(AsrBackend):
+    """
+    faster-whisperのモデルをint8に量子化してCPUで動かす
+    pathはfaster-whisperのモデル名(tiny, small.en, large-v3-turbo等)かHFのリポジトリ名かディレクトリ
+    スレッド数は ASR_CPU_THREADS (0ならCTranslate2の既定値)
+    """
+    name = 'cpu'
+
+    def available(self) ->bool:
+        return USE_FASTER_WHISPER
+
+    def load(self, path:str) ->tuple[Any,int]:
+        model_dir = path if os.path.isdir(path) else download_model(path)
+        model = WhisperModel( model_dir, device='cpu', compute_type='int8', cpu_threads=int(os.getenv('ASR_CPU_THREADS','0')) )
+        # 重みの大半はmodel.binなので、そのサイズをメモリ量とする(int8に変換した分は小さくなる)
+        model_file = os.path.join(model_dir,'model.bin')
+        nbytes = os.path.getsize(model_file) if os.path.exists(model_file) else 0
+        return model, nbytes
+
+    def transcribe(self, model:Any, path:str, audio:AudioF32, *, lang:str|None, prompt:str|None) ->list[dict]:
+        segments, info = model.transcribe( audio, language=lang, initial_prompt=prompt, beam_size=1,
+                                          no_speech_threshold=0.2, condition_on_previous_text=False )
+        return [ {'id': s.id, 'seek': s.seek, 'start': s.start, 'end': s.end, 'text': s.text, 'tokens': s.tokens,
+                  'temperature': s.temperature, 'avg_logprob': s.avg_logprob,
+                  'compression_ratio': s.compression_ratio, 'no_speech_prob': s.no_speech_prob } for s in segments ]
+
+    def tokenizer(self, path:str) ->Tokenizer|None:
+        # ダウンロード済みのモデルのtokenizer.jsonを使う(ここではダウンロードしない)
+        model_dir = path if os.path.isdir(path) else download_model(path, local_files_only=True)
+        return _HfTokenizer( HfTokenizer.from_file( os.path.join(model_dir,'tokenizer.json') ) )
+
+class _HfTokenizer:
+    def __init__(self, tokenizer:Any):
+        self._tokenizer = tokenizer
+    def encode(self, text:str) ->list[Any]:
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+    def decode(self, tokens:list[Any]) ->str:
+        return self._tokenizer.decode(tokens)
+
+#--------------------
+# fake
+#--------------------
+DEFAULT_SCRIPT:list[str] = [
+    "Good morning everyone.",
+    "Let's start with the status of the release.",
+    "The build is green and the tests pass.",
+    "We still need to review the open issues.",
+    "Any questions before we move on?",
+]
+
+class FakeBackend(AsrBackend):
+    """
+    台本の単語をトーンの高さに割り当てて、音声のトーンから単語を読み取る決定的な偽のエンジン
+    synthesize()で作った音声なら台本どおりのテキストを、それ以外の音声でも内容から決まるテキストを返す
+        - 20msフレームのうち発話のフレームが続く区間を1単語とし、無音がsegment_gap秒以上続いたらセグメントを分ける
+        - ウィンドウの末尾で切れている単語は返さない(実際のモデルと同じく末尾は不安定になる)
+        - 推論時間は overhead + rtf*音声の秒数 だけ待つ
+    """
+    name = 'fake'
+    BASE_HZ:float = 300.0
+    STEP_HZ:float = 40.0
+
+    def __init__(self, *, script:list[str]=DEFAULT_SCRIPT, rtf:float=0.1, overhead:float=0.05, segment_gap:float=0.4):
+        self.script:list[str] = list(script)
+        self.words:list[str] = [ w for line in script for w in line.split() ]
+        self.vocab:list[str] = list(dict.fromkeys(self.words))
+        self.rtf:float = rtf
+        self.overhead:float = overhead
+        self.segment_gap:float = segment_gap
+
+    def available(self) ->bool:
+        return True
+
+    def load(self, path:str) ->tuple[Any,int]:
+        return path, 0
+
+    def word_hz(self, word:str) ->float:
+        return self.BASE_HZ + self.STEP_HZ*self.vocab.index(word)
+
+    def synthesize(self, *, word_sec:float=0.3, word_gap:float=0.08, sentence_gap:float=0.8, vol:float=0.3) ->tuple[AudioF32,list[tuple[float,float,str]]]:
+        """台本を読み上げた音声を作る。return: (音声, [(開始秒,終了秒,文)])"""
+        chunks:list[AudioF32] = [ np.zeros(int(SAMPLE_RATE*sentence_gap),dtype=np.float32) ]
+        pos:int = len(chunks[0])
+        timeline:list[tuple[float,float,str]] = []
+        for line in self._lines():
+            start = pos
+            for word in line.split():
+                t = np.arange( int(SAMPLE_RATE*word_sec) )/SAMPLE_RATE
+                tone = (vol*np.sin( 2*np.pi*self.word_hz(word)*t )).astype(np.float32)
+                gap = np.zeros( int(SAMPLE_RATE*word_gap), dtype=np.float32 )
+                chunks += [tone,gap]
+                pos += len(tone)+len(gap)
+            timeline.append( (start/SAMPLE_RATE, (pos-int(SAMPLE_RATE*word_gap))/SAMPLE_RATE, line) )
+            silence = np.zeros( int(SAMPLE_RATE*sentence_gap), dtype=np.float32 )
+            chunks.append(silence)
+            pos += len(silence)
+        return np.concatenate(chunks), timeline
+
+    def _lines(self) ->list[str]:
+        """台本の文。台本の1行か文末記号で区切る"""
+        lines = []
+        for text in self.script:
+            line = []
+            for w in text.split():
+                line.append(w)
+                if w[-1] in '.?!。？！':
+                    lines.append(' '.join(line))
+                    line = []
+            if line:
+                lines.append(' '.join(line))
+        return lines
+
+    def _word(self, tone:AudioF32) ->str:
+        hz = float(np.mean( zero_cross_rate(tone,len(tone)) ))*SAMPLE_RATE/2
+        idx = int(round( (hz-self.BASE_HZ)/self.STEP_HZ ))
+        if 0<=idx<len(self.vocab):
+            return self.vocab[idx]
+        # 台本に無い音は内容から決まる単語にする
+        return self.vocab[ zlib.crc32( np.round(tone[:64]*100).astype(np.int8).tobytes() ) % len(self.vocab) ]
+
+    def transcribe(self, model:Any, path:str, audio:AudioF32, *, lang:str|None, prompt:str|None) ->list[dict]:
+        t0 = time.time()
+        vad = EnergyVad( sample_rate=SAMPLE_RATE, hang_sec=0.0 )
+        frame = vad.frame
+        speech = vad.speech_frames(audio) if len(audio)>=frame else np.zeros(0,dtype=np.bool_)
+        # 発話フレームの連続区間 = 単語
+        edges = np.flatnonzero( np.diff( np.concatenate( ([0],speech.astype(np.int8),[0]) ) ) )
+        words:list[tuple[float,float,str]] = []
+        for s,e in zip(edges[0::2],edges[1::2]):
+            if e>=len(speech):
+                break # 末尾で切れている
+            if e-s<3:
+                continue
+            words.append( (float(s*frame/SAMPLE_RATE), float(e*frame/SAMPLE_RATE), self._word(audio[s*frame:e*frame])) )
+        segs:list[dict] = []
+        cur:list[tuple[float,float,str]] = []
+        for w in words:
+            if cur and w[0]-cur[-1][1]>=self.segment_gap:
+                segs.append( self._segment(len(segs),cur) )
+                cur = []
+            cur.append(w)
+        if cur:
+            segs.append( self._segment(len(segs),cur) )
+        wait = self.overhead + self.rtf*len(audio)/SAMPLE_RATE - (time.time()-t0)
+        if wait>0:
+            time.sleep(wait)
+        return segs
+
+    def tokenizer(self, path:str) ->Tokenizer|None:
+        return SimpleTokenizer()
+
+    def _segment(self, id:int, words:list[tuple[float,float,str]]) ->dict:
+        return { 'id': id, 'seek': 0, 'start': words[0][0], 'end': words[-1][1], 'text': ' '+' '.join( w[2] for w in words ),
+                 'tokens': [], 'temperature': 0.0, 'avg_logprob': -0.1, 'compression_ratio': 1.0, 'no_speech_prob': 0.0 }
+
+BACKENDS:dict[str,AsrBackend] = {
+    'mlx': MlxBackend(),
+    'cpu': CpuBackend(),
+    'fake': FakeBackend(),
+}
+
+def split_model(model:str) ->tuple[AsrBackend,str]:
+    """モデルの文字列をエンジンとパスに分ける"""
+    name, sep, path = model.partition(':')
+    if sep and name in BACKENDS:
+        return BACKENDS[name], path
+    return BACKENDS['mlx'], model
+
+_tokenizers:dict[str,Tokenizer] = {}
+
+def get_tokenizer(model:str) ->Tokenizer|None:
+    """モデルの文字列に対応するトークナイザ(作ったものは使い回す)。作れなければNone
+    作れなかったことは覚えない(モデルのダウンロードが終われば作れるので、次に呼ばれた時に作り直す)
+    """
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        backend, path = split_model(model)
+        if backend.available():
+            try:
+                tokenizer = backend.tokenizer(path)
+            except Exception as ex:
+                print(f"[asr_backend] no tokenizer for {model}: {str(ex)}")
+        if tokenizer is not None:
+            _tokenizers[model] = tokenizer
+    return tokenizer
+
+def join_model(backend:str, path:str) ->str:
+    return path if backend=='mlx' else f"{backend}:{path}"
+
+def default_backend() ->str:
+    """
+    ASR_BACKENDで指定が無ければ、mlx_whisperが使えればmlx、faster-whisperが使えればcpu
+    どちらも無ければNoBackendError(黙って空の結果を返し続けないように、起動時に止める)
+    ASR_BACKENDの指定はこのホストに無くても使う(ASR_NODESのノードのエンジンを指定する場合)
+    """
+    name = os.getenv('ASR_BACKEND','')
+    if name in BACKENDS:
+        return name
+    if USE_MLX_WHISPER:
+        return 'mlx'
+    if USE_FASTER_WHISPER:
+        return 'cpu'
+    raise NoBackendError( "no speech recognition engine: pip install mlx-whisper (Apple Silicon) or faster-whisper,"
+                          " or set ASR_BACKEND (fake for testing without a model)" )
@@ -0,0 +1,258 @@
+import os
+import json
+import hmac
+import struct
+import signal
+import asyncio
+import socket
+import ipaddress
+import numpy as np
+
+from asr_backend import BACKENDS
+from asr_service import AsrService
+from whisper_transcribe import Seg, WM, lang_to_model
+
+"""
+推論(AsrService)を別のマシンで動かすワーカーノード
+    フロント(transcribe_serverのRemoteAsrService)とはTCPで、長さ付きのフレームをやり取りする
+    フレーム: 全体の長さ(I) + ヘッダの長さ(I) + ヘッダ(JSON) + データ   (big endian)
+        フロント→ノード
+            {'op':'hello','secret'}   接続して最初に送る。共有の秘密(ASR_NODE_SECRET)が合わなければ切断する
+            {'op':'transcribe','rid','session','model','lang','prompt'} + 音声(float32)
+            {'op':'prefetch','model'}
+            modelはWMのモデル(各エンジン版)だけ受け付ける(任意のパスやリポジトリはロードしない)
+        ノード→フロント
+            {'op':'result','rid','segs':[[id,seek,start,end,text,avg_logprob,compression_ratio,no_speech_prob],...]}
+            {'op':'error','rid','error','retry'}   retry:別のノードでやり直せる(drain中など)。ridがNoneなら接続への応答(認証の失敗など)
+            {'op':'status','node','workers','pending','draining','models','rtf'}   helloの後と一定間隔、drainの開始時に送る
+    SIGTERM/SIGINTでdrainに入り、新しい要求は断って(retry)、処理中の要求が終わってから終了する
+    既定では127.0.0.1で待ち受ける。他のマシンから使うときはASR_NODE_HOSTとASR_NODE_SECRET(必須)を指定する
+usage: ASR_NODE_PORT=5101 ASR_WORKERS=2 python app/asr_node.py
+       ASR_NODE_HOST=0.0.0.0 ASR_NODE_SECRET=xxxx python app/asr_node.py
+"""
+
+FRAME = struct.Struct('!II')
+MAX_FRAME = 64*1024*1024
+
+def pack_msg( header:dict, data:bytes|memoryview=b'' ) ->bytes:
+    h = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return FRAME.pack( 4+len(h)+len(data), len(h) ) + h + data
+
+def unpack_msg( body:bytes ) ->tuple[dict,memoryview]:
+    """FRAMEの先頭の長さを除いた部分からヘッダとデータを取り出す"""
+    mv = memoryview(body)
+    hlen = struct.unpack_from('!I',mv)[0]
+    return json.loads( bytes(mv[4:4+hlen]).decode('utf-8') ), mv[4+hlen:]
+
+def recv_msg( sock:socket.socket ) ->tuple[dict,memoryview]|None:
+    """ブロッキングで1フレーム読む。接続が閉じたらNone"""
+    head = _recv_exact(sock,4)
+    if head is None:
+        return None
+    size = struct.unpack('!I',head)[0]
+    if size<4 or size>MAX_FRAME:
+        raise ValueError(f"invalid frame size {size}")
+    body = _recv_exact(sock,size)
+    return unpack_msg(body) if body is not None else None
+
+def _recv_exact( sock:socket.socket, n:int ) ->bytes|None:
+    buf = bytearray(n)
+    mv = memoryview(buf)
+    pos = 0
+    while pos<n:
+        k = sock.recv_into( mv[pos:], n-pos )
+        if k==0:
+            return None
+        pos += k
+    return bytes(buf)
+
+async def read_msg( reader:asyncio.StreamReader ) ->tuple[dict,memoryview]|None:
+    try:
+        size = struct.unpack('!I', await reader.readexactly(4))[0]
+        if size<4 or size>MAX_FRAME:
+            raise ValueError(f"invalid frame size {size}")
+        return unpack_msg( await reader.readexactly(size) )
+    except asyncio.IncompleteReadError:
+        return None
+
+def segs_to_list( segs:list[Seg] ) ->list[list]:
+    return [ [s.tid, s.seek, s.start, s.end, s.text, s.avg_logprob, s.compression_ratio, s.no_speech_prob] for s in segs ]
+
+def segs_from_list( items:list[list] ) ->list[Seg]:
+    return [ Seg(*x) for x in items ]
+
+def allowed_models() ->set[str]:
+    """ノードが受け付けるモデル。WMのモデルと、その各エンジン版(ladder_keysで下げる先もWMのキー)"""
+    ret = { v[0] for v in WM.values() if isinstance(v,tuple) }
+    for key in WM:
+        for backend in BACKENDS:
+            ret.add( lang_to_model(key,backend)[0] )
+    return ret
+
+def is_loopback( host:str ) ->bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host=='localhost'
+
+class RequestError(ValueError):
+    """ヘッダが不正な要求。エラーを返して接続は続ける"""
+    pass
+
+def check_request( header:dict, data:memoryview, models:set[str] ):
+    """transcribeとprefetchのヘッダを検査する。不正ならRequestError"""
+    model = header.get('model')
+    if not isinstance(model,str) or model not in models:
+        raise RequestError(f"model not allowed: {str(model)[:100]}")
+    if header.get('op')!='transcribe':
+        return
+    if not isinstance(header.get('rid'),int):
+        raise RequestError("rid must be int")
+    for key in ('session','lang'):
+        if not isinstance(header.get(key,''),str):
+            raise RequestError(f"{key} must be str")
+    if not isinstance(header.get('prompt'),(str,type(None))):
+        raise RequestError("prompt must be str or null")
+    if len(data)==0 or len(data)%4!=0:
+        raise RequestError(f"invalid audio length {len(data)}")
+
+class AsrNode:
+    """
+    AsrServiceをTCPで公開する。複数のフロントから接続を受け付け、要求はAsrServiceのバッチにまとめて処理する
+        secret: helloで送られる共有の秘密。127.0.0.1以外で待ち受けるなら必須
+    """
+    def __init__(self, *, host:str='127.0.0.1', port:int=5101, secret:str='', workers:int=1, preload:list[str]=[], name:str|None=None,
+                 status_interval:float=1.0, hello_timeout:float=10.0):
+        if not secret and not is_loopback(host):
+            raise ValueError(f"ASR_NODE_SECRET is required to listen on {host}")
+        self.host:str = host
+        self.port:int = port
+        self._secret:bytes = secret.encode('utf-8')
+        self.hello_timeout:float = hello_timeout
+        self.models:set[str] = allowed_models()
+        self.name:str = name or f"{socket.gethostname()}:{port}"
+        self.status_interval:float = status_interval
+        self.service:AsrService = AsrService( workers=workers, preload=preload )
+        self.draining:bool = False
+        self._writers:set[asyncio.StreamWriter] = set()
+        self._inflight:int = 0
+        self._served:int = 0
+        self._rejected:int = 0
+        self._stopped:asyncio.Event|None = None
+
+    def status(self) ->dict:
+        return { 'op': 'status', 'node': self.name, 'workers': self.service.workers, 'pending': self._inflight,
+                 'draining': self.draining, 'served': self._served, 'rejected': self._rejected, 'rtf': self.service.model_rtf(),
+                 'models': { str(wid):stats for wid,stats in self.service.model_stats().items() } }
+
+    def _broadcast(self, msg:bytes):
+        for w in list(self._writers):
+            if not w.is_closing():
+                w.write(msg)
+
+    async def _hello(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) ->bool:
+        """最初のメッセージがhelloで、秘密が合っているか。違えばエラーを返す"""
+        try:
+            msg = await asyncio.wait_for( read_msg(reader), self.hello_timeout )
+        except asyncio.TimeoutError:
+            msg = None
+        header = msg[0] if msg is not None else None
+        secret = header.get('secret') if isinstance(header,dict) and header.get('op')=='hello' else None
+        if isinstance(secret,str) and hmac.compare_digest( secret.encode('utf-8'), self._secret ):
+            return True
+        writer.write( pack_msg({'op':'error','rid':None,'error':'authentication failed','retry':False}) )
+        return False
+
+    async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        print(f"[AsrNode]connect {peer}")
+        try:
+            if not await self._hello(reader,writer):
+                print(f"[AsrNode]{peer} authentication failed")
+                return
+            self._writers.add(writer)
+            writer.write( pack_msg(self.status()) )
+            while (msg := await read_msg(reader)) is not None:
+                header, data = msg
+                rid = header.get('rid') if isinstance(header,dict) else None
+                try:
+                    if not isinstance(header,dict):
+                        raise RequestError("header must be an object")
+                    op = header.get('op')
+                    if op=='transcribe':
+                        check_request( header, data, self.models )
+                        if self.draining:
+                            writer.write( pack_msg({'op':'error','rid':rid,'error':f"{self.name} draining",'retry':True}) )
+                            continue
+                        audio = np.frombuffer(data,dtype=np.float32).copy()
+                        fut = self.service.submit( audio, model=header['model'], lang=header.get('lang',''), prompt=header.get('prompt'),
+                                                   session=f"{peer}/{header.get('session','')}" )
+                        self._inflight += 1
+                        asyncio.wrap_future(fut).add_done_callback( lambda f,rid=rid: self._reply(writer,rid,f) )
+                    elif op=='prefetch':
+                        check_request( header, data, self.models )
+                        self.service.prefetch( header['model'] )
+                    else:
+                        raise RequestError(f"unknown op {str(op)[:32]}")
+                except RequestError as ex:
+                    self._rejected += 1
+                    print(f"[AsrNode]{peer} reject {str(ex)}")
+                    writer.write( pack_msg({'op':'error','rid':rid if isinstance(rid,int) else None,'error':str(ex),'retry':False}) )
+        except (ConnectionError, ValueError) as ex:
+            print(f"[AsrNode]{peer} {str(ex)}")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+            print(f"[AsrNode]disconnect {peer}")
+
+    def _reply(self, writer:asyncio.StreamWriter, rid:int, f:asyncio.Future):
+        self._inflight -= 1
+        self._served += 1
+        if writer.is_closing():
+            return
+        if f.cancelled() or f.exception() is not None:
+            writer.write( pack_msg({'op':'error','rid':rid,'error':str(f.exception()) if not f.cancelled() else 'cancelled','retry':False}) )
+        else:
+            writer.write( pack_msg({'op':'result','rid':rid,'segs':segs_to_list(f.result())}) )
+
+    def drain(self):
+        """新しい要求を断り、処理中の要求が終わったら終了する"""
+        if self.draining:
+            return
+        print(f"[AsrNode]drain {self.name} pending {self._inflight}")
+        self.draining = True
+        self._broadcast( pack_msg(self.status()) )
+
+    async def serve(self, *, drain_timeout:float=30.0):
+        self._stopped = asyncio.Event()
+        await asyncio.to_thread(self.service.start)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.drain)
+        server = await asyncio.start_server( self._handle, self.host, self.port )
+        print(f"[AsrNode]listen {self.name}")
+        try:
+            while not self.draining:
+                await asyncio.sleep(self.status_interval)
+                self._broadcast( pack_msg(self.status()) )
+            server.close()
+            t_end = loop.time()+drain_timeout
+            while self._inflight>0 and loop.time()<t_end:
+                await asyncio.sleep(0.05)
+            self._broadcast( pack_msg(self.status()) )
+            for w in list(self._writers):
+                w.close()
+        finally:
+            await asyncio.to_thread(self.service.stop)
+            print(f"[AsrNode]end {self.name} served {self._served}")
+
+def main():
+    host = os.getenv('ASR_NODE_HOST','127.0.0.1')
+    port = int(os.getenv('ASR_NODE_PORT','5101'))
+    workers = int(os.getenv('ASR_WORKERS','1'))
+    preload = [ lang_to_model(x.strip())[0] for x in os.getenv('ASR_PRELOAD','en,ja').split(',') if x.strip() ]
+    node = AsrNode( host=host, port=port, secret=os.getenv('ASR_NODE_SECRET',''), workers=workers, preload=preload, name=os.getenv('ASR_NODE_NAME') )
+    asyncio.run( node.serve() )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import os
+import time
+import socket
+import threading
+from threading import Thread
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from logging import Logger
+import numpy as np
+
+from whisper_transcribe import Seg, SAMPLE_RATE
+from asr_backend import split_model
+from asr_node import pack_msg, recv_msg, segs_from_list
+
+class NodeUnavailable(ConnectionError):
+    """ノードに繋がらない・drain中で断られた。別のノードでやり直せる"""
+    pass
+
+class NodeLink:
+    """1つのワーカーノードとの接続。切れたら繋ぎ直す"""
+    def __init__(self, addr:str, *, timeout:float, secret:str, on_status, on_connect):
+        host, _, port = addr.rpartition(':')
+        self.addr:str = addr
+        self._host:str = host or '127.0.0.1'
+        self._port:int = int(port)
+        self._timeout:float = timeout
+        self._secret:str = secret
+        self._on_status = on_status
+        self._on_connect = on_connect
+        self._sock:socket.socket|None = None
+        self._send_lock:threading.Lock = threading.Lock()
+        self._lock:threading.Lock = threading.Lock()
+        self._pending:dict[int,Future] = {}
+        self._rid:int = 0
+        self._closed:bool = False
+        self._thread:Thread|None = None
+        self.status:dict = {}
+        self.connected:bool = False
+        self.failures:int = 0
+
+    @property
+    def draining(self) ->bool:
+        return bool(self.status.get('draining'))
+
+    def usable(self) ->bool:
+        return self.connected and not self.draining
+
+    def inflight(self) ->int:
+        with self._lock:
+            return len(self._pending)
+
+    def workers(self) ->int:
+        return max(1,int(self.status.get('workers',1)))
+
+    def load(self) ->float:
+        """ワーカー1つあたりの処理待ち。ノードの値は他のフロントの分も含むが、間隔が空くので自分の送信中の数と大きい方を使う"""
+        return max( int(self.status.get('pending',0)), self.inflight() )/self.workers()
+
+    def start(self):
+        self._closed = False
+        self._thread = Thread( target=self._th_link, name=f'asr_node_{self.addr}', daemon=True )
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def send(self, header:dict, data:bytes|memoryview=b'') ->Future|None:
+        """送信する。transcribeなら結果のFutureを返す"""
+        sock = self._sock
+        if sock is None or not self.connected:
+            raise NodeUnavailable(f"{self.addr} not connected")
+        fut:Future|None = None
+        if header.get('op')=='transcribe':
+            fut = Future()
+            with self._lock:
+                self._rid = ( rid := self._rid+1 )
+                self._pending[rid] = fut
+            header['rid'] = rid
+        try:
+            with self._send_lock:
+                sock.sendall( pack_msg(header,data) )
+        except OSError as ex:
+            if fut is not None:
+                with self._lock:
+                    self._pending.pop(header['rid'],None)
+            raise NodeUnavailable(f"{self.addr} {str(ex)}")
+        return fut
+
+    def forget(self, fut:Future):
+        """待ちきれなかった要求を外す(後から届いた結果は捨てる)"""
+        with self._lock:
+            for rid,x in list(self._pending.items()):
+                if x is fut:
+                    del self._pending[rid]
+
+    def _th_link(self):
+        """接続して、結果と状態を受け取る。切れたら処理中の要求をNodeUnavailableで返して繋ぎ直す"""
+        while not self._closed:
+            try:
+                sock = socket.create_connection( (self._host,self._port), timeout=self._timeout )
+            except OSError:
+                self.failures += 1
+                time.sleep(1.0)
+                continue
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+            # 状態は一定間隔で届くので、timeoutの間何も届かなければ止まったとみなす
+            sock.settimeout(self._timeout)
+            self._sock = sock
+            try:
+                sock.sendall( pack_msg({'op':'hello','secret':self._secret}) )
+                while (msg := recv_msg(sock)) is not None:
+                    header, _ = msg
+                    op = header.get('op')
+                    if op=='status':
+                        first = not self.connected
+                        self.status = header
+                        self.connected = True
+                        if first:
+                            print(f"[RemoteAsr]connect {self.addr} {header.get('node')} workers {header.get('workers')}")
+                            self._on_connect(self)
+                        self._on_status(self)
+                        continue
+                    if op=='error' and header.get('rid') is None:
+                        print(f"[RemoteAsr]{self.addr} {header.get('error')}")
+                        continue
+                    with self._lock:
+                        fut = self._pending.pop(header.get('rid'),None)
+                    if fut is None:
+                        continue
+                    if op=='result':
+                        fut.set_result( segs_from_list(header.get('segs',[])) )
+                    elif header.get('retry'):
+                        fut.set_exception( NodeUnavailable(header.get('error','')) )
+                    else:
+                        fut.set_exception( RuntimeError(header.get('error','')) )
+            except (OSError, ValueError) as ex:
+                if not self._closed:
+                    print(f"[RemoteAsr]{self.addr} {type(ex).__name__} {str(ex)}")
+            finally:
+                was = self.connected
+                self.connected = False
+                self._sock = None
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+                with self._lock:
+                    pending = self._pending
+                    self._pending = {}
+                for fut in pending.values():
+                    fut.set_exception( NodeUnavailable(f"{self.addr} disconnected") )
+                if was:
+                    print(f"[RemoteAsr]disconnect {self.addr}")
+                    self._on_status(self)
+            if not self._closed:
+                time.sleep(1.0)
+
+class RemoteAsrService:
+    """
+    AsrServiceと同じ形で呼べる、別のマシンのワーカーノード(asr_node.AsrNode)に推論を投げるサービス
+    セッション毎の状態は呼び出し側(MlxWhisperProcess)が持ち、ノードはウィンドウ単位で推論するだけなので、
+    セッションはどのノードにも移せる
+        - 配置: セッションの最初の要求で、ワーカー1つあたりの処理待ちが最も少ないノードに割り当て、以後は同じノードに送る
+                (同じノードの要求はバッチにまとまり、プロンプトやモデルのロードも揃う)
+        - 移動: ノードがdrainを始めたか切れたら、そのノードのセッションを外し、次の要求で別のノードに割り当て直す
+                送信中の要求が断られたり切れて失われたら、別のノードでやり直す
+                request_timeout秒待っても結果が来ない要求(ノードが詰まっている)も、別のノードでやり直す
+        - 認証: 接続の度にhelloでsecret(既定はASR_NODE_SECRET)を送る
+    """
+    def __init__(self, nodes:list[str], *, timeout:float=10.0, request_timeout:float=30.0, retry:int=2, session_ttl:float=60.0, secret:str|None=None):
+        self._retry:int = retry
+        self._session_ttl:float = session_ttl
+        self._request_timeout:float = request_timeout
+        secret = secret if secret is not None else os.getenv('ASR_NODE_SECRET','')
+        self._links:list[NodeLink] = [ NodeLink(addr, timeout=timeout, secret=secret, on_status=self._on_status, on_connect=self._on_connect) for addr in nodes ]
+        self._lock:threading.Lock = threading.Lock()
+        self._placement:dict[str,tuple[NodeLink,float]] = {} # session -> (ノード, 最後に使った時刻)
+        self._prefetched:list[str] = []
+        self._moving:set[str] = set() # 外されて、次の要求で割り当て直すセッション
+        self._moved:int = 0
+        self._retried:int = 0
+        self._timeouts:int = 0
+        self._requests:dict[str,int] = { link.addr:0 for link in self._links }
+
+    @property
+    def workers(self) ->int:
+        return max( 1, sum( link.workers() for link in self._links if link.usable() ) )
+
+    def model_stats(self) ->dict[str,list[dict]]:
+        """ノードとワーカー毎のロード済みモデル"""
+        ret:dict[str,list[dict]] = {}
+        for link in self._links:
+            for wid,stats in link.status.get('models',{}).items():
+                ret[f"{link.addr}/{wid}"] = stats
+        return ret
+
+    def model_rtf(self) ->dict[str,float]:
+        """ノードが測ったモデル毎の推論だけのRTF(ノードの平均)"""
+        vals:dict[str,list[float]] = {}
+        for link in self._links:
+            if link.connected:
+                for model,rtf in link.status.get('rtf',{}).items():
+                    vals.setdefault(model,[]).append(rtf)
+        return { m:sum(x)/len(x) for m,x in vals.items() }
+
+    def ready(self, model:str) ->bool:
+        """使えるノードの全てのワーカーがモデルをロード済みか"""
+        if not split_model(model)[0].available():
+            return True
+        links = [ link for link in self._links if link.usable() ]
+        if not links:
+            return False
+        for link in links:
+            models = link.status.get('models',{})
+            if len(models)<link.workers() or not all( any( m['path']==model for m in stats ) for stats in models.values() ):
+                return False
+        return True
+
+    def prefetch(self, model:str):
+        """全てのノードにモデルを先読みさせる(後から繋がったノードにも送る)"""
+        with self._lock:
+            if model not in self._prefetched:
+                self._prefetched.append(model)
+        for link in self._links:
+            if link.usable():
+                try:
+                    link.send( {'op':'prefetch','model':model} )
+                except NodeUnavailable:
+                    pass
+
+    def pending(self) ->int:
+        return sum( link.inflight() for link in self._links )
+
+    def node_stats(self) ->dict:
+        with self._lock:
+            sessions:dict[str,int] = {}
+            for link,_ in self._placement.values():
+                sessions[link.addr] = sessions.get(link.addr,0)+1
+            ret:dict = { 'moved': self._moved, 'retried': self._retried, 'timeouts': self._timeouts, 'nodes': {} }
+            for link in self._links:
+                ret['nodes'][link.addr] = { 'node': link.status.get('node'), 'connected': link.connected, 'draining': link.draining,
+                                            'workers': link.workers(), 'pending': link.status.get('pending',0), 'inflight': link.inflight(),
+                                            'sessions': sessions.get(link.addr,0), 'requests': self._requests.get(link.addr,0) }
+            return ret
+
+    def start(self):
+        print(f"[RemoteAsr]start {len(self._links)} nodes {[ link.addr for link in self._links ]}")
+        for link in self._links:
+            link.start()
+
+    def stop(self):
+        for link in self._links:
+            link.close()
+        with self._lock:
+            self._placement = {}
+
+    def _on_connect(self, link:NodeLink):
+        with self._lock:
+            models = list(self._prefetched)
+        for model in models:
+            try:
+                link.send( {'op':'prefetch','model':model} )
+            except NodeUnavailable:
+                pass
+
+    def _on_status(self, link:NodeLink):
+        """drainを始めたか切れたノードのセッションを外す(次の要求で割り当て直す)"""
+        if link.usable():
+            return
+        with self._lock:
+            released = [ s for s,(x,_) in self._placement.items() if x is link ]
+            for s in released:
+                del self._placement[s]
+            self._moving.update(released)
+        if released:
+            print(f"[RemoteAsr]{link.addr} {'draining' if link.draining else 'down'}, move {len(released)} sessions")
+
+    def _place(self, session:str, exclude:set[NodeLink]) ->NodeLink:
+        now = time.time()
+        with self._lock:
+            cur = self._placement.get(session)
+            if cur is not None and cur[0].usable() and cur[0] not in exclude:
+                self._placement[session] = (cur[0],now)
+                return cur[0]
+            # 終わったセッションは通知が無いので、しばらく使われなければ忘れる
+            for s in [ s for s,(_,t) in self._placement.items() if now-t>self._session_ttl ]:
+                del self._placement[s]
+            sessions:dict[NodeLink,int] = {}
+            for x,_ in self._placement.values():
+                sessions[x] = sessions.get(x,0)+1
+            links = [ link for link in self._links if link.usable() and link not in exclude ]
+            if not links:
+                raise NodeUnavailable("no asr node available")
+            link = min( links, key=lambda x: (x.load(), sessions.get(x,0)/x.workers()) )
+            if cur is not None or session in self._moving:
+                self._moving.discard(session)
+                self._moved += 1
+            self._placement[session] = (link,now)
+            return link
+
+    def transcribe(self, audio:np.ndarray, *, model:str, lang:str='', prompt:str|None=None, logger:Logger|None=None, session:str='') ->list[Seg]:
+        """whisper_transcribe.transcribeと同じ形で呼べるブロッキング版"""
+        t0 = time.time()
+        data = memoryview( np.ascontiguousarray(audio,dtype=np.float32) ).cast('B')
+        err:Exception|None = None
+        failed:set[NodeLink] = set() # 断られたノード(drainの状態が届く前でも)には送り直さない
+        for attempt in range(self._retry+1):
+            link:NodeLink|None = None
+            try:
+                link = self._place(session,failed)
+                fut = link.send( {'op':'transcribe','session':session,'model':model,'lang':lang,'prompt':prompt}, data )
+                with self._lock:
+                    self._requests[link.addr] += 1
+                try:
+                    segs:list[Seg] = fut.result( timeout=self._request_timeout )
+                except FutureTimeout:
+                    link.forget(fut)
+                    with self._lock:
+                        self._timeouts += 1
+                    print(f"[RemoteAsr]{link.addr} no result in {self._request_timeout:.1f}sec")
+                    raise NodeUnavailable(f"{link.addr} timeout")
+                break
+            except NodeUnavailable as ex:
+                err = ex
+                if link is not None:
+                    failed.add(link)
+                with self._lock:
+                    self._retried += 1
+                if attempt<self._retry:
+                    time.sleep(0.2*attempt)
+        else:
+            raise err if err is not None else NodeUnavailable("no asr node available")
+        if logger is not None:
+            t0 = time.time()-t0
+            logger.info(f"[transcribe] elaps time {t0:.3f}/{len(audio)/SAMPLE_RATE:.3f}sec")
+        return segs
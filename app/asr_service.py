@@ -0,0 +1,250 @@
+import time
+import traceback
+import threading
+from threading import Thread
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import Process, Queue
+from queue import Empty
+from logging import Logger
+import numpy as np
+
+from whisper_transcribe import transcribe, Seg, SAMPLE_RATE
+from model_registry import get_registry
+from asr_backend import split_model
+
+def _worker_main( wid:int, request_queue:Queue, result_queue:Queue, ctrl_queue:Queue, preload:list[str] ):
+    """モデルを保持するワーカープロセス
+        request: (rid, audio, model, lang, prompt) / None で終了
+        result: (rid, list[Seg]|None, error:str)
+                要求を処理し始める時に ('busy', wid, rid)(ワーカーが終了した時に、処理中だった要求を失敗にする)
+                ロード済みのモデルが変わったら ('models', wid, ModelEntry.json()のリスト)
+                モデルを呼ぶ毎に ('rtf', model, 音声の秒数, 推論の秒数)
+        ctrl: 先読みするモデルのパス / None で終了
+    """
+    print(f"[AsrWorker]{wid} start")
+    registry = get_registry()
+    registry.on_change = lambda stats: result_queue.put( ('models', wid, stats) )
+    def prefetch():
+        while (path := ctrl_queue.get()) is not None:
+            registry.prefetch(path)
+    Thread( target=prefetch, name='asr_prefetch', daemon=True ).start()
+    try:
+        registry.preload(preload)
+        registry.notify()
+        # 空いたワーカーが届いた順に1つずつ処理する
+        while (req := request_queue.get()) is not None:
+            rid,audio,model,lang,prompt = req
+            result_queue.put( ('busy', wid, rid) )
+            try:
+                t0 = time.time()
+                segs = transcribe( audio, model=model, lang=lang, prompt=prompt )
+                t0 = time.time()-t0
+                result_queue.put( ('rtf', model, len(audio)/SAMPLE_RATE, t0) )
+                result_queue.put( (rid, segs, '') )
+            except Exception as ex:
+                traceback.print_exc()
+                result_queue.put( (rid, None, f"{str(ex)}") )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ctrl_queue.put(None)
+        print(f"[AsrWorker]{wid} end")
+
+class AsrService:
+    """
+    モデルを保持するワーカープロセスを固定数だけ起動して、複数セッションから音声ウィンドウを受け付ける
+    セッション毎の状態(バッファや確定位置)は呼び出し側(MlxWhisperProcess)が持つので、
+    メモリはワーカー数にだけ比例する
+    要求は1つのキューに入れ、空いたワーカーが届いた順に1つずつ処理する
+    (エンジンに別々の音声をまとめて推論するAPIが無いので、要求を待ってまとめても1つずつ呼ぶことになり、遅れるだけ)
+    モデルは各ワーカーのModelRegistryが持ち、起動時にpreloadのモデルをロードしておく
+    ワーカーが終了したら(クラッシュ・OOM)、処理中だった要求を失敗にして、ワーカーを起動し直す
+    transcribe()はrequest_timeout秒待っても結果が来なければTimeoutError(RemoteAsrServiceと同じ)
+    """
+    def __init__(self, *, workers:int=1, preload:list[str]=[], request_timeout:float=30.0):
+        self._num_workers:int = max(1,workers)
+        self._request_timeout:float = request_timeout
+        self._request_queue:Queue = Queue()
+        self._result_queue:Queue = Queue()
+        self._ctrl_queues:list[Queue] = []
+        self._preload:list[str] = list(preload)
+        self._models:dict[int,list[dict]] = {} # ワーカー毎のロード済みモデル
+        self._rtf:dict[str,float] = {} # モデル毎の推論の秒数/音声の秒数(待ち時間を含まない)の指数移動平均
+        self._procs:list[Process] = []
+        self._lock:threading.Lock = threading.Lock()
+        self._rid:int = 0
+        self._pending:dict[int,Future] = {}
+        self._busy:dict[int,int] = {} # ワーカー -> 処理中の要求
+        self._restarts:int = 0
+        self._stopping:bool = False
+        self._dispatch_thread:Thread|None = None
+
+    @property
+    def workers(self) ->int:
+        return self._num_workers
+
+    def model_stats(self) ->dict[int,list[dict]]:
+        """ワーカー毎のロード済みモデルと、ロード・ウォームアップにかかった時間"""
+        with self._lock:
+            return dict(self._models)
+
+    def model_rtf(self) ->dict[str,float]:
+        """モデル毎の推論だけのRTF(受け付けの判断に使う)"""
+        with self._lock:
+            return dict(self._rtf)
+
+    def ready(self, model:str) ->bool:
+        """全てのワーカーがモデルをロード済みか(エンジンが使えなければ待っても無駄なのでTrue)"""
+        if not split_model(model)[0].available():
+            return True
+        with self._lock:
+            if len(self._models)<len(self._procs):
+                return False
+            return all( any( m['path']==model for m in stats ) for stats in self._models.values() )
+
+    def prefetch(self, model:str):
+        """全てのワーカーにモデルを先読みさせる"""
+        for q in self._ctrl_queues:
+            q.put(model)
+
+    def pending(self) ->int:
+        """処理待ちのリクエスト数"""
+        with self._lock:
+            return len(self._pending)
+
+    @property
+    def restarts(self) ->int:
+        """終了したワーカーを起動し直した回数"""
+        return self._restarts
+
+    def _spawn(self, wid:int) ->tuple[Process,Queue]:
+        ctrl_queue:Queue = Queue()
+        proc = Process( target=_worker_main, name=f'asrworker{wid}', args=(wid, self._request_queue, self._result_queue, ctrl_queue, self._preload), daemon=True )
+        proc.start()
+        return proc, ctrl_queue
+
+    def start(self):
+        if len(self._procs)>0:
+            return
+        print(f"[AsrService]start {self._num_workers} workers")
+        self._stopping = False
+        for wid in range(self._num_workers):
+            proc, ctrl_queue = self._spawn(wid)
+            self._procs.append(proc)
+            self._ctrl_queues.append(ctrl_queue)
+        self._dispatch_thread = Thread( target=self._th_dispatch, name='asr_dispatch', daemon=True )
+        self._dispatch_thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True # 終了させたワーカーを起動し直さない
+            procs = self._procs
+            self._procs = []
+            self._models = {}
+        for q in self._ctrl_queues:
+            q.put(None)
+        self._ctrl_queues = []
+        for _ in procs:
+            self._request_queue.put(None)
+        for proc in procs:
+            proc.join(1.0)
+            if proc.is_alive():
+                proc.terminate()
+        self._result_queue.put(None)
+        if self._dispatch_thread is not None:
+            self._dispatch_thread.join(1.0)
+            self._dispatch_thread = None
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        for fut in pending.values():
+            fut.set_exception( RuntimeError("AsrService stopped") )
+
+    def submit(self, audio:np.ndarray, *, model:str, lang:str='', prompt:str|None=None, session:str='') ->Future:
+        """音声ウィンドウをワーカーに投入する。sessionはRemoteAsrService(ノードの割り当てに使う)と呼び方を揃えるためのもので、ここでは使わない"""
+        fut:Future = Future()
+        with self._lock:
+            self._rid = ( rid := self._rid+1 )
+            self._pending[rid] = fut
+        self._request_queue.put( (rid, audio, model, lang, prompt) )
+        return fut
+
+    def transcribe(self, audio:np.ndarray, *, model:str, lang:str='', prompt:str|None=None, logger:Logger|None=None, session:str='') ->list[Seg]:
+        """whisper_transcribe.transcribeと同じ形で呼べるブロッキング版"""
+        t0 = time.time()
+        fut = self.submit( audio, model=model, lang=lang, prompt=prompt, session=session )
+        try:
+            segs:list[Seg] = fut.result( timeout=self._request_timeout )
+        except FutureTimeout:
+            # 後から届いた結果は捨てる
+            with self._lock:
+                for rid in [ rid for rid,f in self._pending.items() if f is fut ]:
+                    del self._pending[rid]
+            raise TimeoutError(f"no result in {self._request_timeout:.1f}sec")
+        if logger is not None:
+            t0 = time.time()-t0
+            logger.info(f"[transcribe] elaps time {t0:.3f}/{len(audio)/SAMPLE_RATE:.3f}sec")
+        return segs
+
+    def _check_workers(self):
+        """終了したワーカーが処理中だった要求を失敗にして、ワーカーを起動し直す"""
+        failed:list[tuple[Future,str]] = []
+        with self._lock:
+            if self._stopping:
+                return
+            for wid,proc in enumerate(self._procs):
+                if proc.is_alive():
+                    continue
+                msg = f"asr worker {wid} exited ({proc.exitcode})"
+                print(f"[AsrService]{msg}, restart")
+                fut = self._pending.pop( self._busy.pop(wid,-1), None )
+                if fut is not None:
+                    failed.append( (fut,msg) )
+                self._models.pop(wid,None)
+                self._procs[wid], self._ctrl_queues[wid] = self._spawn(wid)
+                self._restarts += 1
+        for fut,msg in failed:
+            fut.set_exception( RuntimeError(msg) )
+
+    def _th_dispatch(self):
+        """ワーカーの結果をリクエスト元のFutureに返す。結果が来ない間にワーカーの終了を確かめる"""
+        try:
+            checked = time.monotonic()
+            while True:
+                if time.monotonic()-checked>=0.5:
+                    checked = time.monotonic()
+                    self._check_workers()
+                try:
+                    res = self._result_queue.get(timeout=0.5)
+                except Empty:
+                    continue
+                if res is None:
+                    break
+                if res[0]=='busy':
+                    _, wid, rid = res
+                    with self._lock:
+                        self._busy[wid] = rid
+                    continue
+                if res[0]=='models':
+                    _, wid, stats = res
+                    with self._lock:
+                        self._models[wid] = stats
+                    continue
+                if res[0]=='rtf':
+                    _, model, audio_sec, sec = res
+                    if audio_sec>0:
+                        with self._lock:
+                            prev = self._rtf.get(model)
+                            self._rtf[model] = sec/audio_sec if prev is None else prev + 0.2*(sec/audio_sec-prev)
+                    continue
+                rid, segs, err = res
+                with self._lock:
+                    fut = self._pending.pop(rid,None)
+                if fut is None:
+                    continue
+                if err:
+                    fut.set_exception( RuntimeError(err) )
+                else:
+                    fut.set_result( segs )
+        except Exception as ex:
+            traceback.print_exc()
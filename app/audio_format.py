@@ -0,0 +1,210 @@
+import struct
+from typing import NamedTuple
+
+"""
+ブラウザから届く音声の先頭を見て、コンテナとコーデックを判定する(ffmpegを起動しない)
+判定できるのは MediaRecorderが出力するWebM/Matroska、MP4、Ogg と WAV
+"""
+
+class AudioFormat(NamedTuple):
+    container:str
+    codec:str
+    error:str # ''なら受け付ける
+
+# ffmpegでデコードできるコーデック
+ACCEPT_CODECS:set[str] = { 'opus', 'vorbis', 'flac', 'aac', 'mp3', 'pcm', 'alaw', 'mulaw' }
+
+def _verdict( container:str, codec:str ) ->AudioFormat:
+    if codec in ACCEPT_CODECS:
+        return AudioFormat(container,codec,'')
+    return AudioFormat(container,codec,f"unsupported codec {codec} in {container}")
+
+#--------------------
+# EBML (WebM/Matroska)
+#--------------------
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+_EBML_HEADER = 0x1A45DFA3
+_EBML_SEGMENT = 0x18538067
+_EBML_TRACKS = 0x1654AE6B
+_EBML_TRACK_ENTRY = 0xAE
+_EBML_CODEC_ID = 0x86
+_EBML_DOCTYPE = 0x4282
+_EBML_CLUSTER = 0x1F43B675
+_EBML_MASTERS = { _EBML_HEADER, _EBML_SEGMENT, _EBML_TRACKS, _EBML_TRACK_ENTRY }
+
+_MKV_CODECS:dict[str,str] = {
+    'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_FLAC': 'flac', 'A_MPEG/L3': 'mp3',
+    'A_PCM/INT/LIT': 'pcm', 'A_PCM/INT/BIG': 'pcm', 'A_PCM/FLOAT/IEEE': 'pcm',
+}
+
+def _ebml_vint( data:bytes, pos:int, keep_marker:bool ) ->tuple[int,int]|None:
+    """可変長整数を読む。return: (値, 次の位置)。データが足りなければNone。値が全部1ならサイズ不明として-1"""
+    if pos>=len(data):
+        return None
+    first = data[pos]
+    if first==0:
+        raise ValueError("invalid EBML vint")
+    n = 1
+    while not (first & (0x80>>(n-1))):
+        n += 1
+    if pos+n>len(data):
+        return None
+    value = first if keep_marker else first & (0xFF>>n)
+    for b in data[pos+1:pos+n]:
+        value = (value<<8) | b
+    if not keep_marker and value==(1<<(7*n))-1:
+        value = -1
+    return value, pos+n
+
+def sniff_ebml( data:bytes ) ->AudioFormat|None:
+    doctype = 'matroska'
+    pos = 0
+    end = len(data)
+    while pos<end:
+        r = _ebml_vint(data,pos,True)
+        if r is None:
+            return None
+        eid,pos = r
+        r = _ebml_vint(data,pos,False)
+        if r is None:
+            return None
+        size,pos = r
+        if eid==_EBML_CLUSTER:
+            break # トラック情報はクラスタより前にある
+        if eid in _EBML_MASTERS:
+            continue # 子要素に入る
+        if size<0 or pos+size>end:
+            return None
+        if eid==_EBML_DOCTYPE:
+            doctype = data[pos:pos+size].decode('ascii','replace').rstrip('\x00')
+        elif eid==_EBML_CODEC_ID:
+            codec_id = data[pos:pos+size].decode('ascii','replace').rstrip('\x00')
+            if codec_id.startswith('V_'):
+                pos += size
+                continue # 映像トラックは見ない
+            codec = _MKV_CODECS.get(codec_id, 'aac' if codec_id.startswith('A_AAC') else codec_id)
+            return _verdict(doctype,codec)
+        pos += size
+    return None
+
+#--------------------
+# MP4 (ISO BMFF)
+#--------------------
+_MP4_CONTAINERS = { b'moov', b'trak', b'mdia', b'minf', b'stbl' }
+_MP4_CODECS:dict[bytes,str] = {
+    b'Opus': 'opus', b'mp4a': 'aac', b'fLaC': 'flac', b'.mp3': 'mp3',
+    b'lpcm': 'pcm', b'sowt': 'pcm', b'twos': 'pcm', b'ulaw': 'mulaw', b'alaw': 'alaw',
+}
+
+def sniff_mp4( data:bytes ) ->AudioFormat|None:
+    pos = 0
+    end = len(data)
+    while pos+8<=end:
+        size, typ = struct.unpack_from('>I4s',data,pos)
+        hdr = 8
+        if size==1:
+            if pos+16>end:
+                return None
+            size = struct.unpack_from('>Q',data,pos+8)[0]
+            hdr = 16
+        elif size==0:
+            size = end-pos
+        if size<hdr:
+            raise ValueError(f"invalid mp4 box size {size}")
+        if typ in _MP4_CONTAINERS:
+            pos += hdr # 子ボックスに入る
+            continue
+        if typ==b'stsd':
+            # version/flags(4), entry_count(4), 最初のエントリの size(4) と format(4)
+            if pos+hdr+16>end:
+                return None
+            fmt = data[pos+hdr+12:pos+hdr+16]
+            if fmt in (b'avc1',b'hvc1',b'vp09',b'av01'):
+                pos += size
+                continue # 映像トラックは見ない
+            return _verdict('mp4', _MP4_CODECS.get(fmt, fmt.decode('ascii','replace')))
+        if typ in (b'moof',b'mdat'):
+            break # サンプル記述はこれより前にある
+        pos += size
+    return None
+
+#--------------------
+# Ogg
+#--------------------
+_OGG_CODECS:list[tuple[bytes,str]] = [
+    (b'OpusHead','opus'), (b'\x01vorbis','vorbis'), (b'\x7fFLAC','flac'), (b'Speex   ','speex'),
+]
+
+def sniff_ogg( data:bytes ) ->AudioFormat|None:
+    # ページヘッダ27バイト + セグメントテーブル の後に最初のパケット
+    if len(data)<27:
+        return None
+    nseg = data[26]
+    pos = 27+nseg
+    if len(data)<pos+8:
+        return None
+    for magic,codec in _OGG_CODECS:
+        if data[pos:pos+len(magic)]==magic:
+            return _verdict('ogg',codec)
+    return _verdict('ogg',data[pos:pos+8].decode('ascii','replace'))
+
+#--------------------
+# WAV
+#--------------------
+_WAV_CODECS:dict[int,str] = { 1: 'pcm', 3: 'pcm', 6: 'alaw', 7: 'mulaw', 0x55: 'mp3' }
+
+def sniff_wav( data:bytes ) ->AudioFormat|None:
+    pos = 12
+    while pos+8<=len(data):
+        cid, size = struct.unpack_from('<4sI',data,pos)
+        if cid==b'fmt ':
+            if pos+8+16>len(data):
+                return None
+            tag, ch, rate, _, _, bits = struct.unpack_from('<HHIIHH',data,pos+8)
+            if tag==0xFFFE and size>=40 and pos+8+26<=len(data):
+                tag = struct.unpack_from('<H',data,pos+8+24)[0] # WAVE_FORMAT_EXTENSIBLEのサブフォーマット
+            codec = _WAV_CODECS.get(tag, f"0x{tag:04x}")
+            fmt = _verdict('wav',codec)
+            if fmt.error=='' and (ch==0 or rate==0):
+                return AudioFormat('wav',codec,f"invalid wav format ch:{ch} rate:{rate}")
+            return fmt
+        pos += 8 + size + (size&1)
+    return None
+
+def sniff_audio( data:bytes ) ->AudioFormat|None:
+    """
+    先頭のヘッダからコンテナとコーデックを判定する
+    return: 判定できなければNone(ヘッダが無い、途中で切れている、知らない形式)
+    """
+    try:
+        if data[:4]==EBML_MAGIC:
+            return sniff_ebml(data)
+        if data[4:8]==b'ftyp':
+            return sniff_mp4(data)
+        if data[:4]==b'OggS':
+            return sniff_ogg(data)
+        if data[:4]==b'RIFF' and data[8:12]==b'WAVE':
+            return sniff_wav(data)
+    except (ValueError,struct.error) as ex:
+        return AudioFormat('','',f"broken audio header {str(ex)}")
+    return None
+
+# 途中から読み直せる位置(WebMのクラスタ、MP4のフラグメント、Oggのページ)の目印
+_RESYNC_MARKS:dict[str,tuple[bytes,int]] = {
+    'webm': (b'\x1f\x43\xb6\x75', 0),
+    'mp4': (b'moof', 4), # ボックスの先頭はサイズ(4バイト)から
+    'ogg': (b'OggS', 0),
+}
+
+def resync_offset( container:str, data:bytes|memoryview ) ->int:
+    """
+    チャンクが欠けた後に、デコーダが読み直せる位置を探す(それより前を送ると、欠けた前後が繋がって壊れたデータになる)
+    return: 位置。見つからなければ-1。目印の無い形式は0
+    """
+    mark = _RESYNC_MARKS.get(container)
+    if mark is None:
+        return 0
+    pos = bytes(data).find(mark[0])
+    if pos<mark[1]:
+        return -1
+    return pos-mark[1]
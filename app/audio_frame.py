@@ -0,0 +1,184 @@
+import struct
+import zlib
+from typing import NamedTuple
+
+from audio_format import resync_offset
+
+"""
+ブラウザから届く音声のフレーム(audio_frameイベントのバイナリ)
+    ヘッダ(24バイト, little endian) + 音声データ
+        magic   2s  b'AF'
+        version B   1
+        codec   B   CODEC_*
+        seq     I   audioStartからの通し番号(0から)
+        ts      d   キャプチャした時刻(クライアントの時計のミリ秒。差だけを使う)
+        length  I   音声データのバイト数
+        crc     I   音声データのCRC32
+"""
+
+MAGIC = b'AF'
+VERSION = 1
+HEADER = struct.Struct('<2sBBIdII')
+
+CODEC_PCM = 1  # 16kHz mono int16
+CODEC_WEBM = 2
+CODEC_MP4 = 3
+CODEC_OGG = 4
+CODEC_NAMES:dict[int,str] = { CODEC_PCM: 'pcm', CODEC_WEBM: 'webm', CODEC_MP4: 'mp4', CODEC_OGG: 'ogg' }
+
+class FrameError(ValueError):
+    pass
+
+class AudioFrame(NamedTuple):
+    seq:int
+    ts:float
+    codec:int
+    payload:memoryview
+
+def pack_frame( seq:int, ts:float, codec:int, payload:bytes ) ->bytes:
+    return HEADER.pack( MAGIC, VERSION, codec, seq & 0xFFFFFFFF, ts, len(payload), zlib.crc32(payload) ) + payload
+
+def parse_frame( data:bytes|memoryview ) ->AudioFrame:
+    """ヘッダを検査して音声データを取り出す(音声データはコピーしない)"""
+    mv = memoryview(data)
+    if len(mv)<HEADER.size:
+        raise FrameError(f"short audio frame {len(mv)}")
+    magic, version, codec, seq, ts, length, crc = HEADER.unpack_from(mv)
+    if magic!=MAGIC or version!=VERSION:
+        raise FrameError(f"invalid audio frame header {bytes(magic)!r} v{version}")
+    if codec not in CODEC_NAMES:
+        raise FrameError(f"unknown audio codec {codec}")
+    payload = mv[HEADER.size:]
+    if len(payload)!=length:
+        raise FrameError(f"audio frame length {len(payload)}!={length} seq:{seq}")
+    if zlib.crc32(payload)!=crc:
+        raise FrameError(f"audio frame crc error seq:{seq}")
+    return AudioFrame(seq,ts,codec,payload)
+
+class FrameOrder:
+    """
+    フレームを通し番号の順に並べ直し、欠けを検出する
+        - 先の番号が届いたら、最大window個まで欠けた番号を待つ(その間に届けば順に並べて返す)
+        - 待ちきれなければ欠けとして先へ進む(返すフレームに直前で欠けた数を付ける)
+        - 既に進んだ番号や重複は捨てる
+    """
+    def __init__(self, window:int=4):
+        self.window:int = window
+        self.next_seq:int = 0
+        self._held:dict[int,AudioFrame] = {}
+        self.received:int = 0
+        self.reordered:int = 0 # 順番が入れ替わって届き、並べ直したフレーム
+        self.lost:int = 0      # 待ちきれずに欠けとしたフレーム
+        self.dropped:int = 0   # 遅すぎるか重複で捨てたフレーム
+
+    def reset(self):
+        self.next_seq = 0
+        self._held = {}
+        self.received = self.reordered = self.lost = self.dropped = 0
+
+    def stats(self) ->dict:
+        return { 'received': self.received, 'reordered': self.reordered, 'lost': self.lost, 'dropped': self.dropped }
+
+    def push(self, frame:AudioFrame) ->list[tuple[AudioFrame,int]]:
+        """return: 順番に処理できるようになった (フレーム, 直前で欠けたフレームの数) のリスト"""
+        self.received += 1
+        if frame.seq<self.next_seq or frame.seq in self._held:
+            self.dropped += 1
+            return []
+        if frame.seq==self.next_seq and self._held:
+            self.reordered += 1 # 先に届いていたフレームの前が埋まった
+        self._held[frame.seq] = frame
+        return self._drain(self.window)
+
+    def flush(self) ->list[tuple[AudioFrame,int]]:
+        """入力の終わり。待っているフレームを欠けを飛ばして全て返す"""
+        return self._drain(0)
+
+    def _drain(self, window:int) ->list[tuple[AudioFrame,int]]:
+        out:list[tuple[AudioFrame,int]] = []
+        while self._held:
+            f = self._held.pop(self.next_seq,None)
+            if f is not None:
+                out.append( (f,0) )
+                self.next_seq += 1
+                continue
+            if len(self._held)<=window:
+                break
+            # 待ちきれないので、次に届いている番号まで飛ばす
+            seq = min(self._held)
+            f = self._held.pop(seq)
+            missing = seq-self.next_seq
+            self.lost += missing
+            out.append( (f,missing) )
+            self.next_seq = seq+1
+        return out
+
+class FrameStream:
+    """
+    届いたフレームを、whisperへ送る音声のチャンク (seq, 形式の名前, データ) の並びにする
+        - FrameOrderで通し番号の順に並べ直す
+        - PCMが欠けたら、欠けたフレームの数×前のフレームのサンプル数を無音で埋める(以後の時刻がずれない)
+          キャプチャの時刻は揺れるので、時刻の差(+1フレーム)とmax_fill_msは埋める長さの上限にだけ使う
+        - コンテナ(WebM等)が欠けたら、欠けた前後を繋ぐとffmpegの入力が壊れるので、読み直せる位置(クラスタ等)まで捨てる
+    """
+    def __init__(self, *, window:int=4, sample_rate:int=16000, max_fill_ms:float=2000.0):
+        self.order:FrameOrder = FrameOrder(window)
+        self.sample_rate:int = sample_rate
+        self.max_fill_ms:float = max_fill_ms
+        self._pcm_end:float|None = None # 前のPCMのフレームの終わりの時刻(ms)
+        self._pcm_samples:int = 0 # 前のPCMのフレームのサンプル数
+        self._resync:bool = False
+        self.filled_ms:float = 0.0 # 無音で埋めた長さ
+        self.skipped:int = 0       # 読み直せる位置を探すために捨てたバイト数
+
+    def reset(self):
+        self.order.reset()
+        self._pcm_end = None
+        self._pcm_samples = 0
+        self._resync = False
+        self.filled_ms = 0.0
+        self.skipped = 0
+
+    def stats(self) ->dict:
+        return { **self.order.stats(), 'filled_ms': round(self.filled_ms,1), 'skipped': self.skipped }
+
+    def push(self, frame:AudioFrame) ->tuple[list[tuple[int,str,bytes|memoryview]],int]:
+        """return: (送るチャンク, 欠けたフレームの数)"""
+        return self._chunks( self.order.push(frame) )
+
+    def flush(self) ->tuple[list[tuple[int,str,bytes|memoryview]],int]:
+        return self._chunks( self.order.flush() )
+
+    def _chunks(self, frames:list[tuple[AudioFrame,int]]) ->tuple[list[tuple[int,str,bytes|memoryview]],int]:
+        out:list[tuple[int,str,bytes|memoryview]] = []
+        lost:int = 0
+        for f,missing in frames:
+            lost += missing
+            payload = f.payload
+            if f.codec==CODEC_PCM:
+                if missing>0 and self._pcm_end is not None:
+                    n = missing*self._pcm_samples
+                    gap_ms = f.ts-self._pcm_end
+                    if gap_ms>=0:
+                        n = min( n, int( (gap_ms+self._pcm_samples*1000/self.sample_rate)*self.sample_rate/1000 ) )
+                    n = min( n, int(self.max_fill_ms*self.sample_rate/1000) )
+                    if n>0:
+                        self.filled_ms += n*1000/self.sample_rate
+                        out.append( (f.seq,'pcm',bytes(n*2)) )
+                self._pcm_samples = len(payload)//2
+                self._pcm_end = f.ts + self._pcm_samples*1000/self.sample_rate
+                out.append( (f.seq,'pcm',payload) )
+                continue
+            container = CODEC_NAMES[f.codec]
+            if missing>0:
+                self._resync = True
+            if self._resync:
+                pos = resync_offset(container, payload)
+                if pos<0:
+                    self.skipped += len(payload)
+                    continue
+                self.skipped += pos
+                payload = payload[pos:]
+                self._resync = False
+            out.append( (f.seq,container,payload) )
+        return out, lost
@@ -35,6 +35,9 @@ class Bot:
         config={ 'voicevox_speaker': 8 }
         self.tts:TtsEngine = TtsEngine(config=config)
         self.queue:Queue = Queue()
+        # 結果をasyncio側へ通知するためのキュー(start()を呼んだイベントループに紐付ける)
+        self._loop:asyncio.AbstractEventLoop|None = None
+        self._aqueue:asyncio.Queue|None = None
         self.th = None
         self.run = False
         self.global_messages:list[ChatCompletionMessageParam] = []
@@ -57,6 +60,12 @@ class Bot:
 
     def start(self):
         self.run=True
+        try:
+            self._loop = asyncio.get_running_loop()
+            self._aqueue = asyncio.Queue()
+        except RuntimeError:
+            self._loop = None
+            self._aqueue = None
         if self.th is None:
             self.th = Thread( target=self._th_loop, daemon=True)
             self.th.start()
@@ -71,6 +80,13 @@ class Bot:
             else:
                 self._temp_texts=[]
 
+    def _put(self, res:VoiceRes):
+        """スレッドから結果を渡す。イベントループがあればasyncioのキューへ通知する"""
+        if self._loop is not None and self._aqueue is not None:
+            self._loop.call_soon_threadsafe( self._aqueue.put_nowait, res )
+        else:
+            self.queue.put(res)
+
     def stop(self):
         self.run=False
         if self.th:
@@ -88,30 +104,30 @@ class Bot:
                     temp_text = ' '.join(self._temp_texts)
                     if (time.time()-last_time)>15.0 and (len(self._orig_texts)!=last_num or temp_text!=last_temp_text):
                         try:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
                             self.summarize_text()
                         finally:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
                         last_num = len(self._orig_texts)
                         last_time = time.time()
                 elif self.mode == Bot.MODE_TRANSLATION:
                     temp_text = ' '.join(self._temp_texts)
                     if (time.time()-last_time)>5.0 and (len(self._orig_texts)!=last_num or temp_text!=last_temp_text):
                         try:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
                             self.translate_text()
                         finally:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
                         last_num = len(self._orig_texts)
                         last_temp_text = temp_text
                         last_time = time.time()
                 elif self.mode == Bot.MODE_CONVERSATION:
                     if (time.time()-last_time)>1.0 and len(self._user_messages)>0:
                         try:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_ON,'a',b''))
                             self.response_text()
                         finally:
-                            self.queue.put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
+                            self._put(VoiceRes(VoiceRes.CMD_LLM_OFF,'a',b''))
                         last_num = len(self._orig_texts)
                         last_time = time.time()
                 else:
@@ -144,7 +160,7 @@ class Bot:
         )
         restext = response.choices[0].message.content or ""
         res = VoiceRes(VoiceRes.CMD_ALL,text=restext,voice=b'')
-        self.queue.put(res)
+        self._put(res)
 
     def summarize_text(self):
         """音声認識テキストを要約する"""
@@ -183,7 +199,7 @@ class Bot:
         
         restext = response.choices[0].message.content or ""
         res = VoiceRes(VoiceRes.CMD_ALL,text=restext,voice=b'')
-        self.queue.put(res)
+        self._put(res)
 
     def response_text(self):
         """音声認識で会話"""
@@ -210,7 +226,7 @@ class Bot:
             self.global_messages.append({"role": "user", "content":msg})
         self._user_messages = []
         self.global_messages.append({"role":"assistant","content":restext})
-        self.queue.put(res)
+        self._put(res)
 
     def text_to_voice(self,text):
         audio_data,model = self.tts._text_to_audio_by_voicevox(text,sampling_rate=SAMPLE_RATE)
@@ -218,14 +234,20 @@ class Bot:
             return audio_to_wave_bytes(audio_data, sampling_rate=SAMPLE_RATE, ch=1), model
         return b'',model
 
-    async def get(self, *, timeout:float=0.0) ->tuple[int,str,bytes]:
-        breaktime = time.time()+(timeout if timeout>0 else 3.0)
-        while time.time()<breaktime:
+    async def get(self, *, timeout:float=0.0) ->tuple[int,str,bytes]|None:
+        """結果が届くまで待つ。timeout秒で届かなければNone"""
+        wait_sec = timeout if timeout>0 else 3.0
+        if self._aqueue is None:
             try:
-                a = self.queue.get_nowait()
-                if isinstance(a,VoiceRes):
-                    return a.cmd, a.text, a.voice
+                a = await asyncio.to_thread( self.queue.get, True, wait_sec )
             except Empty:
-                pass
-            await asyncio.sleep(0.2)
+                return None
+        else:
+            try:
+                a = await asyncio.wait_for( self._aqueue.get(), wait_sec )
+            except asyncio.TimeoutError:
+                return None
+        if isinstance(a,VoiceRes):
+            return a.cmd, a.text, a.voice
+        return None
         return 0,'',b''
\ No newline at end of file
@@ -0,0 +1,79 @@
+import time
+import hashlib
+import asyncio
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+def normalize_text( text:str ) ->str:
+    """キャッシュのキーにするテキスト。全角半角(NFKC)と空白の違いは同じものとする"""
+    return ' '.join( unicodedata.normalize('NFKC',text).split() )
+
+def cache_key( mode:str, version:int|str, text:str ) ->str:
+    return hashlib.sha256( f"{mode}\0{version}\0{normalize_text(text)}".encode('utf-8') ).hexdigest()
+
+class ResultCache:
+    """
+    LLMの結果を、モード・プロンプトのバージョン・正規化したテキストのハッシュをキーに保持する(イベントループの中で使う)
+        - ttl_sec を過ぎたものと、max_entries を超えたら最後に使ったのが古いものから捨てる
+        - 同じキーの要求が処理中なら、LLMを呼ばずにその結果を待つ(coalesced)
+        - 失敗した結果は保持しない(待っていた要求には同じ例外を返す)
+    """
+    def __init__(self, *, max_entries:int=256, ttl_sec:float=600.0):
+        self.max_entries:int = max_entries
+        self.ttl_sec:float = ttl_sec
+        self._entries:OrderedDict[str,tuple[float,str]] = OrderedDict()
+        self._inflight:dict[str,asyncio.Task] = {}
+        self._counts:dict[str,int] = { 'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0, 'expired': 0, 'evicted': 0 }
+
+    def stats(self) ->dict:
+        lookups = self._counts['hits']+self._counts['misses']+self._counts['coalesced']
+        return { 'entries': len(self._entries), 'inflight': len(self._inflight), 'max_entries': self.max_entries, 'ttl_sec': self.ttl_sec,
+                 **self._counts, 'hit_rate': round( (self._counts['hits']+self._counts['coalesced'])/lookups, 3 ) if lookups else 0.0 }
+
+    def get(self, key:str) ->str|None:
+        ent = self._entries.get(key)
+        if ent is None:
+            return None
+        if time.time()-ent[0]>self.ttl_sec:
+            del self._entries[key]
+            self._counts['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return ent[1]
+
+    def put(self, key:str, value:str):
+        self._entries[key] = (time.time(),value)
+        self._entries.move_to_end(key)
+        while len(self._entries)>self.max_entries:
+            self._entries.popitem(last=False)
+            self._counts['evicted'] += 1
+
+    async def get_or_run(self, key:str, fn:Callable[[],Awaitable[str]]) ->tuple[str,str]:
+        """return: (結果, hit|miss|coalesced)"""
+        value = self.get(key)
+        if value is not None:
+            self._counts['hits'] += 1
+            return value, 'hit'
+        task = self._inflight.get(key)
+        if task is not None:
+            self._counts['coalesced'] += 1
+            # 先に来た要求が切断されても、処理は止めない
+            return await asyncio.shield(task), 'coalesced'
+        self._counts['misses'] += 1
+        task = asyncio.get_running_loop().create_task( self._run(key,fn) )
+        # 待っている要求が全て切断されても、例外を回収しておく
+        task.add_done_callback( lambda t: t.cancelled() or t.exception() )
+        self._inflight[key] = task
+        return await asyncio.shield(task), 'miss'
+
+    async def _run(self, key:str, fn:Callable[[],Awaitable[str]]) ->str:
+        try:
+            value = await fn()
+            self.put(key,value)
+            return value
+        except Exception:
+            self._counts['errors'] += 1
+            raise
+        finally:
+            self._inflight.pop(key,None)
@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+
+"""
+負荷に応じてセッションのモデルを小さくする(WMの large → medium → small → base → tiny の段)
+段0はセッションで選んだモデルで、それより大きくはしない
+"""
+
+class SessionLoad:
+    def __init__(self):
+        self.level:int = 0
+        self.rtf:float|None = None  # デコード時間/デコードした音声の秒数 の指数移動平均
+        self.duty:float|None = None # デコード時間/前回のデコードからの経過時間 の指数移動平均
+        self.queue_sec:float = 0.0  # デコードが追いついていない音声の秒数
+        self.last_step:float = 0.0
+        self.changed:float = time.time()
+        # デコードした音声の秒数とかかった秒数の累計、1回でデコードした音声の最大の秒数
+        self.steps:int = 0
+        self.decoded_sec:float = 0.0
+        self.wall_sec:float = 0.0
+        self.max_decoded_sec:float = 0.0
+
+    def json(self) ->dict:
+        return { 'level': self.level, 'rtf': round(self.rtf or 0.0,3), 'duty': round(self.duty or 0.0,3), 'queue_sec': round(self.queue_sec,2),
+                 'steps': self.steps, 'decoded_sec': round(self.decoded_sec,2), 'wall_sec': round(self.wall_sec,3), 'max_decoded_sec': round(self.max_decoded_sec,2) }
+
+class ModelLoad:
+    """モデル毎のRTFの指数移動平均(共有の推論サービスが無いときの、受け付けの判断と容量の見積もりに使う)"""
+    def __init__(self):
+        self.rtf:float|None = None
+        self.steps:int = 0
+
+    def json(self) ->dict:
+        return { 'rtf': round(self.rtf or 0.0,4), 'steps': self.steps }
+
+class LoadController:
+    """
+    セッション毎のRTFと、同じプロセスの全セッションの推論の負荷(duty)の合計から、モデルの段を決める
+        rtf_high: セッションのRTFがこれを超えるか、未処理の音声がqueue_sec秒を超えたら1段下げる
+        rtf_low: RTFがこれを下回り、未処理の音声が無ければ1段戻す
+        host_high: 全セッションのdutyの合計(推論ワーカーが埋まっている割合の合計)がこれを超えたら下げる
+        host_low: 合計がこれを下回るまでは戻さない
+        hold_sec: 段を変えてから次に変えるまでの最短の秒数(モデルを切り替えた直後の揺れを無視する)
+    下げる閾値と戻す閾値を分け、さらにhold_secだけ待つことで、段が行ったり来たりしないようにする
+    """
+    def __init__(self, *, rtf_high:float=0.6, rtf_low:float=0.25, queue_sec:float=3.0, host_high:float=0.9, host_low:float=0.5,
+                 hold_sec:float=10.0, alpha:float=0.3, enabled:bool=True):
+        self.rtf_high:float = rtf_high
+        self.rtf_low:float = rtf_low
+        self.queue_sec:float = queue_sec
+        self.host_high:float = host_high
+        self.host_low:float = host_low
+        self.hold_sec:float = hold_sec
+        self.alpha:float = alpha
+        self.enabled:bool = enabled
+        self._sessions:dict[str,SessionLoad] = {}
+        self._models:dict[str,ModelLoad] = {}
+        self._lock:threading.Lock = threading.Lock()
+
+    def host_duty(self) ->float:
+        with self._lock:
+            return sum( s.duty or 0.0 for s in self._sessions.values() )
+
+    def stats(self) ->dict:
+        with self._lock:
+            return { 'host_duty': round( sum( s.duty or 0.0 for s in self._sessions.values() ), 3 ),
+                     'sessions': { k:s.json() for k,s in self._sessions.items() },
+                     'models': { k:m.json() for k,m in self._models.items() } }
+
+    def reset(self, session:str):
+        """セッションで選んだモデルが変わったら段0からやり直す(デコードの累計は引き継ぐ)"""
+        with self._lock:
+            prev = self._sessions.get(session)
+            s = self._sessions[session] = SessionLoad()
+            if prev is not None:
+                s.steps, s.decoded_sec, s.wall_sec, s.max_decoded_sec = prev.steps, prev.decoded_sec, prev.wall_sec, prev.max_decoded_sec
+
+    def remove(self, session:str):
+        with self._lock:
+            self._sessions.pop(session,None)
+
+    def update(self, session:str, trans_sec:float, audio_sec:float, queue_sec:float, levels:int, *, model:str='') ->int:
+        """デコードを1回終える毎に呼ぶ
+            trans_sec: デコードにかかった秒数
+            audio_sec: デコードした音声の秒数
+            queue_sec: デコードが追いついていない音声の秒数
+            levels: 段の数
+            model: デコードしたモデル(モデル毎の測定値に加える)
+            return: このセッションの段(0..levels-1)
+        """
+        now = time.time()
+        with self._lock:
+            s = self._sessions.get(session)
+            if s is None:
+                s = self._sessions[session] = SessionLoad()
+            rtf = trans_sec/audio_sec if audio_sec>0 else 0.0
+            s.rtf = rtf if s.rtf is None else s.rtf + self.alpha*(rtf-s.rtf)
+            if s.last_step>0 and now>s.last_step:
+                duty = min( 1.0, trans_sec/(now-s.last_step) )
+                s.duty = duty if s.duty is None else s.duty + self.alpha*(duty-s.duty)
+            if model and audio_sec>0:
+                m = self._models.get(model)
+                if m is None:
+                    m = self._models[model] = ModelLoad()
+                # 多くのセッションの値が混ざるので、セッションのものより緩やかに追う
+                a = max( self.alpha/4, 1.0/(m.steps+1) )
+                m.rtf = rtf if m.rtf is None else m.rtf + a*(rtf-m.rtf)
+                m.steps += 1
+            s.last_step = now
+            s.queue_sec = queue_sec
+            s.steps += 1
+            s.decoded_sec += audio_sec
+            s.wall_sec += trans_sec
+            s.max_decoded_sec = max( s.max_decoded_sec, audio_sec )
+            s.level = min( s.level, max(0,levels-1) )
+            if not self.enabled or now-s.changed<self.hold_sec:
+                return s.level
+            host = sum( x.duty or 0.0 for x in self._sessions.values() )
+            if s.level<levels-1 and ( s.rtf>self.rtf_high or queue_sec>self.queue_sec or host>self.host_high ):
+                s.level += 1
+            elif s.level>0 and s.rtf<self.rtf_low and queue_sec<0.5 and host<self.host_low:
+                s.level -= 1
+            else:
+                return s.level
+            # 新しいモデルで測り直す
+            s.changed = now
+            s.rtf = s.duty = None
+            return s.level
+
+_controller:LoadController|None = None
+
+def get_load_controller() ->LoadController:
+    """プロセスに1つのコントローラ。閾値は環境変数で設定する
+        ASR_LOAD_CONTROL=0で無効、ASR_RTF_HIGH, ASR_RTF_LOW, ASR_QUEUE_SEC, ASR_HOST_DUTY_HIGH, ASR_HOST_DUTY_LOW, ASR_LOAD_HOLD_SEC
+        ホストの閾値の既定は推論ワーカーの数(ASR_WORKERS)に比例する
+    """
+    global _controller
+    if _controller is None:
+        workers = max( 1, int(os.getenv('ASR_WORKERS','2')) )
+        _controller = LoadController(
+            rtf_high=float(os.getenv('ASR_RTF_HIGH','0.6')),
+            rtf_low=float(os.getenv('ASR_RTF_LOW','0.25')),
+            queue_sec=float(os.getenv('ASR_QUEUE_SEC','3.0')),
+            host_high=float(os.getenv('ASR_HOST_DUTY_HIGH',str(0.9*workers))),
+            host_low=float(os.getenv('ASR_HOST_DUTY_LOW',str(0.5*workers))),
+            hold_sec=float(os.getenv('ASR_LOAD_HOLD_SEC','10')),
+            enabled=os.getenv('ASR_LOAD_CONTROL','1')!='0',
+        )
+    return _controller
@@ -0,0 +1,180 @@
+import os
+import time
+import traceback
+import threading
+from threading import Thread
+from collections import OrderedDict
+from typing import Callable, Any
+
+from rec_util import sin_signal
+from asr_backend import split_model, NoBackendError
+
+class ModelEntry:
+    """ロード済みのモデルと、ロード・ウォームアップにかかった時間"""
+    def __init__(self, path:str, model:Any, nbytes:int, load_sec:float):
+        self.path:str = path
+        self.model:Any = model
+        self.nbytes:int = nbytes
+        self.load_sec:float = load_sec
+        self.warm_sec:float = 0.0
+        self.last_used:float = time.time()
+        self.inuse:int = 0 # 推論中(と推論を待っている)の数。0でなければ捨てない
+
+    def json(self) ->dict:
+        return { 'path': self.path, 'mb': round(self.nbytes/1048576,1), 'load_sec': round(self.load_sec,3), 'warm_sec': round(self.warm_sec,3) }
+
+class ModelRegistry:
+    """
+    whisperのモデルをモデルの文字列(WMの値、エンジンの接頭辞付き)毎に保持する
+    ロードと推論はasr_backendのエンジンが行い、ここではロード済みのモデルを持って推論に渡す
+        budget_mb: ロードしたモデルの合計サイズの上限。超えたら最後に使ったのが古いものから捨てる
+                   推論に使っているモデルは捨てず、使い終わった時に捨て直す(その間は上限を超えることがある)
+        warmup: ロード後にサイン波を1回デコードして、初回の推論のコンパイル等を済ませておく
+        on_change: ロード済みのモデルが変わったときに呼ぶ(引数はjson()のリスト)
+    prefetch()はバックグラウンドでロードし、推論はその間も前のモデルで続けられる
+    モデルの差し替え(mlxならModelHolder)とウォームアップは推論と同じロックで行うので、デコードの合間にしか起きない
+    """
+    def __init__(self, *, budget_mb:float=3072, warmup:bool=True, on_change:Callable[[list[dict]],None]|None=None):
+        self.budget:int = int(budget_mb*1048576)
+        self.warmup:bool = warmup
+        self.on_change:Callable[[list[dict]],None]|None = on_change
+        self._models:OrderedDict[str,ModelEntry] = OrderedDict()
+        self._loading:dict[str,threading.Event] = {}
+        self._errors:dict[str,str] = {}
+        self._lock:threading.Lock = threading.Lock()      # _modelsの更新
+        self._run_lock:threading.RLock = threading.RLock() # 推論とModelHolderの差し替え
+
+    def stats(self) ->list[dict]:
+        with self._lock:
+            return [ e.json() for e in self._models.values() ]
+
+    def ready(self, path:str) ->bool:
+        """ロードとウォームアップが済んでいて、すぐに推論できるか(エンジンが使えなければ待っても無駄なのでTrue)"""
+        if not split_model(path)[0].available():
+            return True
+        with self._lock:
+            return path in self._models
+
+    def error(self, path:str) ->str|None:
+        return self._errors.get(path)
+
+    def preload(self, paths:list[str]):
+        """起動時にまとめてロードする(終わるまで戻らない)"""
+        for path in paths:
+            try:
+                self.get(path)
+            except Exception as ex:
+                traceback.print_exc()
+
+    def prefetch(self, path:str):
+        """バックグラウンドでロードを始める"""
+        with self._lock:
+            if not split_model(path)[0].available() or path in self._models or path in self._loading:
+                return
+        Thread( target=self._th_prefetch, args=(path,), name='model_prefetch', daemon=True ).start()
+
+    def _th_prefetch(self, path:str):
+        try:
+            self.get(path)
+        except Exception as ex:
+            traceback.print_exc()
+
+    def get(self, path:str) ->ModelEntry|None:
+        """モデルを返す。無ければロードしてウォームアップする"""
+        backend, backend_path = split_model(path)
+        if not backend.available():
+            return None
+        while True:
+            with self._lock:
+                entry = self._models.get(path)
+                if entry is not None:
+                    self._models.move_to_end(path)
+                    return entry
+                loading = self._loading.get(path)
+                if loading is None:
+                    loading = self._loading[path] = threading.Event()
+                    break
+            # 他のスレッドがロード中なら終わるのを待つ
+            loading.wait()
+            if path in self._errors:
+                raise RuntimeError(f"can not load {path}: {self._errors[path]}")
+        try:
+            t0 = time.time()
+            model, nbytes = backend.load(backend_path)
+            entry = ModelEntry( path, model, nbytes, time.time()-t0 )
+            if self.warmup:
+                t0 = time.time()
+                with self._run_lock:
+                    backend.transcribe( model, backend_path, sin_signal(duration=1.0), lang=None, prompt=None )
+                entry.warm_sec = time.time()-t0
+            print(f"[ModelRegistry] loaded {path} {nbytes/1048576:.1f}MB load:{entry.load_sec:.3f}sec warm:{entry.warm_sec:.3f}sec")
+            with self._lock:
+                self._models[path] = entry
+                self._errors.pop(path,None)
+                self._evict(keep=path)
+        except Exception as ex:
+            self._errors[path] = str(ex)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(path,None)
+            loading.set()
+        self.notify()
+        return entry
+
+    def _evict(self, keep:str|None=None):
+        """予算を超えていたら、使われていないモデルを古い順に捨てる(_lockを持って呼ぶ)"""
+        total = sum( e.nbytes for e in self._models.values() )
+        for path in list(self._models.keys()):
+            if total<=self.budget:
+                break
+            if path==keep or self._models[path].inuse>0:
+                continue
+            entry = self._models.pop(path)
+            total -= entry.nbytes
+            split_model(path)[0].unload(entry.model)
+            print(f"[ModelRegistry] evict {path} {entry.nbytes/1048576:.1f}MB")
+
+    def notify(self):
+        """on_changeを呼ぶ"""
+        if self.on_change is not None:
+            try:
+                self.on_change( self.stats() )
+            except Exception as ex:
+                traceback.print_exc()
+
+    def transcribe(self, path:str, audio, *, lang:str|None, prompt:str|None) ->list[dict]:
+        """pathのモデルで推論する。エンジンが使えなければNoBackendError(無音と区別が付かないので[]は返さない)"""
+        backend, backend_path = split_model(path)
+        while True:
+            entry = self.get(path) # ロード中のウォームアップが_run_lockを使うので、ロックの外でロードする
+            if entry is None:
+                raise NoBackendError(f"{backend.name} engine is not installed for {path}")
+            with self._lock:
+                # getの後に捨てられていたら、ロードし直す
+                if self._models.get(path) is entry:
+                    entry.inuse += 1
+                    break
+        try:
+            with self._run_lock:
+                entry.last_used = time.time()
+                return backend.transcribe( entry.model, backend_path, audio, lang=lang, prompt=prompt )
+        finally:
+            with self._lock:
+                entry.inuse -= 1
+                # 使っている間に予算を超えていたら、今捨てる
+                n = len(self._models)
+                if entry.inuse==0:
+                    self._evict()
+                changed = len(self._models)!=n
+            if changed:
+                self.notify()
+
+_registry:ModelRegistry|None = None
+
+def get_registry() ->ModelRegistry:
+    """プロセスに1つのレジストリ"""
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry( budget_mb=float(os.getenv('ASR_MODEL_MEMORY_MB','3072')) )
+    return _registry
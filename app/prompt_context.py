@@ -0,0 +1,82 @@
+import re
+from typing import Any, Protocol
+
+"""
+デコードに渡すprompt(直前の文脈)を作る
+確定したテキストの末尾を、whisperのトークン数で上限(budget)までに切り詰めて保持する
+トークン化した結果はテキスト毎に保持しておき、デコードの度にトークン化し直さない
+"""
+
+class Tokenizer(Protocol):
+    def encode(self, text:str) ->list[Any]: ...
+    def decode(self, tokens:list[Any]) ->str: ...
+
+class SimpleTokenizer:
+    """
+    whisperのトークナイザが使えないときの近似
+    英数字の並びと記号を1トークン、空白の無い言語は1文字を1トークンとする(トークンは空白を含む文字列そのもの)
+    """
+    _RE = re.compile( r'\s*(?:[a-zA-Z0-9_]+|\S)' )
+
+    def encode(self, text:str) ->list[Any]:
+        return self._RE.findall(text)
+
+    def decode(self, tokens:list[Any]) ->str:
+        return ''.join(tokens)
+
+class PromptContext:
+    """
+    セッション毎のpromptの文脈
+        budget: promptのトークン数の上限(whisperは223トークンまで)
+    commit()で確定したテキストを追加し、prompt()で末尾のbudgetトークン分のテキストを返す
+    """
+    def __init__(self, tokenizer:Tokenizer|None=None, budget:int=128):
+        self.tokenizer:Tokenizer = tokenizer if tokenizer is not None else SimpleTokenizer()
+        self.budget:int = max(0,budget)
+        self._texts:list[tuple[str,list[Any]]] = [] # (テキスト,トークン)
+        self._total:int = 0
+        self._prompt:tuple[str|None,int]|None = None # prompt()のキャッシュ
+        self.encoded:int = 0 # トークン化した回数
+
+    def _encode(self, text:str) ->list[Any]:
+        self.encoded += 1
+        return list(self.tokenizer.encode(' '+text))
+
+    def set_tokenizer(self, tokenizer:Tokenizer|None):
+        """モデルが変わったら、保持しているテキストを新しいトークナイザでトークン化し直す"""
+        self.tokenizer = tokenizer if tokenizer is not None else SimpleTokenizer()
+        self._texts = [ (text,self._encode(text)) for text,_ in self._texts ]
+        self._total = sum( len(t) for _,t in self._texts )
+        self._trim()
+
+    def reset(self):
+        self._texts = []
+        self._total = 0
+        self._prompt = None
+
+    def commit(self, text:str):
+        """確定したテキストを追加する"""
+        text = text.strip() if text else ''
+        if not text or self.budget==0:
+            return
+        tokens = self._encode(text)
+        self._texts.append( (text,tokens) )
+        self._total += len(tokens)
+        self._trim()
+
+    def _trim(self):
+        # 先頭のテキストを除いても上限に足りるなら捨てる
+        while len(self._texts)>1 and self._total-len(self._texts[0][1])>=self.budget:
+            self._total -= len(self._texts.pop(0)[1])
+        self._prompt = None
+
+    def prompt(self) ->tuple[str|None,int]:
+        """return: (promptのテキスト, トークン数)。文脈が無ければ(None,0)"""
+        if self._prompt is None:
+            tokens = [ tk for _,t in self._texts for tk in t ]
+            if len(tokens)>self.budget:
+                tokens = tokens[len(tokens)-self.budget:]
+            # 途中で切ったトークンはバイト列の途中から始まることがある
+            text = self.tokenizer.decode(tokens).lstrip('�').strip() if tokens else ''
+            self._prompt = (text,len(tokens)) if text else (None,0)
+        return self._prompt
@@ -166,6 +166,156 @@ def signal_ave( signal:AudioF32 ) ->float:
     else:
         return 0.0
 
+def signal_ave_frames( signal:AudioF32, frame:int ) ->AudioF32:
+    """signal_aveをframeサンプル毎にまとめて計算する(端数のサンプルは使わない)"""
+    if not isinstance(signal, np.ndarray) or signal.dtype != np.float32 or len(signal.shape)!=1:
+        raise TypeError("Invalid signal")
+    n:int = len(signal)//frame
+    a = np.abs( signal[:n*frame] ).reshape(n,frame)
+    mask = a >= 0.001
+    cnt = np.count_nonzero(mask,axis=1)
+    total = np.sum( a, axis=1, where=mask, dtype=np.float32 )
+    return np.divide( total, cnt, out=np.zeros(n,dtype=np.float32), where=cnt>0 )
+
+def zero_cross_rate( signal:AudioF32, frame:int ) ->AudioF32:
+    """frameサンプル毎のゼロ交差率(0.0〜1.0)"""
+    n:int = len(signal)//frame
+    sign = np.signbit( signal[:n*frame].reshape(n,frame) )
+    return ( np.count_nonzero( sign[:,1:]!=sign[:,:-1], axis=1 ) / frame ).astype(np.float32)
+
+class EnergyVad:
+    """
+    振幅とゼロ交差率による簡易な発話検出
+    フレーム(frame_sec)毎に、レベル(signal_ave)がノイズフロアのratio倍かつmin_level以上で、
+    ゼロ交差率がzcr_max以下(ホワイトノイズは0.5付近)なら発話とする。十分大きな音はゼロ交差率に関係なく発話とする
+    発話の後hang_secは発話が続いているとみなす
+    ノイズフロアは発話でないフレームのレベルから追従する
+    """
+    def __init__(self, *, sample_rate:int=16000, frame_sec:float=0.02, min_level:float=0.005, ratio:float=3.0, zcr_max:float=0.35, hang_sec:float=0.3):
+        self.frame:int = max(1,int(sample_rate*frame_sec))
+        self.min_level:float = min_level
+        self.ratio:float = ratio
+        self.zcr_max:float = zcr_max
+        self.hang:int = int(hang_sec/frame_sec)
+        self.floor:float = min_level/ratio
+        self._rest:AudioF32 = EmptyF32
+        self._hang_left:int = 0
+
+    def reset(self):
+        self.floor = self.min_level/self.ratio
+        self._rest = EmptyF32
+        self._hang_left = 0
+
+    def speech_frames( self, audio:AudioF32 ) ->NDArray[np.bool_]:
+        """フレーム毎の判定(ハングオーバー無し)。ノイズフロアを更新する"""
+        level = signal_ave_frames( audio, self.frame )
+        zcr = zero_cross_rate( audio, self.frame )
+        thr = max( self.min_level, self.floor*self.ratio )
+        speech = (level>=thr) & ( (zcr<=self.zcr_max) | (level>=thr*4) )
+        if not speech.all():
+            noise = float(np.median( level[~speech] ))
+            self.floor = self.floor*0.9 + noise*0.1
+        return speech
+
+    def process( self, audio:AudioF32 ) ->int:
+        """
+        ブロックを判定して、ブロック内で発話が続いている最後の位置(サンプル数)を返す。発話が無ければ-1
+        フレームに満たない端数は次のブロックに回す
+        """
+        rest = len(self._rest)
+        data = np.concatenate( (self._rest,audio) ) if rest>0 else audio
+        n:int = len(data)//self.frame
+        self._rest = data[n*self.frame:].copy()
+        if n==0:
+            return -1
+        speech = self.speech_frames( data[:n*self.frame] )
+        idx = np.flatnonzero(speech)
+        if len(idx)>0:
+            end = int(idx[-1])+1+self.hang
+            self._hang_left = max(0,end-n)
+            end = min(n,end)
+        elif self._hang_left>0:
+            end = min(n,self._hang_left)
+            self._hang_left -= end
+        else:
+            return -1
+        return max( 0, min( len(audio), end*self.frame-rest ) )
+
+class AudioRingBuffer:
+    """
+    int16のPCMを読み込んでfloat32で保持するリングバッファ(確保は最初の1回だけ)
+        - readinto()で読み込み元から作業用のint16配列へ直接読み込み、out=指定でfloat32に変換してリングに書く
+        - リングは2倍の長さで確保し、後半に前半の複製を持つ(ミラー)ので、view()はいつも連続した配列のビューを返す
+        - 先頭を捨てる(drop)のは位置を進めるだけで、メモリは移動しない
+    位置は最初からの通しのサンプル数(head: 保持している先頭、head+len: 末尾)
+    """
+    def __init__(self, capacity:int, *, chunk:int=3200):
+        self.capacity:int = capacity
+        self._data:AudioF32 = np.zeros( capacity*2, dtype=np.float32 )
+        self._stage:AudioI16 = np.zeros( chunk, dtype=np.int16 )
+        self._stage_mv:memoryview = memoryview(self._stage).cast('B')
+        self._scale:np.float32 = np.float32(1.0/32768.0)
+        self._head:int = 0
+        self._tail:int = 0
+
+    def __len__(self) ->int:
+        return self._tail-self._head
+
+    @property
+    def head(self) ->int:
+        return self._head
+
+    def space(self) ->int:
+        return self.capacity-(self._tail-self._head)
+
+    def _put(self, pcm:AudioI16):
+        """int16をfloat32に変換して末尾に書く(ミラーにも書く)"""
+        n = len(pcm)
+        p = self._tail % self.capacity
+        first = min(n, self.capacity-p)
+        for src,q in ( (pcm[:first],p), (pcm[first:],0) ):
+            if len(src)==0:
+                continue
+            # 型変換のコピーと、その場での割り算(ufuncに型変換をさせると作業用のバッファを確保する)
+            dst = self._data[q:q+len(src)]
+            np.copyto( dst, src, casting='unsafe' )
+            np.multiply( dst, self._scale, out=dst )
+            np.copyto( self._data[q+self.capacity:q+self.capacity+len(src)], dst )
+        self._tail += n
+
+    def readinto(self, reader, max_samples:int) ->memoryview:
+        """reader.readinto()で最大max_samples(とchunk)まで読み込んで末尾に追加する
+            return: 読み込んだint16のバイト列(作業用配列のビューなので、次の読み込みまでに使う)。読めなければ空
+        """
+        n = min( max_samples, self.space(), len(self._stage) )
+        if n<=0:
+            return self._stage_mv[:0]
+        nbytes = reader.readinto( self._stage_mv[:n*2] ) or 0
+        k = nbytes//2
+        if k>0:
+            self._put( self._stage[:k] )
+        return self._stage_mv[:k*2]
+
+    def write(self, pcm:bytes|memoryview) ->int:
+        """int16のPCMを末尾に追加する。return: 追加したサンプル数(空きが無い分は捨てる)"""
+        src = np.frombuffer( pcm, dtype=np.int16 )
+        n = min( len(src), self.space() )
+        if n>0:
+            self._put( src[:n] )
+        return n
+
+    def view(self, start:int=0, end:int|None=None) ->AudioF32:
+        """先頭からの相対位置[start,end)の連続したビュー(コピーしない。dropや書き込みで内容が変わる)"""
+        size = self._tail-self._head
+        end = size if end is None else min(end,size)
+        start = max(0,min(start,end))
+        p = (self._head+start) % self.capacity
+        return self._data[p:p+(end-start)]
+
+    def drop(self, n:int):
+        """先頭からnサンプル捨てる"""
+        self._head += max( 0, min(n, self._tail-self._head) )
+
 def sin_signal( *, freq:int=220, duration:float=3.0, vol:float=0.5,sample_rate:int=16000, chunk:int|None=None) ->AudioF32:
     #frequency # 生成する音声の周波数 100Hz
     chunk_len:int = chunk if isinstance(chunk,int) and chunk>0 else int(sample_rate*0.2)
@@ -0,0 +1,117 @@
+import os
+import struct
+import traceback
+from bisect import bisect_left, bisect_right
+from threading import Thread
+from queue import Queue
+
+SAMPLE_RATE=16000
+BYTES_PER_SAMPLE=2
+
+# 索引のレコード: seq(uint32), 開始サンプル(uint64), 終了サンプル(uint64)
+INDEX_RECORD = struct.Struct('<IQQ')
+
+AUDIO_FILE='audio.pcm'
+INDEX_FILE='index.bin'
+
+class RecordingSink:
+    """
+    セッションの音声(16kHz mono int16 PCM)を1つのファイルに追記して、
+    確定したセグメントの位置を固定長の索引に記録する
+    ファイルへの書き込みは専用スレッドで行うので、デコードループはキューに入れるだけ
+    既存の録音があれば、その後ろに追記する(サンプル位置はファイル先頭からの通し番号)
+    """
+    def __init__(self, path:str):
+        self.path:str = path
+        self._queue:Queue = Queue()
+        self._thread:Thread|None = None
+        self._samples:int = 0
+
+    def start(self):
+        os.makedirs(self.path,exist_ok=True)
+        audio_file = os.path.join(self.path,AUDIO_FILE)
+        self._samples = os.path.getsize(audio_file)//BYTES_PER_SAMPLE if os.path.exists(audio_file) else 0
+        self._thread = Thread( target=self._th_write, name='recording', daemon=True )
+        self._thread.start()
+
+    @property
+    def base_sample(self) ->int:
+        """start()した時点の録音済みサンプル数(今回の録音の先頭位置)"""
+        return self._samples
+
+    def write(self, pcm:bytes):
+        """int16のPCMを追記する"""
+        self._queue.put( pcm )
+
+    def mark(self, seq:int, start:int, end:int):
+        """確定セグメントの位置を記録する。start,endは今回の録音の先頭からのサンプル数"""
+        self._queue.put( (seq, self._samples+max(0,start), self._samples+max(0,end)) )
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put( None )
+            self._thread.join(2.0)
+            self._thread = None
+
+    def _th_write(self):
+        try:
+            with open( os.path.join(self.path,AUDIO_FILE), 'ab') as af, open( os.path.join(self.path,INDEX_FILE), 'ab') as xf:
+                while True:
+                    data = self._queue.get()
+                    if data is None:
+                        break
+                    if isinstance(data,bytes):
+                        af.write(data)
+                    else:
+                        xf.write( INDEX_RECORD.pack(*data) )
+                        # 索引を引く前に音声が読めるようにする
+                        af.flush()
+                        xf.flush()
+        except Exception as ex:
+            traceback.print_exc()
+
+class RecordingReader:
+    """RecordingSinkの録音を、セグメント番号や時刻で直接読み出す"""
+    def __init__(self, path:str):
+        self.path:str = path
+        self._seqs:list[int] = []
+        self._starts:list[int] = []
+        self._ends:list[int] = []
+        self.reload()
+
+    def reload(self):
+        """索引を読み直す(レコードは固定長なので、追記中でも完全なレコードだけ読む)"""
+        self._seqs, self._starts, self._ends = [], [], []
+        index_file = os.path.join(self.path,INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file,'rb') as f:
+                data = f.read()
+            n = len(data)//INDEX_RECORD.size
+            for seq,start,end in INDEX_RECORD.iter_unpack( data[:n*INDEX_RECORD.size] ):
+                self._seqs.append(seq)
+                self._starts.append(start)
+                self._ends.append(end)
+
+    def segments(self) ->list[tuple[int,float,float]]:
+        """(seq, 開始秒, 終了秒)の一覧"""
+        return [ (q, s/SAMPLE_RATE, e/SAMPLE_RATE) for q,s,e in zip(self._seqs,self._starts,self._ends) ]
+
+    def find(self, sec:float) ->int|None:
+        """指定した時刻を含む(無ければ直前の)セグメントのseq"""
+        i = bisect_right( self._starts, int(sec*SAMPLE_RATE) )-1
+        return self._seqs[i] if i>=0 else None
+
+    def read(self, start_sec:float, end_sec:float) ->bytes:
+        """時刻を指定してPCMを読む(ファイル全体は読まない)"""
+        start = max(0,int(start_sec*SAMPLE_RATE))
+        end = max(start,int(end_sec*SAMPLE_RATE))
+        with open( os.path.join(self.path,AUDIO_FILE), 'rb') as f:
+            f.seek( start*BYTES_PER_SAMPLE )
+            return f.read( (end-start)*BYTES_PER_SAMPLE )
+
+    def segment_audio(self, seq:int) ->bytes:
+        """セグメントのPCMを読む"""
+        i = bisect_left( self._seqs, seq )
+        if i>=len(self._seqs) or self._seqs[i]!=seq:
+            return b''
+        return self.read( self._starts[i]/SAMPLE_RATE, self._ends[i]/SAMPLE_RATE )
@@ -0,0 +1,272 @@
+import os
+import time
+import struct
+import threading
+import numpy as np
+from multiprocessing import Event, Lock
+from multiprocessing.shared_memory import SharedMemory
+
+_LEN = struct.Struct('<I')
+
+class ShmRing:
+    """
+    multiprocessing.shared_memory上の、単一producer/単一consumer用のリングバッファ
+    書き込み位置はproducerだけが、読み出し位置はconsumerだけが更新する
+    位置の更新と参照は短いロック(共有メモリならmultiprocessingのセマフォ)を通す。データのコピーはロックの外で行い、
+    ロックの取得と解放がメモリバリアになるので、順序の弱いCPU(arm64など)の別プロセスでも、データより先に位置が見えることはない
+    データは 長さ(uint32)+payload のレコード単位でやり取りし、長さ0のレコードはEOFとして使う
+      - 空きが足りない場合、put()はtimeoutまで待ち(バックプレッシャ)、それでも空かなければ
+        レコードを捨ててFalseを返す(オーバーラン)。捨てた回数はoverrunsで参照できる
+      - get()はデータが届くまでイベントで待つ
+    Processの引数として渡せる(子プロセスでは同じ共有メモリに接続する)
+    shared=Falseなら同じプロセスのスレッド間で使う(共有メモリを使わず、/dev/shmを消費しない。Processには渡せない)
+    request_stop()はproducer以外からも呼べる。consumerは未読のレコードを読み終えたらget()でNoneを受け取り、stoppedで止める
+    """
+    HEADER_SIZE = 64 # write位置(uint64), read位置(uint64), オーバーラン回数(uint64), 停止の要求(uint64)
+
+    def __init__(self, capacity:int=4*1024*1024, *, shared:bool=True):
+        self.capacity:int = capacity
+        self._shm:SharedMemory|None = SharedMemory( create=True, size=ShmRing.HEADER_SIZE+capacity ) if shared else None
+        self._owner_pid:int = os.getpid()
+        self._data_ev = Event() if shared else threading.Event()  # consumerを起こす
+        self._space_ev = Event() if shared else threading.Event() # producerを起こす
+        self._idx_lock = Lock() if shared else threading.Lock()   # 位置の公開と参照
+        self._map()
+        self._hdr[0] = 0
+        self._hdr[1] = 0
+        self._hdr[2] = 0
+        self._hdr[3] = 0
+
+    def _map(self):
+        buf = self._shm.buf if self._shm is not None else memoryview( bytearray(ShmRing.HEADER_SIZE+self.capacity) )
+        assert buf is not None
+        self._hdr_raw = buf[:32]
+        self._hdr = self._hdr_raw.cast('Q')
+        self._data = buf[ShmRing.HEADER_SIZE:ShmRing.HEADER_SIZE+self.capacity]
+
+    def __getstate__(self):
+        if self._shm is None:
+            raise TypeError("ShmRing(shared=False) cannot be passed to another process")
+        return { 'name': self._shm.name, 'capacity': self.capacity, 'data_ev': self._data_ev, 'space_ev': self._space_ev, 'idx_lock': self._idx_lock }
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self._shm = SharedMemory( name=state['name'] )
+        self._owner_pid = -1
+        self._data_ev = state['data_ev']
+        self._space_ev = state['space_ev']
+        self._idx_lock = state['idx_lock']
+        self._map()
+
+    @property
+    def name(self) ->str:
+        return self._shm.name if self._shm is not None else ''
+
+    @property
+    def overruns(self) ->int:
+        return self._hdr[2]
+
+    @property
+    def stopped(self) ->bool:
+        """request_stop()されたか"""
+        with self._idx_lock:
+            return self._hdr[3]!=0
+
+    def used(self) ->int:
+        """未読のバイト数"""
+        with self._idx_lock:
+            return self._hdr[0]-self._hdr[1]
+
+    def reset(self):
+        """未読のデータを捨てる(consumerが居ないときだけ呼ぶ)"""
+        with self._idx_lock:
+            self._hdr[1] = self._hdr[0]
+            self._hdr[3] = 0
+        self._data_ev.clear()
+        self._space_ev.set()
+
+    def _write(self, pos:int, data) ->None:
+        p = pos % self.capacity
+        n = len(data)
+        first = min(n, self.capacity-p)
+        self._data[p:p+first] = data[:first]
+        if first<n:
+            self._data[0:n-first] = data[first:]
+
+    def _read(self, pos:int, n:int) ->bytes:
+        p = pos % self.capacity
+        first = min(n, self.capacity-p)
+        if first==n:
+            return bytes(self._data[p:p+n])
+        return bytes(self._data[p:p+first]) + bytes(self._data[0:n-first])
+
+    def put(self, data:bytes, *, timeout:float|None=0.0) ->bool:
+        """レコードを1つ書き込む(producer側)。timeout=Noneなら空くまで待つ"""
+        need = _LEN.size + len(data)
+        if need>self.capacity:
+            raise ValueError(f"record too large {len(data)}")
+        deadline = None if timeout is None else time.monotonic()+timeout
+        while self.capacity-self.used() < need:
+            self._space_ev.clear()
+            if self.capacity-self.used() >= need:
+                break
+            remain = None if deadline is None else deadline-time.monotonic()
+            if remain is not None and remain<=0:
+                self._hdr[2] += 1
+                return False
+            self._space_ev.wait(remain)
+        w = self._hdr[0]
+        self._write( w, _LEN.pack(len(data)) )
+        self._write( w+_LEN.size, data )
+        with self._idx_lock:
+            self._hdr[0] = w+need # データを書き終えてから公開する
+        self._data_ev.set()
+        return True
+
+    def get(self, *, timeout:float|None=None) ->bytes|None:
+        """レコードを1つ読む(consumer側)。timeoutまでに無いか、wakeup()かrequest_stop()されたらNone"""
+        if self.used()<_LEN.size:
+            self._data_ev.clear()
+            # clearの後に停止を確かめるので、直前のrequest_stop()も取りこぼさない
+            if self.used()<_LEN.size and not self.stopped:
+                self._data_ev.wait(timeout)
+            if self.used()<_LEN.size:
+                return None
+        r = self._hdr[1]
+        n = _LEN.unpack( self._read(r,_LEN.size) )[0]
+        data = self._read( r+_LEN.size, n )
+        with self._idx_lock:
+            self._hdr[1] = r+_LEN.size+n # 読み終えてから空きとして公開する
+        self._space_ev.set()
+        return data
+
+    def wakeup(self):
+        """get()で待っているconsumerを起こす"""
+        self._data_ev.set()
+
+    def request_stop(self):
+        """consumerに入力の終わりを知らせる。producerと並んで書き込まないので、どのスレッド・プロセスからでも呼べる"""
+        with self._idx_lock:
+            self._hdr[3] = 1
+        self._data_ev.set()
+
+    def close(self):
+        """共有メモリから切り離す。作成した側なら共有メモリも削除する"""
+        if self._data is None:
+            return
+        self._hdr.release()
+        self._hdr_raw.release()
+        self._data.release()
+        self._data = None
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner_pid==os.getpid():
+            self._shm.unlink()
+
+class ShmAudioStore:
+    """
+    セッションの音声(16kHz mono int16)の直近capacityサンプルを共有メモリに保持する
+    位置はセッションの先頭からの通しのサンプル数で、producer(デコードループ)だけが書き込む
+    セグメントは位置だけを持ち、音声が必要になったときにread()で取り出す(上書き済みならNone)
+    Processの引数として渡せる(子プロセスでは同じ共有メモリに接続する)
+    shared=Falseなら同じプロセスの中だけで使う(ShmRingと同じ)
+    書き込んだサンプル数はShmRingの位置と同じくロックを通して公開・参照する
+    """
+    HEADER_SIZE = 64 # 書き込んだサンプル数(uint64), 書き込み中の終わりの位置(uint64)
+
+    def __init__(self, capacity:int=16000*60, *, shared:bool=True):
+        self.capacity:int = capacity
+        self._shm:SharedMemory|None = SharedMemory( create=True, size=ShmAudioStore.HEADER_SIZE+capacity*2 ) if shared else None
+        self._owner_pid:int = os.getpid()
+        self._lock = Lock() if shared else threading.Lock()
+        self._map()
+        self._hdr[0] = 0
+        self._hdr[1] = 0
+
+    def _map(self):
+        buf = self._shm.buf if self._shm is not None else memoryview( bytearray(ShmAudioStore.HEADER_SIZE+self.capacity*2) )
+        assert buf is not None
+        self._hdr_raw = buf[:16]
+        self._hdr = self._hdr_raw.cast('Q')
+        self._data = buf[ShmAudioStore.HEADER_SIZE:ShmAudioStore.HEADER_SIZE+self.capacity*2]
+
+    def __getstate__(self):
+        if self._shm is None:
+            raise TypeError("ShmAudioStore(shared=False) cannot be passed to another process")
+        return { 'name': self._shm.name, 'capacity': self.capacity, 'lock': self._lock }
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self._shm = SharedMemory( name=state['name'] )
+        self._owner_pid = -1
+        self._lock = state['lock']
+        self._map()
+
+    @property
+    def written(self) ->int:
+        """書き込んだサンプル数"""
+        with self._lock:
+            return self._hdr[0]
+
+    def reset(self):
+        """セッションの先頭に戻す(producerが居ないときだけ呼ぶ)"""
+        with self._lock:
+            self._hdr[0] = 0
+            self._hdr[1] = 0
+
+    def write(self, pcm:bytes|memoryview):
+        """int16のPCMを追記する(producer側)。古い音声は上書きされる"""
+        src = memoryview(pcm).cast('B')
+        n = len(src)//2
+        w = self._hdr[0]
+        if n>self.capacity:
+            src = src[(n-self.capacity)*2:]
+            w += n-self.capacity
+            n = self.capacity
+        with self._lock:
+            self._hdr[1] = w+n # 上書きする範囲を先に知らせる
+        p = w % self.capacity
+        first = min(n, self.capacity-p)
+        self._data[p*2:(p+first)*2] = src[:first*2]
+        if first<n:
+            self._data[0:(n-first)*2] = src[first*2:n*2]
+        with self._lock:
+            self._hdr[0] = w+n
+
+    def read(self, start:int, end:int) ->np.ndarray|None:
+        """サンプル位置[start,end)の音声のコピー(np.int16)。保持していなければNone"""
+        w = self.written
+        start = max(0,start)
+        end = min(end,w)
+        if end<=start:
+            return np.zeros(0,dtype=np.int16)
+        if start<w-self.capacity:
+            return None # 上書き済み
+        data = np.frombuffer( self._data, dtype=np.int16 )
+        p = start % self.capacity
+        n = end-start
+        first = min(n, self.capacity-p)
+        ret = np.empty(n,dtype=np.int16)
+        ret[:first] = data[p:p+first]
+        if first<n:
+            ret[first:] = data[0:n-first]
+        with self._lock:
+            writing = self._hdr[1]
+        if start<writing-self.capacity:
+            return None # コピー中に上書きされた(書き込み中のものも含む)
+        return ret
+
+    def close(self):
+        """共有メモリから切り離す。作成した側なら共有メモリも削除する"""
+        if self._data is None:
+            return
+        self._hdr.release()
+        self._hdr_raw.release()
+        self._data.release()
+        self._data = None
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner_pid==os.getpid():
+            self._shm.unlink()
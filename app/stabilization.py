@@ -0,0 +1,159 @@
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from whisper_transcribe import Seg
+
+"""
+仮説(デコード結果のセグメント列)のどこまでを確定するかを決める方針
+split()は確定したセグメントのインデックス(そのインデックスを含む)を返す。-1なら確定しない
+"""
+
+# 英語などの文末: 英字の直後の .!? (閉じ括弧・引用符が続いてもよい)
+_EN_END = re.compile( r'[a-zA-Z0-9][.!?]["\')\]]*\s*$' )
+# 日本語の文末記号(全角・半角)。閉じ括弧が続いてもよい
+_JA_END_MARK = re.compile( r'[。．！？!?…‥][」』）)】〕"”]*\s*$' )
+# 句読点が付かなかったときの、よくある文末の言い回し(「ですが」「ますけど」は文が続くので含めない)
+_JA_END_WORD = re.compile( r'(です|ます|でした|ました|ません|でしょう|ましょう|ください|ございます|下さい)(ね|よ|か|よね)?\s*$' )
+
+def is_sentence_end(text:str|None, lang:str|None=None) ->bool:
+    """textが文の終わりで終わっているか
+        lang: セッションの言語。en なら英語の文末だけ、それ以外は日本語の文末記号と言い回しも見る(日本語の中の英文もあるので英語の文末は常に見る)
+    """
+    if not text:
+        return False
+    if _EN_END.search(text):
+        return True
+    if lang!='en' and ( _JA_END_MARK.search(text) or _JA_END_WORD.search(text) ):
+        return True
+    return False
+
+class StabilizationPolicy:
+    name:str = ''
+
+    def __init__(self, lang:str|None=None):
+        self.lang:str|None = lang # 文末の判定に使う言語。モデルを切り替えたら更新する
+
+    def reset(self):
+        """バッファを捨てたときなど、前回までの仮説が使えなくなったときに呼ぶ"""
+        pass
+
+    def split(self, previous:list["Seg"], current:list["Seg"], secs:float, speech_end:float|None=None) ->int:
+        raise NotImplementedError()
+
+    def settle(self, current:list["Seg"], secs:float, speech_end:float|None=None) ->int:
+        """
+        発話が無く、デコードせずに前回の仮説をそのまま使うとき。同じ仮説どうしは一致の根拠にならないので
+        split()は呼ばず(履歴にも入れない)、末尾の無音が1.2秒あれば全部確定する
+        """
+        if len(current)>0 and tail_blank(current,secs,speech_end)>1.2:
+            self.reset()
+            return len(current)-1
+        return -1
+
+def tail_blank(current:list["Seg"], secs:float, speech_end:float|None) ->float:
+    """最後のセグメント(か発話)の後ろの無音の秒数"""
+    tail_blank_sec = secs-(current[-1].end) if len(current)>0 else 0
+    if speech_end is not None and len(current)>0:
+        tail_blank_sec = max( tail_blank_sec, secs-speech_end )
+    return tail_blank_sec
+
+class HeuristicPolicy(StabilizationPolicy):
+    """
+    従来の判定
+        - 末尾の無音が1.2秒あれば全部確定
+        - セグメントが2個なら、両方が文末(is_sentence_end)で終わり、末尾の無音が0.4秒以上なら最初を確定
+        - セグメントが3個以上なら、最後の二つ以外を確定
+    """
+    name = 'heuristic'
+
+    def split(self, previous:list["Seg"], current:list["Seg"], secs:float, speech_end:float|None=None) ->int:
+        if not isinstance(previous,list) or not isinstance(current,list):
+            return -1
+        cur_size = len(current)
+        #---step.1
+        if tail_blank(current,secs,speech_end)>1.2:
+            return cur_size-1 # テキストの最後と音声の最後が1.2秒あれば、全部確定
+
+        if cur_size <=1:
+            return -1 # セグメントが1以下の場合は、確定しない
+        elif cur_size==2:
+            if is_sentence_end(current[0].text,self.lang):
+                if is_sentence_end(current[1].text,self.lang):
+                    if (secs-current[1].end)>0.4:
+                        return 0 # セグメントが2個の場合、時間感覚が0.4秒以上あれば確定する
+            return -1
+        else:
+            return cur_size-3 # セグメントが3個以上あったら、最後の二つ以外は確定
+
+def _words(text:str) ->list[str]:
+    """比較用の単語列。空白の無い言語は1文字を1単語とする"""
+    ret:list[str] = []
+    for w in text.lower().split():
+        w = re.sub(r'[^\w]','',w)
+        if not w:
+            continue
+        if w.isascii():
+            ret.append(w)
+        else:
+            ret.extend(w)
+    return ret
+
+class LocalAgreementPolicy(StabilizationPolicy):
+    """
+    LocalAgreement-n: 直近n回の仮説で先頭から一致している単語を安定とみなし、
+    安定した単語だけで構成されるセグメントまでを確定する(確定はセグメント単位、バッファもセグメントの終わりで切る)
+    最後のセグメントは、文末(is_sentence_end)で終わっているか、後ろにtail_gap秒以上の無音があるときだけ確定する(文の途中で切らない)
+    末尾の無音が1.2秒あれば、一致に関係なく全部確定する
+    """
+    name = 'local_agreement'
+
+    def __init__(self, lang:str|None=None, n:int=2, tail_gap:float=0.5):
+        super().__init__(lang)
+        self.n:int = max(2,n)
+        self.tail_gap:float = tail_gap
+        self._history:list[list[str]] = []
+
+    def reset(self):
+        self._history = []
+
+    def split(self, previous:list["Seg"], current:list["Seg"], secs:float, speech_end:float|None=None) ->int:
+        if not isinstance(current,list) or len(current)==0:
+            self.reset()
+            return -1
+        seg_words = [ _words(seg.text) for seg in current ]
+        self._history.append( [ w for ws in seg_words for w in ws ] )
+        self._history = self._history[-self.n:]
+        if tail_blank(current,secs,speech_end)>1.2:
+            fixed = len(current)-1
+        else:
+            agreed = 0
+            if len(self._history)>=self.n:
+                for words in zip(*self._history):
+                    if any( w!=words[0] for w in words[1:] ):
+                        break
+                    agreed += 1
+            fixed = -1
+            count = 0
+            for i,ws in enumerate(seg_words):
+                count += len(ws)
+                if count>agreed:
+                    break
+                if i==len(current)-1 and (secs-current[i].end)<self.tail_gap and not is_sentence_end(current[i].text,self.lang):
+                    break
+                fixed = i
+        if fixed>=0:
+            # 確定した単語を履歴から除いて、残りの仮説どうしを比べられるようにする
+            drop = sum( len(ws) for ws in seg_words[:fixed+1] )
+            self._history = [ h[drop:] for h in self._history ]
+        return fixed
+
+POLICIES:dict[str,type[StabilizationPolicy]] = {
+    HeuristicPolicy.name: HeuristicPolicy,
+    LocalAgreementPolicy.name: LocalAgreementPolicy,
+}
+
+def make_policy(name:str|None, lang:str|None=None) ->StabilizationPolicy:
+    """名前から方針を作る。知らない名前なら従来の判定"""
+    cls = POLICIES.get(name or '', HeuristicPolicy)
+    return cls(lang)
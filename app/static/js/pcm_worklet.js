@@ -0,0 +1,35 @@
+// マイク入力を16kHz mono int16に変換して、200ms毎にメインスレッドへ送る
+// { t: チャンクの先頭の時刻(ms), pcm: ArrayBuffer }
+// AudioContextを sampleRate:16000 で作ればブラウザがリサンプリングする
+class PcmCaptureProcessor extends AudioWorkletProcessor {
+    constructor() {
+        super();
+        this.frames = Math.floor(sampleRate * 0.2);
+        this.chunk = new Int16Array(this.frames);
+        this.pos = 0;
+        this.t0 = 0;
+    }
+
+    process(inputs) {
+        const input = inputs[0];
+        if (input && input.length > 0) {
+            const ch = input[0];
+            for (let i = 0; i < ch.length; i++) {
+                if (this.pos === 0) {
+                    this.t0 = (currentTime + i / sampleRate) * 1000;
+                }
+                const v = Math.max(-1, Math.min(1, ch[i]));
+                this.chunk[this.pos++] = v < 0 ? v * 0x8000 : v * 0x7FFF;
+                if (this.pos >= this.frames) {
+                    // バッファの所有権ごと渡してコピーを避ける
+                    this.port.postMessage({ t: this.t0, pcm: this.chunk.buffer }, [this.chunk.buffer]);
+                    this.chunk = new Int16Array(this.frames);
+                    this.pos = 0;
+                }
+            }
+        }
+        return true;
+    }
+}
+
+registerProcessor('pcm-capture', PcmCaptureProcessor);
@@ -53,24 +53,48 @@ function test_mimetype() {
       "audio/mp4;codecs=\"mp4a, avc1\"", "audio/mp4;codecs=\"mp4a, mp4a\""
   */
 
-function calculateXORChecksum(data) {
-    let checksum = 0;
-    for (let i = 0; i < data.length; i++) {
-        checksum ^= data[i]; // 各バイトをXOR演算
+// 音声のフレーム(サーバのaudio_frame.pyと同じ形式)
+// ヘッダ24バイト(little endian): magic 'AF', version 1, codec, seq u32, ts f64(ms), length u32, crc32 u32
+const FRAME_HEADER = 24;
+const AUDIO_CODEC = { pcm: 1, webm: 2, mp4: 3, ogg: 4 };
+const CRC_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+function crc32(u8) {
+    let c = 0xFFFFFFFF;
+    for (let i = 0; i < u8.length; i++) {
+        c = CRC_TABLE[(c ^ u8[i]) & 0xFF] ^ (c >>> 8);
     }
-    return checksum;
+    return (c ^ 0xFFFFFFFF) >>> 0;
 }
-// Blobをbase64に変換
-async function blobToBase64(blob) {
-    return new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onloadend = () => {
-            const base64data = reader.result.split(',')[1];
-            resolve(base64data);
-        };
-        reader.onerror = reject;
-        reader.readAsDataURL(blob);
-    });
+function packAudioFrame(seq, ts, codec, payload) {
+    const u8 = new Uint8Array(payload);
+    const buf = new ArrayBuffer(FRAME_HEADER + u8.length);
+    const view = new DataView(buf);
+    view.setUint8(0, 0x41); // 'A'
+    view.setUint8(1, 0x46); // 'F'
+    view.setUint8(2, 1);
+    view.setUint8(3, codec);
+    view.setUint32(4, seq >>> 0, true);
+    view.setFloat64(8, ts, true);
+    view.setUint32(16, u8.length, true);
+    view.setUint32(20, crc32(u8), true);
+    new Uint8Array(buf, FRAME_HEADER).set(u8);
+    return buf;
+}
+// MediaRecorderのmimeTypeからコーデックの番号を決める
+function codecOfMime(mime) {
+    if (mime.startsWith('audio/mp4')) return AUDIO_CODEC.mp4;
+    if (mime.startsWith('audio/ogg')) return AUDIO_CODEC.ogg;
+    return AUDIO_CODEC.webm;
 }
 function asleep(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
@@ -86,7 +110,17 @@ class WhisperController {
         this.audioChunks = [];
         this.stream = null;
         this.fragment = [];
+        // 文字起こしの履歴(サーバーのtranscript_stream.py)。stream:履歴のid v:当てた版 segs:確定した文の数 tmp:仮の文 key:引き継ぎの鍵(自分の履歴だけ)
+        // URLに ?stream=<id> があれば、その履歴を途中から見る
+        this.transcriptView = new URLSearchParams(window.location.search).get('stream');
+        this.transcript = { stream: this.transcriptView, v: 0, segs: 0, tmp: '', key: null, syncing: false };
         this.isListening = false; // 音声認識がアクティブかどうかを追跡
+        // AudioWorkletによるPCM送信(使えない場合はMediaRecorderのWebMにフォールバック)
+        this.usePcm = !!window.AudioWorkletNode;
+        this.pcmContext = null;
+        this.pcmSource = null;
+        this.pcmNode = null;
+        this.pcmSending = false;
 
         // 音声録音の設定
         this.constraints = {
@@ -125,6 +159,12 @@ class WhisperController {
             });
         }
         
+        window.uiController.uiHandler('recording', async (value) => {
+            // サーバーに通知(次の録音開始から有効)
+            this.values['recording'] = value
+            await this.sendValues();
+        })
+
         window.uiController.uiHandler('llmMode', async (value) => {
             // サーバーに通知
             this.values['llmMode'] = value
@@ -154,6 +194,13 @@ class WhisperController {
     onConnect() {
         console.log('socketio connected');
         const llmMode = document.querySelector('input[name="llmMode"]:checked').value;
+        // 再接続したら、持っている版からの続きを送ってもらう(見ているだけの履歴でなければ引き継ぐ)
+        // 差分には履歴のidが無いので、初めての接続でも送り直しで自分の履歴のidを受け取る
+        const tr = this.transcript;
+        if( this.socket ) {
+            tr.syncing = true;
+            this.socket.emit('ev', { msg: 'transcriptSync', data: { stream: tr.stream, since: tr.v, resume: tr.key != null, key: tr.key } });
+        }
     }
     onConnectError(error) {
         console.log('socketio connect error',error);
@@ -173,8 +220,18 @@ class WhisperController {
             if(sz !== undefined ) {
                 window.uiController.updateToUI('bufsize',sz)
             }
-        } else if( cmd == 'transcription' ) {
-            this.onTranscription(data)
+        } else if( cmd == 'asrModel' ) {
+            window.uiController.updateToUI('asrModel',data)
+        } else if( cmd == 'admission' ) {
+            // queue:空くのを待っている reject:断られた(録音を止める)
+            window.uiController.updateToUI('admission',data)
+            if( data.status=='reject' ) {
+                console.log('socketio admission rejected',data.reason);
+                window.uiController.updateStatusForError(`rejected: ${data.reason}`);
+                this.stopRecording()
+            }
+        } else if( cmd == 'transcript' ) {
+            this.onTranscript(data)
         } else if( cmd=='resultText' ) {
             
         } else if( cmd=='llmStat' ) {
@@ -191,20 +248,43 @@ class WhisperController {
             console.log('ERROR',cmd)
         }
     }
-    onTranscription(data) {
-        console.log('socketio recv transcription');
-        const results = []
-        if (data.text) {
-            for (const result_text of data.text) {
-                results.push({ text: result_text, isFinal: true, confidence: 1.0 });
+    onTranscript(data) {
+        const tr = this.transcript;
+        if( data.full ) {
+            // 送り直し。始めからなら作り直す
+            if( data.stream != tr.stream || data.since == 0 ) {
+                tr.stream = data.stream;
+                tr.key = data.key ?? null;
+                tr.segs = 0;
+                window.uiController.resetTranscriptUI();
             }
-        }
-        if (data.tmp) {
-            for (const result_text of data.tmp) {
-                results.push({ text: result_text, isFinal: false, confidence: 0.5});
+            tr.syncing = false;
+        } else {
+            // 差分は見ている履歴のルームにだけ届く
+            if( tr.stream == null || tr.syncing || data.v <= tr.v ) {
+                return; // 送り直しを待っている間か、当て済みの版
             }
+            if( data.v != tr.v + 1 ) {
+                // 抜けた版があるので、持っている版からの続きを送ってもらう
+                console.log('socketio transcript gap',tr.v,data.v);
+                tr.syncing = true;
+                this.socket?.emit('ev', { msg: 'transcriptSync', data: { stream: tr.stream, since: tr.v } });
+                return;
+            }
+        }
+        tr.v = data.v;
+        // 既に持っている文は除く
+        const add = data.add ?? [];
+        const seg = data.seg ?? tr.segs;
+        const texts = add.slice( Math.max(0, tr.segs - seg) );
+        // 文毎のセグメント番号と時刻。録音していれば、その文の音声を /recording/<stream>/<seq> で引ける
+        const at = (data.at ?? []).slice( Math.max(0, tr.segs - seg) );
+        tr.segs = Math.max( tr.segs, seg + add.length );
+        if( data.tmp ) { // 無ければ仮の文は変わっていない
+            const [offset,text] = data.tmp;
+            tr.tmp = tr.tmp.slice(0,offset) + text;
         }
-        window.uiController.updateTranscriptUI(results);
+        window.uiController.appendTranscriptUI( texts, tr.tmp, at.map( a => a ? { url: `/recording/${tr.stream}/${a[0]}`, start: a[1], end: a[2] } : null ) );
     }
     onResultText(data) {
         console.log('socketio recv text');
@@ -291,50 +371,81 @@ class WhisperController {
         await this.asend_ev('configure',this.values);
     }
 
+    // AudioWorkletで16kHz mono int16を取り出して audio_frame で送る
+    async startPcmCapture() {
+        this.pcmContext = new AudioContext({ sampleRate: 16000 });
+        await this.pcmContext.audioWorklet.addModule('/static/js/pcm_worklet.js');
+        this.pcmSource = this.pcmContext.createMediaStreamSource(this.stream);
+        this.pcmNode = new AudioWorkletNode(this.pcmContext, 'pcm-capture', { numberOfInputs: 1, numberOfOutputs: 0 });
+        this.pcmNode.port.onmessage = (event) => {
+            if (this.pcmSending && this.socket && this.socket.connected) {
+                // tsはチャンクの先頭のAudioContextの時刻(ms)
+                this.socket.emit('audio_frame', packAudioFrame(this.media_seq++, event.data.t, AUDIO_CODEC.pcm, event.data.pcm));
+            }
+        };
+        this.pcmSource.connect(this.pcmNode);
+    }
+
+    async stopPcmCapture() {
+        this.pcmSending = false;
+        if (this.pcmSource) {
+            this.pcmSource.disconnect();
+            this.pcmSource = null;
+        }
+        if (this.pcmNode) {
+            this.pcmNode.port.onmessage = null;
+            this.pcmNode = null;
+        }
+        if (this.pcmContext) {
+            await this.pcmContext.close();
+            this.pcmContext = null;
+        }
+    }
+
     async startRecording() {
         try {
             this.isListening = true; // 音声認識をアクティブに設定
             // WebSocket接続を初期化
             await this.initializeWebSocket();
-            console.log('[mediaRec]start')
-            await this.asend_ev('audioStart',this.values); 
             // マイクへのアクセスを要求
             this.stream = await navigator.mediaDevices.getUserMedia(this.constraints);
+            // フレームの通し番号はaudioStart毎に0から
+            this.media_seq = 0;
+            if (this.usePcm) {
+                try {
+                    await this.startPcmCapture();
+                    console.log('[pcm]start')
+                    await this.asend_ev('audioStart',{ ...this.values, audioFormat: 'pcm' });
+                    this.pcmSending = true;
+                    window.uiController.updateToUI('recogStat','start')
+                    return;
+                } catch (error) {
+                    console.log('[pcm]not available, fallback to MediaRecorder', error);
+                    await this.stopPcmCapture();
+                    this.usePcm = false;
+                }
+            }
+            console.log('[mediaRec]start')
             // MediaRecorderの設定
             const options = {mimeType: 'audio/webm;codecs=opus'};
             options.mimeType = 'audio/webm';
             //options.mimeType = 'audio/webm;codecs=pcm'
             options.mimeType = 'audio/mp4;codecs=opus'
             this.mediaRecorder = new MediaRecorder(this.stream);
+            // サーバはmimeType毎に形式の判定結果を覚える
+            await this.asend_ev('audioStart',{ ...this.values, audioFormat: 'webm', mimeType: this.mediaRecorder.mimeType });
 
-            const send = 1;
+            const codec = codecOfMime(this.mediaRecorder.mimeType);
             this.mediaRecorder.ondataavailable = async (event) => {
                 if (event.data.size > 0) {
                     try {
                         // WebSocketを通じてサーバーに音声データを送信
                         if (this.socket && this.socket.connected) {
+                            // 番号はarrayBuffer()を待つ前に決める(送信の順序が入れ替わってもサーバで並べ直す)
                             const seq = this.media_seq++;
-                            const type = event.data.type;
-
-                            //console.log('send mode',send)
-                            if( send==1 ) {
-                                // ダイレクト
-                                this.socket.emit('audio_bin', event.data )
-                            } else if( send==3 ) {
-                                const audio_bin = await event.data.arrayBuffer()
-                                const u8 = new Uint8Array(audio_bin)
-                                const b64 = btoa(String.fromCharCode.apply(null,u8))
-                                this.socket.emit('audio_b64', b64 )
-                            } else if( send==4 ) {
-                                const b64 = await blobToBase64(event.data)
-                                this.socket.emit('audio_b64', b64 )
-                            } else if( send==6 ) {
-                                this.socket.emit('audio_data', {
-                                    'seq':seq,
-                                    'type': type,
-                                    'base64': blobToBase64(event.data),
-                                } );
-                            }
+                            const ts = performance.now();
+                            const payload = await event.data.arrayBuffer();
+                            this.socket.emit('audio_frame', packAudioFrame(seq, ts, codec, payload));
                         }
                     } catch (error) {
                         console.error('音声データの送信エラー:', error);
@@ -365,6 +476,7 @@ class WhisperController {
                 console.log('mediaRecorder stop')
                 this.mediaRecorder.stop();
             }
+            await this.stopPcmCapture();
             // 音声ストリームを停止
             if (this.stream) {
                 console.log('stream stop')
@@ -1,9 +1,13 @@
-from flask import request, jsonify
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
-def summarize_text(text: str) -> str:
-    """音声認識テキストを要約する"""
-    prompt = """
+LLM_MODEL = "gpt-4o-mini"
+
+# モード毎の (プロンプトのバージョン, system, 本文の前に付けるプロンプト)
+# プロンプトを変えたらバージョンを上げる(結果のキャッシュのキーに含めるので、古い結果を返さなくなる)
+PROMPTS:dict[str,tuple[int,str,str]] = {
+    'summary': ( 1,
+        "あなたは音声テキストの要約の専門家です。重要なポイントを簡潔にまとめます。",
+        """
 以下の音声認識テキストを簡潔に要約してください。
 重要なポイントを箇条書きで記載し、できるだけ簡潔にまとめてください。
 
@@ -11,38 +15,57 @@ def summarize_text(text: str) -> str:
 - 重要なポイントを箇条書きで記載
 
 音声認識テキスト：
-"""
-    system_role = "あなたは音声テキストの要約の専門家です。重要なポイントを簡潔にまとめます。"
-    # OpenAI クライアントの初期化（環境変数から自動的にAPI keyを取得）
-    client = OpenAI()
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_role},
-            {"role": "user", "content": prompt + text}
-        ]
-    )
-    
-    return response.choices[0].message.content or ""
-
-def translate_text(text: str) -> str:
-    """テキストを日本語に翻訳する"""
-    prompt = """
+""" ),
+    'translation': ( 1,
+        "あなたは優秀な翻訳者です。自然で分かりやすい日本語訳を提供します。",
+        """
 以下のテキストを自然な日本語に翻訳してください。
 文脈を考慮し、分かりやすい日本語になるよう心がけてください。
 
 原文：
-"""
-    system_role = "あなたは優秀な翻訳者です。自然で分かりやすい日本語訳を提供します。"
-    # OpenAI クライアントの初期化（環境変数から自動的にAPI keyを取得）
-    client = OpenAI()
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_role},
-            {"role": "user", "content": prompt + text}
-        ]
-    )
-    
+""" ),
+}
+
+_client:OpenAI|None = None
+_async_client:AsyncOpenAI|None = None
+
+def get_client() ->OpenAI:
+    """OpenAI クライアント(環境変数から自動的にAPI keyを取得)。接続を使い回すのでプロセスで1つ"""
+    global _client
+    if _client is None:
+        _client = OpenAI()
+    return _client
+
+def get_async_client() ->AsyncOpenAI:
+    """イベントループから呼ぶ版"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI()
+    return _async_client
+
+def prompt_version(mode:str) ->int:
+    return PROMPTS[mode][0]
+
+def _messages(mode:str, text:str) ->list:
+    _, system_role, prompt = PROMPTS[mode]
+    return [
+        {"role": "system", "content": system_role},
+        {"role": "user", "content": prompt + text}
+    ]
+
+def process_text(mode:str, text:str) ->str:
+    """modeのプロンプトでLLMを呼ぶ"""
+    response = get_client().chat.completions.create( model=LLM_MODEL, messages=_messages(mode,text) )
+    return response.choices[0].message.content or ""
+
+async def a_process_text(mode:str, text:str) ->str:
+    response = await get_async_client().chat.completions.create( model=LLM_MODEL, messages=_messages(mode,text) )
     return response.choices[0].message.content or ""
 
+def summarize_text(text: str) -> str:
+    """音声認識テキストを要約する"""
+    return process_text('summary', text)
+
+def translate_text(text: str) -> str:
+    """テキストを日本語に翻訳する"""
+    return process_text('translation', text)
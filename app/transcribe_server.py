@@ -1,96 +1,226 @@
 import sys, os, json
+import re
 import time
-import base64
 from io import BytesIO
-import atexit
 import asyncio
 from asyncio import Task
-from typing import cast
-import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
 
-from flask import Flask, request, jsonify, send_from_directory, send_file
-from flask_socketio import SocketIO, emit
-
-from whisper_transcribe import check_audio, MlxWhisperProcess
-from text_processing import summarize_text,translate_text
+import numpy as np
+from aiohttp import web
+import socketio
+
+from whisper_transcribe import check_audio, MlxWhisperProcess, lang_to_model, SAMPLE_RATE
+from audio_frame import parse_frame, FrameError, FrameStream
+from asr_backend import default_backend
+from asr_service import AsrService
+from asr_remote import RemoteAsrService
+from whisper_pool import WhisperPool
+from load_controller import get_load_controller
+from admission import make_admission_controller
+from text_processing import a_process_text, prompt_version
+from llm_cache import ResultCache, cache_key
+from transcript_stream import TranscriptStream
+from session_recorder import RecordingReader
+from rec_util import audio_to_wave_bytes
 from bot_server import Bot, VoiceRes
 
-# Flask-SocketIOのrequestオブジェクトの型を拡張
-class SocketIORequest:
-    sid: str
-
-def calculate_xor_checksum(data: bytes) -> int:
-    checksum = 0
-    for byte in data:
-        checksum ^= byte  # 各バイトをXOR演算
-    return checksum
+async def create_app() ->tuple[web.Application,socketio.AsyncServer]:
+    """1つのイベントループでHTTPとSocket.IOを処理する(aiohttp)
+    ハンドラはイベントループの上で直接動くので、ブロックする処理(プロセスの停止待ち、LLMの呼び出し等)はスレッドに回す
+    async_handlers=Falseで、1つの接続のイベントは届いた順に処理する(音声のチャンクの順序を保つ)
+    """
+    # to_threadで回すのは主に終了待ち(join)なので、CPUの数より多めに用意する
+    asyncio.get_running_loop().set_default_executor( ThreadPoolExecutor(max_workers=64, thread_name_prefix='blocking') )
+    app = web.Application()
+    sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins="*", ping_timeout=60, async_handlers=False)
+    sio.attach(app)
 
-async def create_app():
-    global_status:bool = True
-    app = Flask(__name__)
-    #app.config['SECRET_KEY'] = 'secret!'
-    socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, async_mode='threading')
+    # 音声認識エンジンが無ければ起動しない(NoBackendError)
+    print(f"[ASR] default backend {default_backend()}")
 
     # 各接続ごとに専用のwhisper_procを管理
     client_sessions: dict[str, "ClientSession"] = {}
 
-    # 非同期ループを共有
-    global_event_loop = asyncio.new_event_loop()
-    # 別スレッドでイベントループを実行
-    async def background_task():
-        """サーバ全体で動作するバックグラウンドタスク"""
-        while global_status:
-            await asyncio.sleep(5)
-    global_event_loop.create_task(background_task())
-    asyncio.set_event_loop(global_event_loop)
-    global_thread = threading.Thread(target=global_event_loop.run_forever, daemon=True)
-    global_thread.start()
+    # モデルを保持するワーカーを全セッションで共有する(0ならセッション毎にプロセスを起動)
+    asr_workers:int = int(os.getenv('ASR_WORKERS','2'))
+    # 起動時にロードしておくモデル(言語かWMのキーをカンマ区切りで)
+    asr_preload:list[str] = [ lang_to_model(x.strip())[0] for x in os.getenv('ASR_PRELOAD','en,ja').split(',') if x.strip() ]
+    # 推論を別のマシンのワーカーノード(asr_node.py)で動かす場合は、ノードのアドレスをカンマ区切りで(host:port,...)
+    asr_nodes:list[str] = [ x.strip() for x in os.getenv('ASR_NODES','').split(',') if x.strip() ]
+    asr_service:AsrService|RemoteAsrService|None = RemoteAsrService(asr_nodes) if asr_nodes else AsrService(workers=asr_workers, preload=asr_preload) if asr_workers>0 else None
+    # 確定位置を決める方針(stabilization.POLICIES)
+    asr_policy:str = os.getenv('ASR_STABILIZATION','local_agreement')
+    if asr_service is not None:
+        asr_service.start()
+    # セッション毎のプロセスの場合は、モデルをロード済みのプロセスを待機させておく(0なら開始の度に起動)
+    pool_size:int = int(os.getenv('ASR_POOL_SIZE','2'))
+    whisper_pool:WhisperPool|None = WhisperPool(size=pool_size, preload=asr_preload) if asr_service is None and pool_size>0 else None
+    if whisper_pool is not None:
+        whisper_pool.start()
+    # audioStartでデコードを始めてよいかを、測った負荷とCPU・メモリの余裕から決める
+    # セッション毎のプロセスならCPUの数だけ推論できるものとする
+    admission = make_admission_controller( workers=(lambda: asr_service.workers) if asr_service is not None else (lambda: os.cpu_count() or 1),
+                                           shared_models=asr_service is not None,
+                                           model_stats=asr_service.model_stats if asr_service is not None else None,
+                                           model_rtf=asr_service.model_rtf if asr_service is not None else None )
+
+    # /process_audioの結果(LLMの要約・翻訳)のキャッシュ
+    llm_cache = ResultCache( max_entries=int(os.getenv('LLM_CACHE_SIZE','256')), ttl_sec=float(os.getenv('LLM_CACHE_TTL_SEC','600')) )
+
+    # 文字起こしの版付きの履歴(transcript_stream.py)。所有するセッションが切断した後も、切断か最後の更新からTRANSCRIPT_TTL_SEC秒は残して
+    # 再接続したクライアントや途中から見るクライアントに送り直す。差分はルーム tr:<stream> に送る(クライアントは見ている1つのルームだけに入る)
+    transcript_ttl:float = float(os.getenv('TRANSCRIPT_TTL_SEC','600'))
+    transcripts:dict[str,TranscriptStream] = {}
+    def transcript_room(stream_id:str) ->str:
+        return f"tr:{stream_id}"
+    # 録音(session_recorder.py)は履歴毎のディレクトリに追記する(引き継いだセッションも同じ録音に続ける)
+    recording_root:str = 'tmp/rec'
+    def recording_dir(stream_id:str) ->str|None:
+        return os.path.join(recording_root,stream_id) if re.fullmatch(r'[0-9a-f]{1,32}',stream_id) else None
+    def prune_transcripts():
+        owned = { s.transcript.stream_id for s in client_sessions.values() }
+        now = time.time()
+        for stream_id in [ k for k,tr in transcripts.items() if k not in owned and now-tr.updated>transcript_ttl ]:
+            del transcripts[stream_id]
+
+    # 送信は完了を待たない(遅いクライアントで呼び出し元を止めない)。タスクは終わるまで参照を持っておく
+    emit_tasks:set[Task] = set()
+    def emit_nowait(event:str, data, to:str):
+        task = asyncio.get_running_loop().create_task( sio.emit(event, data, to=to) )
+        emit_tasks.add(task)
+        task.add_done_callback(emit_tasks.discard)
 
     class ClientSession:
 
         def __init__(self,clientid):
             self.client_id = clientid
-            self.whisper_proc = MlxWhisperProcess( logfile=f'tmp/client_{clientid}.log')
+            self.whisper_proc = MlxWhisperProcess( logfile=f'tmp/client_{clientid}.log', incremental=True, service=asr_service, policy=asr_policy,
+                                                  on_event=self.send_ev, pool=whisper_pool )
             self.vot_proc = Bot()
             self._run:int=0
             self._audioid:int = 0
+            self._t0:Task|None = None # 受け付けを待つタスク
             self._t1:Task|None = None
             self._t2:Task|None = None
+            self._admitted:bool = False
             self.mode = 'off'  # デフォルトモード
             self.lang = 'off'  # デフォルト言語
-            self._accept_audio:str|None = None
+            self.backend:str|None = None
+            self._audio_mime:str = ''
+            self._audio_verdicts:dict[str,str] = {} # mime毎のcheck_audioの結果
             self._prev_bufsz:float = 0.0
+            self._overruns:int = 0
+            self._pcm:bool = False # Trueならブラウザから16kHz mono int16のPCMを受け取る
+            self._recording:bool = False
+            self._frames:FrameStream = FrameStream( sample_rate=SAMPLE_RATE ) # 音声のフレームを通し番号の順に並べる
+            self.transcript:TranscriptStream = TranscriptStream()
+            self._following:str = '' # 差分を受け取る履歴(ルームは1つだけ。差分にはstreamが無い)
 
         async def connect(self):
-            pass
-
-        async def start(self):
+            prune_transcripts()
+            transcripts[self.transcript.stream_id] = self.transcript
+            await self.follow( self.transcript )
+
+        async def follow(self, tr:TranscriptStream):
+            """差分を受け取る履歴をtrに切り替える"""
+            if self._following==tr.stream_id:
+                return
+            if self._following:
+                await sio.leave_room( self.client_id, transcript_room(self._following) )
+            self._following = tr.stream_id
+            await sio.enter_room( self.client_id, transcript_room(tr.stream_id) )
+
+        async def sync_transcript(self, data):
+            """版sinceからの送り直し
+                resumeなら、鍵の合う履歴を引き継ぐ(まだ何も起こしていない場合だけ)。前の接続の切断をまだ検知していなければ、そのセッションを終わらせる
+                引き継げなければ自分の履歴を送る。resumeでなければ、その履歴を見るだけ
+            """
+            data = data if isinstance(data,dict) else {}
+            stream_id = str(data.get('stream') or '')
+            since = int(data.get('since') or 0)
+            tr = transcripts.get(stream_id)
+            if tr is not None and tr is not self.transcript and data.get('resume'):
+                owner = next( (s for s in client_sessions.values() if s.transcript is tr), None )
+                if data.get('key')==tr.key and self.transcript.version==0:
+                    if owner is not None:
+                        await evict( owner )
+                    transcripts.pop( self.transcript.stream_id, None )
+                    self.transcript = tr
+                    self.whisper_proc.set_next_seq( tr.next_seq )
+                    print(f"[SESSION]{self.client_id}:transcript resume {tr.stream_id} v{tr.version}")
+                else:
+                    tr = None
+            if tr is None:
+                # 期限切れ等で無いか、引き継げなければ、自分の履歴を始めから送る
+                tr = self.transcript
+                since = 0
+            # 見るだけの履歴なら、自分の履歴の差分は受け取らない(クライアントも見ている履歴しか表示しない)
+            await self.follow( tr )
+            snap = tr.snapshot(since)
+            if tr is self.transcript:
+                snap['key'] = tr.key
+            self.send_ev( 'transcript', snap )
+
+        async def start(self, data=None):
+            self._pcm = isinstance(data,dict) and data.get('audioFormat')=='pcm'
+            self._audio_mime = str(data.get('mimeType','')) if isinstance(data,dict) else ''
+            # 受け付けなかった形式は、次の録音で判定し直す
+            self._audio_verdicts = { m:v for m,v in self._audio_verdicts.items() if v=='' }
+            self._frames.reset()
+            # 録音先は開始の時点の履歴で決める(接続した後に別の履歴を引き継ぐことがある)
+            self.whisper_proc.set_recording( recording_dir(self.transcript.stream_id) if self._recording else None )
+            # 前の録音の受け付け待ちが残っていれば止める(後から受け付けられて、この録音の分をreleaseしないように)
+            if self._t0 is not None and not self._t0.done():
+                self._t0.cancel()
+                await asyncio.gather( self._t0, return_exceptions=True )
             self._audioid=( a:=self._audioid+1 )
             self._run = a
+            self._admitted = False
+            self._t0 = asyncio.get_event_loop().create_task( self._task_admit(a) )
+
+        async def _task_admit(self,aid):
+            """受け付けられるまで待ってからデコードを始める(待つ間に届いた音声は捨てる)"""
+            adm = await admission.acquire( self.client_id, self.lang, self.backend,
+                                           on_queued=lambda x: self.send_ev( 'admission', x._asdict() | {'status': x.action} ) )
+            if self._run!=aid:
+                admission.release(self.client_id)
+                return
+            print(f"[SESSION]{self.client_id}-{aid}:admission {adm.action} {adm.model} {adm.reason}")
+            self.send_ev( 'admission', adm._asdict() | {'status': adm.action} )
+            if adm.action=='reject':
+                self._run = aid+1
+                return
+            # 小さいモデルで受け付けたら、この録音の間だけ切り替える(次のaudioStartで選んだモデルから判断し直す)
+            self.whisper_proc.set_language( adm.key if adm.action=='degrade' else self.lang, self.backend )
+            self._admitted = True
             loop = asyncio.get_event_loop()
-            if self._t1 is None:
-                self._t1 = loop.create_task( self._task_stt(a) )
-            if self._t2 is None:
-                self._t2 = loop.create_task( self._task_vod(a) )
+            if self._t1 is None or self._t1.done():
+                self._t1 = loop.create_task( self._task_stt(aid) )
+            if self._t2 is None or self._t2.done():
+                self._t2 = loop.create_task( self._task_vod(aid) )
 
         async def stop(self):
+            # 欠けを待っているフレームを流してから止める
+            await self._append_chunks( *self._frames.flush() )
             self._run=self._audioid+1
-            self.whisper_proc.stop()
-            self.vot_proc.stop()
-            if self._t1 is not None:
-                self._t1.cancel()
-                self._t1 = None
-            if self._t2 is not None:
-                self._t2.cancel()
-                self._t2 = None
+            self._admitted = False
+            tasks = [ t for t in (self._t0,self._t1,self._t2) if t is not None ]
+            self._t0 = self._t1 = self._t2 = None
+            for t in tasks:
+                t.cancel()
+            # whisper_procとvot_procは各タスクの終わりに(スレッドで)停止するので、それを待つ
+            await asyncio.gather( *tasks, return_exceptions=True )
+            admission.release(self.client_id)
 
         async def disconnect(self):
+            self.transcript.updated = time.time()
             await self.stop()
+            await asyncio.to_thread(self.whisper_proc.close)
 
         def send_ev(self,msg,data):
-            socketio.emit('ev', {'msg': msg, 'data': data}, to=self.client_id)
+            emit_nowait('ev', {'msg': msg, 'data': data}, to=self.client_id)
 
         async def update_configure(self, data ):
             mode = data.get('llmMode', 'off') if data else 'off'
@@ -100,47 +230,94 @@ async def create_app():
             self.lang = lang
             # 必要に応じてwhisper_procやvot_procの設定も更新
             if self.whisper_proc:
-                self.whisper_proc.set_language(lang)
+                # エンジンはセッション毎に選べる(空なら言語毎の既定)
+                self.backend = ( data.get('asrBackend') if data else None ) or None
+                self.whisper_proc.set_language(lang, self.backend)
+                # 録音はセッション毎に切り替える(次のaudioStartから有効)
+                self._recording = bool(data.get('recording', False)) if data else False
             if self.vot_proc:
                 self.vot_proc.set_mode(mode)
 
-        async def append_audio(self,seq:int,typ:str,audio:bytes) ->str:
-            if self._accept_audio is None or self._accept_audio!='':
-                self._accept_audio = await check_audio(audio, 16000)
-            if self._accept_audio is not None and self._accept_audio!='':
-                return self._accept_audio
+        async def append_frame(self,data:bytes) ->str:
+            """audio_frameのバイナリを検査して、通し番号の順にwhisperへ送る"""
+            try:
+                frame = parse_frame(data)
+            except FrameError as ex:
+                return str(ex) # 壊れたフレームは欠けとして扱われる
+            return await self._append_chunks( *self._frames.push(frame) )
+
+        async def _append_chunks(self,chunks:list[tuple[int,str,bytes|memoryview]],lost:int) ->str:
+            msgs:list[str] = []
+            if lost>0:
+                print(f"[SESSION]{self.client_id} audio frame lost {lost} {self._frames.stats()}")
+                msgs.append( f"audio frame lost {lost}" )
+            for seq,typ,payload in chunks:
+                msg = await self.append_pcm(seq,payload) if typ=='pcm' else await self.append_audio(seq,typ,payload)
+                if msg:
+                    msgs.append(msg)
+            return ' '.join(msgs)
+
+        async def append_audio(self,seq:int,typ:str,audio:bytes|memoryview) ->str:
+            # 判定は録音の最初のチャンクだけ行い、同じmimeなら以後は判定しない
+            verdict = self._audio_verdicts.get(self._audio_mime)
+            if verdict is None:
+                verdict = self._audio_verdicts[self._audio_mime] = await check_audio(bytes(audio), 16000)
+            if verdict!='':
+                return verdict
+            return self._send_audio(seq,typ,audio)
+
+        async def append_pcm(self,seq:int,pcm:bytes|memoryview) ->str:
+            """AudioWorkletからの16kHz mono int16をffmpegを通さずにwhisperのバッファへ送る"""
+            if not self._pcm:
+                return 'audio format is not pcm'
+            if len(pcm)%2!=0:
+                return f'invalid pcm length {len(pcm)}'
+            return self._send_audio(seq,'pcm',pcm)
+
+        def _send_audio(self,seq:int,typ:str,audio:bytes|memoryview) ->str:
+            if not self._admitted:
+                return '' # 受け付けを待っている
             if self.whisper_proc:
                 sz:float = self.whisper_proc.append_audio(seq,typ,audio)
                 if sz != self._prev_bufsz:
                     self._prev_bufsz = sz
                     self.send_ev( 'bufsize', {'size': sz} )
+                # デコードが追いつかずにリングバッファから溢れた
+                overruns = self.whisper_proc.overruns
+                if overruns != self._overruns:
+                    self._overruns = overruns
+                    return f'audio buffer overrun {overruns}'
             return ''
 
         async def _task_stt(self,aid):
             print(f"[SESSION]{self.client_id}-{aid}:stt start")
-            self.whisper_proc.start()
+            self.whisper_proc.start(pcm=self._pcm)
             """whisper_procからの結果を読み取ってクライアントに送信するタスク"""
             try:
                 while self._run==aid and self.client_id in client_sessions:  # クライアントが接続中の間だけ実行
                     try:
                         fixed_text = ''
-                        result = await self.whisper_proc.read()
+                        result = await self.whisper_proc.read(segments=True)
+                        if result is None:
+                            break # whisperが終了した
                         if result:
-                            fixed_text, temp_text = result
-                            # 確定したテキストを送信
-                            if fixed_text or temp_text:
+                            fixed_segs, temp_text = result
+                            fixed_text = [ x.text for x in fixed_segs ]
+                            # 確定したテキストと仮のテキストの差分を送信
+                            delta = self.transcript.update( fixed_text, temp_text, [ (x.seq,x.start,x.end) for x in fixed_segs ] )
+                            if delta is not None:
                                 print(f"Sending fixed text to {self.client_id}: {fixed_text} {temp_text}")
-                                self.send_ev( 'transcription', {'text': ' '.join(fixed_text), 'tmp': ' '.join(temp_text)} )
+                                emit_nowait( 'ev', {'msg': 'transcript', 'data': delta}, to=transcript_room(self.transcript.stream_id) )
                             if fixed_text is not None and fixed_text!='':
                                 await self.vot_proc.put(fixed_text,temp_text)
                     except Exception as ex:
                         print(f"Error in read_transcription loop for client {self.client_id}: {str(ex)}")
-                    await asyncio.sleep(0.1)  # 短い待機時間を入れてCPU使用率を抑える
+                        await asyncio.sleep(0.1)
             except Exception as ex:
                 print(f"Error in read_transcription for client {self.client_id}: {str(ex)}")
             finally:
                 self._run = aid+1
-                self.whisper_proc.stop()
+                await asyncio.to_thread(self.whisper_proc.stop)
                 print(f"[SESSION]{self.client_id}-{aid}:stt end {self._run}")
 
         async def _task_vod(self,aid):
@@ -150,62 +327,59 @@ async def create_app():
             try:
                 while self._run==aid and self.client_id in client_sessions:  # クライアントが接続中の間だけ実行
                     try:
-                        cmd, restext, voice = await self.vot_proc.get(timeout=0.2)
+                        res = await self.vot_proc.get(timeout=1.0)
+                        if res is None:
+                            continue
+                        cmd, restext, voice = res
                         if restext != '' or len(voice)>0:
                             if cmd==VoiceRes.CMD_APPEND:
-                                socketio.emit('audio_stream', {'text': restext, 'audio': voice}, to=self.client_id)
+                                emit_nowait('audio_stream', {'text': restext, 'audio': voice}, to=self.client_id)
                             elif cmd==VoiceRes.CMD_ALL:
-                                socketio.emit('result_text', {'text': restext, 'audio': voice}, to=self.client_id)
+                                emit_nowait('result_text', {'text': restext, 'audio': voice}, to=self.client_id)
                             elif cmd==VoiceRes.CMD_LLM_ON or cmd==VoiceRes.CMD_LLM_OFF:
                                 self.send_ev( 'llmStat', { 'stat': cmd==VoiceRes.CMD_LLM_ON } )
                     except Exception as ex:
                         print(f"Error in read_transcription loop for client {self.client_id}: {str(ex)}")
-                    await asyncio.sleep(0.1)  # 短い待機時間を入れてCPU使用率を抑える
+                        await asyncio.sleep(0.1)
             except Exception as ex:
                 print(f"Error in read_transcription for client {self.client_id}: {str(ex)}")
             finally:
-                self.vot_proc.stop()
+                await asyncio.to_thread(self.vot_proc.stop)
                 self._run = aid+1
                 print(f"[SESSION]{self.client_id}-{aid}:vod end {self._run}")
 
-    @app.route('/')
-    def whisper_page():
-        return send_from_directory('static', 'transcribe_mlxwhisper.html')
+    async def whisper_page(request:web.Request):
+        return web.FileResponse('static/transcribe_mlxwhisper.html')
 
-    @app.route('/transcribe_webrtc')
-    def whisper_pagea():
-        return send_from_directory('static', 'transcribe_webrtc.html')
+    async def whisper_pagea(request:web.Request):
+        return web.FileResponse('static/transcribe_webrtc.html')
 
-    @app.route('/transcribe_mlxwhisper')
-    def whisper_pageb():
-        return send_from_directory('static', 'transcribe_mlxwhisper.html')
+    async def whisper_pageb(request:web.Request):
+        return web.FileResponse('static/transcribe_mlxwhisper.html')
 
-    @app.route('/static/<path:path>')
-    def send_static(path):
-        print(f"static {path}")
-        return send_from_directory('static', path)
+    app.router.add_get('/', whisper_page)
+    app.router.add_get('/transcribe_webrtc', whisper_pagea)
+    app.router.add_get('/transcribe_mlxwhisper', whisper_pageb)
+    app.router.add_static('/static', 'static')
 
-    @socketio.on('connect')
-    def handle_connect():
-        """クライアント接続時にwhisper_procを生成して起動"""
+    @sio.event
+    async def connect(sid:str, environ:dict):
+        """クライアント接続時にwhisper_procを生成"""
         try:
-            # requestをSocketIORequest型としてキャスト
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
+            client_id = sid
             print(f'Client connected: {client_id}')
             if client_id not in client_sessions:
                 session:ClientSession = ClientSession(client_id)
                 client_sessions[client_id] = session
-                # 非同期タスクを作成
-                global_event_loop.create_task(session.connect())
+                await session.connect()
         except Exception as ex:
             print(f"Error in handle_connect: {str(ex)}")
-            emit('error', {'error': str(ex)})
-    @socketio.on('ev')
-    def handle_message(raw_message):
+            await sio.emit('error', {'error': str(ex)}, to=sid)
+
+    @sio.on('ev')
+    async def handle_message(sid:str, raw_message):
         try:
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
+            client_id = sid
             session = client_sessions.get(client_id)
             if session:
                 cmd_dict:dict = raw_message
@@ -213,126 +387,144 @@ async def create_app():
                 cmd = cmd_dict.get('msg')
                 data = cmd_dict.get('data')
                 if cmd == 'configure':
-                    # 非同期タスクを作成
-                    global_event_loop.create_task(session.update_configure(data))
+                    await session.update_configure(data)
                     return
                 elif cmd == 'audioStart':
-                    global_event_loop.create_task(session.start())
+                    await session.start(data)
+                    return
+                elif cmd == 'transcriptSync':
+                    await session.sync_transcript(data)
                     return
                 elif cmd == 'audioStop':
-                    global_event_loop.create_task(session.stop())
+                    # 停止を待つ間も他のイベントを処理できるようにタスクにする
+                    asyncio.get_running_loop().create_task(session.stop())
                     return
             print(f"[API] invalid cmd {raw_message}")
         except Exception as ex:
-            print(f"[API]message {raw_message} {str(str)}")
+            print(f"[API]message {raw_message} {str(ex)}")
 
-    @socketio.on('audio_bin')
-    def handle_audio_bin(data):
-        """WebSocketで受信した音声データを該当クライアントのwhisper_procに送信"""
+    @sio.on('audio_frame')
+    async def handle_audio_frame(sid:str, data):
+        """音声のフレーム(audio_frame.py)を該当クライアントのwhisper_procに送信"""
         msg = 'invalid data'
+        client_id = sid
         try:
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
             session = client_sessions.get(client_id)
             if session is not None:
                 if isinstance(data,bytes):
-                    seq = 0
-                    typ = ''
-                    fut = asyncio.run_coroutine_threadsafe(session.append_audio(seq, typ, data), global_event_loop)
-                    msg = fut.result()  # 結果を受け取る
+                    msg = await session.append_frame(data)
         except Exception as e:
-            msg = f"Error handling audio data for client {client_id}: {str(e)}"
+            msg = f"Error handling audio frame for client {client_id}: {str(e)}"
         if msg:
             print(f"{msg}")
-            if client_id:
-                socketio.send( json.dumps({'msg':'audioError', 'data': {'error': msg}}), to=client_id )
+            await sio.emit('ev', {'msg':'audioError', 'data': {'error': msg}}, to=client_id)
 
-    @socketio.on('audio_b64')
-    def handle_audio_b64(data):
-        """WebSocketで受信した音声データを該当クライアントのwhisper_procに送信"""
-        msg = 'invalid data'
-        try:
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
-            session = client_sessions.get(client_id)
-            if session is not None:
-                if isinstance(data,str):
-                    seq = 0
-                    typ = ''
-                    buf:bytes = base64.b64decode(data)
-                    fut = asyncio.run_coroutine_threadsafe(session.append_audio(seq,typ,buf),global_event_loop)
-                    msg = fut.result()
-        except Exception as e:
-            msg = f"Error handling audio data for client {client_id}: {str(e)}"
-        if msg:
-            print(f"{msg}")
-            emit('audio_error', {'error': msg})
+    async def evict(session:ClientSession):
+        """切断を検知する前に再接続したクライアントの、前の接続のセッションを終わらせる"""
+        print(f"[SESSION]{session.client_id}:evicted")
+        if client_sessions.pop(session.client_id,None) is not None:
+            asyncio.get_running_loop().create_task(session.disconnect())
+        await sio.disconnect(session.client_id)
 
-    @socketio.on('audio_dict')
-    def handle_audio_dict(data):
-        """WebSocketで受信した音声データを該当クライアントのwhisper_procに送信"""
-        msg = 'invalid data'
-        try:
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
-            session = client_sessions.get(client_id)
-            if session is not None:
-                if isinstance(data,dict):
-                    seq = data.get('seq',-1)
-                    typ = data.get('type','')
-                    b64 = data.get('base64','')
-                    buf:bytes = base64.b64decode(b64)
-                    fut = asyncio.run_coroutine_threadsafe(session.append_audio(seq,typ,buf),global_event_loop)
-                    msg = fut.result()
-        except Exception as e:
-            msg = f"Error handling audio data for client {client_id}: {str(e)}"
-        if msg:
-            print(f"{msg}")
-            emit('audio_error', {'error': msg})
-
-    @socketio.on('disconnect')
-    def handle_disconnect():
+    @sio.event
+    async def disconnect(sid:str):
         """クライアント切断時にwhisper_procを停止"""
+        client_id = sid
         try:
-            socket_request = cast(SocketIORequest, request)
-            client_id = socket_request.sid
             print(f'Client disconnected: {client_id}')
-            session = client_sessions.pop(client_id)
+            session = client_sessions.pop(client_id,None)
             if session:
-                global_event_loop.create_task(session.disconnect())
+                asyncio.get_running_loop().create_task(session.disconnect())
         except Exception as e:
             print(f"Error handling disconnect for client {client_id}: {str(e)}")
-            #emit('error', {'error': str(e)})
 
-    @app.route('/process_audio', methods=['POST'])
-    def process_audio_route():
+    async def process_audio_route(request:web.Request):
         try:
-            data = request.get_json()
+            data = await request.json()
             text = data.get('text', '')
             mode = data.get('mode', 'summary')  # デフォルトは要約モード
             
             if mode == 'off':
-                return jsonify({"response": ""})
+                return web.json_response({"response": ""})
                 
-            if mode == 'summary':
-                answer = summarize_text(text)
-            else:  # translation mode
-                answer = translate_text(text)
-            
-            return jsonify({"response": answer})
+            mode = 'summary' if mode == 'summary' else 'translation'
+            # 同じテキストの要求(画面の更新等)はキャッシュか、処理中の要求の結果を返す
+            key = cache_key(mode, prompt_version(mode), text)
+            answer, cache = await llm_cache.get_or_run( key, lambda: a_process_text(mode, text) )
+            return web.json_response({"response": answer}, headers={'X-Cache': cache})
         
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
-
-    #defining function to run on shutdown
-    def close_running_threads():
-        global_status = False
+            return web.json_response({"error": str(e)}, status=500)
+
+    async def process_audio_stats_route(request:web.Request):
+        """/process_audioの結果のキャッシュのヒット・ミスの数"""
+        return web.json_response( llm_cache.stats() )
+
+    async def models_route(request:web.Request):
+        """ワーカー毎のロード済みモデルと、ロード・ウォームアップにかかった時間。loadはセッション毎のデコードした秒数とかかった秒数"""
+        ret:dict = { str(wid):stats for wid,stats in asr_service.model_stats().items() } if asr_service is not None else {}
+        ret['load'] = get_load_controller().stats()
+        ret['admission'] = admission.stats()
+        if whisper_pool is not None:
+            ret['pool'] = whisper_pool.stats()
+        if isinstance(asr_service,RemoteAsrService):
+            ret['nodes'] = asr_service.node_stats()
+        return web.json_response( ret )
+
+    app.router.add_post('/process_audio', process_audio_route)
+    app.router.add_get('/process_audio/stats', process_audio_stats_route)
+    async def capacity_route(request:web.Request):
+        """WMのモデル毎に、このホストで何セッションまで持つかの見積もり(?backend=でエンジンを指定)"""
+        return web.json_response( admission.report( request.query.get('backend') or None ) )
+
+    def read_recording(stream_id:str, seq:int|None) ->list[tuple[int,float,float]]|bytes|None:
+        path = recording_dir(stream_id)
+        if path is None or not os.path.isdir(path):
+            return None
+        reader = RecordingReader(path)
+        if seq is None:
+            return reader.segments()
+        pcm = reader.segment_audio(seq)
+        return audio_to_wave_bytes( np.frombuffer(pcm,dtype=np.int16), sampling_rate=SAMPLE_RATE, ch=1 ) if pcm else None
+
+    async def recording_route(request:web.Request):
+        """履歴の録音にある確定セグメントの一覧 [[seq,開始秒,終了秒],...](秒は録音の先頭から)"""
+        segs = await asyncio.to_thread( read_recording, request.match_info['stream'], None )
+        if segs is None:
+            raise web.HTTPNotFound()
+        return web.json_response( { 'stream': request.match_info['stream'], 'segments': segs } )
+
+    async def recording_segment_route(request:web.Request):
+        """確定セグメントの音声(WAV)。seqは文字起こしの差分のatにある番号"""
+        try:
+            seq = int(request.match_info['seq'])
+        except ValueError:
+            raise web.HTTPNotFound()
+        wav = await asyncio.to_thread( read_recording, request.match_info['stream'], seq )
+        if not isinstance(wav,bytes):
+            raise web.HTTPNotFound()
+        return web.Response( body=wav, content_type='audio/wav' )
+
+    app.router.add_get('/recording/{stream}', recording_route)
+    app.router.add_get('/recording/{stream}/{seq}', recording_segment_route)
+    app.router.add_get('/models', models_route)
+    app.router.add_get('/capacity', capacity_route)
+
+    async def close_running_threads(app:web.Application):
+        """サーバの終了時にセッションとワーカーを止める"""
+        sessions = list(client_sessions.values())
+        client_sessions.clear()
+        for session in sessions:
+            await session.disconnect()
+        if asr_service is not None:
+            await asyncio.to_thread(asr_service.stop)
+        if whisper_pool is not None:
+            await asyncio.to_thread(whisper_pool.stop)
         print("Threads complete, ready to finish")
 
-    #Register the function to be called on exit
-    atexit.register(close_running_threads)
+    app.on_cleanup.append(close_running_threads)
 
-    return app, socketio
+    return app, sio
 
 async def main():
     try:
@@ -347,14 +539,26 @@ async def main():
         # ssl_key='.certs/server.key'
         # ssl_cert='.certs/server.crt'
         # if os.path.exists(ssl_key) and os.path.exists(ssl_cert):
-        #     ssl_context=(ssl_cert,ssl_key)
+        #     ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        #     ssl_context.load_cert_chain(ssl_cert,ssl_key)
         # else:
         #     ssl_context=None
         ssl_context = None
-        app, socketio = await create_app()
-        socketio.run(app, host='0.0.0.0', port=port, ssl_context=ssl_context, debug=True)
+        app, sio = await create_app()
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host='0.0.0.0', port=port, ssl_context=ssl_context)
+        await site.start()
+        print(f"Running on {'https' if ssl_context else 'http'}://0.0.0.0:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
     except Exception as ex:
         print(f"{ex}")
 
 if __name__ == '__main__':
-    asyncio.run( main() )
+    try:
+        asyncio.run( main() )
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,83 @@
+import time
+import uuid
+
+"""
+ブラウザへ送る文字起こしの差分(ev 'transcript')。差分は版を1つずつ上げるので、クライアントの版+1でなければ抜けがある
+    {'v', 'seg', 'add': [text,...], 'at': [[seq,start,end],...], 'tmp': [offset,text]}
+        v: この差分を当てた後の版
+        seg, add: 確定した文と、その最初の文のid(0からの通し番号)。一度送った文は送らない。無ければ省く
+        at: addの文毎の、デコードループのセグメント番号と時刻(秒、audioStartからの音声の位置)。録音があれば /recording/<stream>/<seq> で音声を引ける
+        tmp: 仮の文の差分。前の仮の文の先頭offset文字(UTF-16の単位、JavaScriptの文字列の長さ)を残してtextに置き換える。変わらなければ省く
+        履歴のid(stream)は付けない。クライアントは1つの履歴のルームだけに入り、届いた差分はその履歴のもの
+    {'stream', 'v', 'full': True, 'since', 'seg', 'add', 'at', 'tmp': [0,text], 'key'}
+        送り直し。版sinceより後に確定した文の全てと仮の文(sinceが0なら始めから)。streamは受け取る履歴のid
+        keyは履歴を引き継ぐための鍵で、所有するセッションへの送り直しにだけ付ける(見るだけのクライアントには送らない)
+    クライアントは ev 'transcriptSync' {'stream','since','resume','key'} で送り直しを頼む(再接続や途中から見る場合。streamが無ければ自分の履歴)
+"""
+
+def utf16_len( text:str ) ->int:
+    return len(text.encode('utf-16-le'))//2
+
+class TranscriptStream:
+    """
+    セッションの文字起こし。確定した文と仮の文を持ち、変更の度に版を上げて差分を作る
+    確定した文は全て持つので、どの版からでも送り直せる
+    """
+    def __init__(self, stream_id:str|None=None):
+        self.stream_id:str = stream_id or uuid.uuid4().hex[:8]
+        self.key:str = uuid.uuid4().hex # 引き継ぎの鍵(stream_idはURLで共有するので別に持つ)
+        self.version:int = 0
+        self._segs:list[tuple[int,str]] = [] # (追加した版, 文)。idはインデックス
+        self._at:list[list|None] = [] # 文毎の[seq,start,end]
+        self._tmp:str = ''
+        self.updated:float = time.time()
+
+    @property
+    def next_seq(self) ->int:
+        """続きのセグメントに振る番号(履歴を引き継いだセッションが、録音の索引で前の番号と重ならないように)"""
+        return max( (a[0] for a in self._at if a is not None), default=-1 )+1
+
+    def update(self, fixed:list[str], tmp:list[str], at:list[tuple[int,float,float]]|None=None) ->dict|None:
+        """新しく確定した文と、今の仮の文から差分を作る。変わっていなければNone
+            at: fixedの文毎の(seq,開始秒,終了秒)
+        """
+        keep = [ i for i,t in enumerate(fixed) if t ]
+        add = [ fixed[i] for i in keep ]
+        new_at = [ [at[i][0],round(at[i][1],2),round(at[i][2],2)] for i in keep ] if at is not None else None
+        new_tmp = ' '.join( t for t in tmp if t )
+        if not add and new_tmp==self._tmp:
+            return None
+        self.version += 1
+        first = len(self._segs)
+        self._segs += [ (self.version,t) for t in add ]
+        self._at += new_at if new_at is not None else [None]*len(add)
+        # 前の仮の文と共通の先頭は送らない
+        k = 0
+        n = min(len(self._tmp),len(new_tmp))
+        while k<n and self._tmp[k]==new_tmp[k]:
+            k += 1
+        changed = new_tmp!=self._tmp
+        self._tmp = new_tmp
+        self.updated = time.time()
+        delta:dict = { 'v': self.version }
+        if add:
+            delta |= { 'seg': first, 'add': add }
+            if new_at is not None:
+                delta['at'] = new_at
+        if changed:
+            delta['tmp'] = [ utf16_len(new_tmp[:k]), new_tmp[k:] ]
+        return delta
+
+    def snapshot(self, since:int=0) ->dict:
+        """版sinceより後に確定した文と、今の仮の文(sinceが0か範囲外なら始めから)"""
+        if since<=0 or since>self.version:
+            since = 0
+        first = next( (i for i,(v,_) in enumerate(self._segs) if v>since), len(self._segs) )
+        ret:dict = { 'stream': self.stream_id, 'v': self.version, 'full': True, 'since': since,
+                     'seg': first, 'add': [ t for _,t in self._segs[first:] ], 'tmp': [0,self._tmp] }
+        if any( a is not None for a in self._at ):
+            ret['at'] = self._at[first:]
+        return ret
+
+    def text(self) ->str:
+        return ' '.join( t for _,t in self._segs )
@@ -0,0 +1,215 @@
+import os
+import threading
+from multiprocessing import Process, Value, Array, Queue
+
+from shm_ring import ShmRing, ShmAudioStore
+from model_registry import get_registry
+from whisper_transcribe import MlxWhisperProcess, SAMPLE_RATE
+
+def _worker_main( wid:int, job_queue:Queue, loaded, share_id, share_stop, share_vad, audio_ring:ShmRing, audio_store:ShmAudioStore, ctrl_queue:Queue, stdout:Queue, preload:list[str] ):
+    """プールのワーカープロセス。モジュールのimportとモデルのロードを済ませて、セッションが届くのを待つ
+        job: (session, lang, logfile, window, pcm, record_dir, backend, policy, vad) / None で終了
+        セッションが終わったら(デコードループが終了マーカーを送ったら)次のjobを待つ
+    """
+    print(f"[WhisperPool]{wid} start")
+    try:
+        registry = get_registry()
+        registry.preload(preload)
+        loaded.value = 1
+        while (job := job_queue.get()) is not None:
+            session, lang, logfile, window, pcm, record_dir, backend, policy, vad = job
+            MlxWhisperProcess._th_transcribe( share_id, share_stop, share_vad if vad else None, audio_ring, ctrl_queue, stdout, lang, logfile, window, pcm, record_dir,
+                                              models=registry, backend=backend, policy=policy, audio_store=audio_store, session=session, pooled=True )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        audio_ring.close()
+        audio_store.close()
+        print(f"[WhisperPool]{wid} end")
+
+class PooledWorker:
+    """
+    プールの1ワーカー。セッションとの受け渡しに使う共有メモリとキューはワーカーが持ち、
+    セッション(MlxWhisperProcess)はstart()からstop()まで借りて使う
+    """
+    def __init__(self, wid:int, *, store_sec:int, preload:list[str]):
+        self.wid:int = wid
+        self.audio_ring:ShmRing = ShmRing( 4*1024*1024 )
+        self.audio_store:ShmAudioStore = ShmAudioStore( SAMPLE_RATE*store_sec )
+        self.share_stop = Value('i',0)
+        self.share_id = Value('i',0)
+        self.share_vad = Array('d',2)
+        self.ctrl_queue:Queue = Queue()
+        self.stdout:Queue = Queue()
+        self.job_queue:Queue = Queue()
+        self.loaded = Value('i',0) # 先読みのモデルのロードが終わったら1
+        self.leased:bool = False
+        self.warm:bool = False # 貸し出した時にロードが終わっていたか
+        self.sessions:int = 0
+        self.proc:Process = Process( target=_worker_main, name=f'whisperpool{wid}', daemon=True,
+                                     args=(wid, self.job_queue, self.loaded, self.share_id, self.share_stop, self.share_vad, self.audio_ring, self.audio_store, self.ctrl_queue, self.stdout, preload) )
+        self.proc.start()
+
+    def is_alive(self) ->bool:
+        """セッションに貸し出していて、プロセスが動いているか"""
+        return self.leased and self.proc.is_alive()
+
+    def run(self, session:str, lang:str, logfile:str|None, window:tuple[float,float]|None, pcm:bool, record_dir:str|None, backend:str|None, policy:str|None, vad:bool):
+        """セッションのデコードループを始める"""
+        self.sessions += 1
+        self.job_queue.put( (session, lang, logfile, window, pcm, record_dir, backend, policy, vad) )
+
+    def reset(self):
+        """次のセッションに渡せるように共有の状態を初期化する"""
+        self.share_stop.value = 0
+        self.share_id.value = 0
+        self.share_vad[0] = self.share_vad[1] = 0.0
+        self.audio_ring.reset()
+        self.audio_store.reset()
+        for q in (self.ctrl_queue,self.stdout):
+            try:
+                while True:
+                    q.get_nowait()
+            except:
+                pass
+
+    def close(self):
+        try:
+            self.job_queue.put(None)
+            self.share_stop.value = 1
+            self.audio_ring.request_stop()
+            self.proc.join(1.0)
+            if self.proc.is_alive():
+                self.proc.terminate()
+                self.proc.join(1.0)
+        except Exception as ex:
+            print(f"[WhisperPool]close {str(ex)}")
+        self.audio_ring.close()
+        self.audio_store.close()
+
+class WhisperPool:
+    """
+    セッション毎のデコードループ(共有の推論サービスを使わない場合)を動かすプロセスを、
+    importとモデルのロードを済ませた状態で起動しておき、セッションのstart()で1つ貸し出す
+    stop()で返されたワーカーは状態を初期化して待機に戻すので、次のセッションはプロセスの起動とモデルのロードを待たない
+    ワーカーの数(待機+貸し出し中)はsize個を保ち、終了したワーカーや終了させたワーカーの分だけ補充する
+    貸し出す時はロードが終わっているワーカーを優先し、待機が空なら新しく起動して渡す(size個を超えた分)
+    size個を超えたら、返されたワーカーより後に起動したもの(まだロード中かもしれない)から終了させる
+    開始から最初の結果が届くまでの秒数を、ロードが終わっていたワーカーか(warm)どうか(cold)で分けて集計する
+    """
+    def __init__(self, *, size:int=2, preload:list[str]=[]):
+        self._size:int = max(0,size)
+        self._preload:list[str] = list(preload)
+        self._store_sec:int = int(os.getenv('ASR_AUDIO_STORE_SEC','120'))
+        self._idle:list[PooledWorker] = []
+        self._busy:dict[int,PooledWorker] = {}
+        self._wid:int = 0
+        self._spawned:int = 0
+        self._retired:int = 0
+        self._latency:dict[str,list[float]] = { 'warm': [], 'cold': [] }
+        self._lock:threading.Lock = threading.Lock()
+        self._closed:bool = False
+
+    @property
+    def size(self) ->int:
+        return self._size
+
+    def _spawn(self) ->PooledWorker:
+        with self._lock:
+            self._wid = ( wid := self._wid+1 )
+            self._spawned += 1
+        return PooledWorker( wid, store_sec=self._store_sec, preload=self._preload )
+
+    def start(self):
+        print(f"[WhisperPool]start {self._size} workers")
+        self._closed = False
+        for _ in range(self._size-len(self._idle)):
+            w = self._spawn()
+            with self._lock:
+                self._idle.append(w)
+
+    def stop(self):
+        self._closed = True
+        with self._lock:
+            workers = self._idle + list(self._busy.values())
+            self._idle = []
+            self._busy = {}
+        for w in workers:
+            w.close()
+
+    def acquire(self) ->PooledWorker:
+        """待機中のワーカーを1つ貸し出す。ワーカーがsize個より少なくなっていたら補充する"""
+        with self._lock:
+            # 待機中に終了したワーカーは捨てる
+            dead = [ w for w in self._idle if not w.proc.is_alive() ]
+            self._idle = [ w for w in self._idle if w.proc.is_alive() ]
+            w = next( (x for x in self._idle if x.loaded.value), self._idle[0] if self._idle else None )
+            if w is not None:
+                self._idle.remove(w)
+        for d in dead:
+            d.close()
+        if w is None:
+            w = self._spawn()
+        w.warm = w.loaded.value==1
+        w.leased = True
+        with self._lock:
+            self._busy[w.wid] = w
+            refill = self._short()
+        if refill:
+            # 次のセッションのために補充しておく(forkは待たない)
+            threading.Thread( target=self._refill, name='whisperpool_refill', daemon=True ).start()
+        return w
+
+    def _short(self) ->bool:
+        """ワーカーがsize個より少ないか(ロックの中で呼ぶ)"""
+        return not self._closed and len(self._idle)+len(self._busy)<self._size
+
+    def _refill(self):
+        w = self._spawn()
+        with self._lock:
+            if self._short():
+                self._idle.append(w)
+                return
+        w.close()
+
+    def release(self, w:PooledWorker, *, clean:bool=True):
+        """セッションが終わったワーカーを返す
+            clean: デコードループの終了を確認できたか。Falseならまだ動いているかもしれないので終了させる
+        """
+        w.leased = False
+        retire:list[PooledWorker] = []
+        with self._lock:
+            self._busy.pop(w.wid,None)
+            if clean and not self._closed and w.proc.is_alive() and self._size>0:
+                w.reset()
+                self._idle.append(w)
+                # 古い(ロードが済んでいる)ものを残す
+                self._idle.sort( key=lambda x: x.wid )
+                keep = max(0,self._size-len(self._busy))
+                retire = self._idle[keep:]
+                del self._idle[keep:]
+            else:
+                retire = [w]
+            self._retired += len(retire)
+            refill = self._short()
+        if refill:
+            threading.Thread( target=self._refill, name='whisperpool_refill', daemon=True ).start()
+        if retire:
+            # 終了はロード中だと待たされるので、呼び出し元(stop)は待たせない
+            threading.Thread( target=lambda: [ x.close() for x in retire ], name='whisperpool_retire', daemon=True ).start()
+
+    def record_first_result(self, w:PooledWorker, sec:float):
+        """start()から最初の結果が届くまでの秒数"""
+        with self._lock:
+            lat = self._latency['warm' if w.warm else 'cold']
+            lat.append(sec)
+            del lat[:-100]
+
+    def stats(self) ->dict:
+        with self._lock:
+            ret:dict = { 'size': self._size, 'idle': len(self._idle), 'busy': len(self._busy), 'spawned': self._spawned, 'retired': self._retired }
+            for k,lat in self._latency.items():
+                if lat:
+                    x = sorted(lat)
+                    ret[f'first_result_{k}'] = { 'n': len(x), 'p50': round(x[len(x)//2],3), 'max': round(x[-1],3) }
+            return ret
@@ -9,24 +9,33 @@ from io import BytesIO
 from io import BufferedReader
 import subprocess
 from subprocess import Popen
-from multiprocessing import Process, Value, Array, Manager, Queue
+from multiprocessing import Process, Value, Array, Manager, Queue, parent_process
 from queue import Empty
 #from multiprocessing.connection import Connection
 import threading
 from threading import Thread
+from functools import partial
 import numpy as np
 from numpy.typing import NDArray
 
-from typing import Optional
+from typing import Optional, Callable, TYPE_CHECKING
 import os
 from logging import getLogger, Logger, StreamHandler, FileHandler, Formatter,  DEBUG as LV_DEBUG, INFO as LV_INFO, WARN as LV_WARN
 
-try:
-    import mlx.core as mx
-    import mlx_whisper
-    USE_MLX_WHISPER:bool = True
-except:
-    USE_MLX_WHISPER:bool = False
+from session_recorder import RecordingSink
+from shm_ring import ShmRing, ShmAudioStore
+from rec_util import EnergyVad, AudioRingBuffer
+from audio_format import sniff_audio
+from model_registry import get_registry, ModelRegistry
+from asr_backend import BACKENDS, join_model, default_backend, get_tokenizer
+from stabilization import HeuristicPolicy, make_policy
+from prompt_context import PromptContext
+from load_controller import get_load_controller
+
+if TYPE_CHECKING:
+    from asr_service import AsrService
+    from asr_remote import RemoteAsrService
+    from whisper_pool import WhisperPool, PooledWorker
 
 # tiny base small medium large
 WHISPER_MODEL_TINY_EN = "mlx-community/whisper-tiny.en-mlx-q4"
@@ -53,9 +62,30 @@ WM = {
     'small': ("mlx-community/whisper-small-mlx-q4",''),
     'medium': ("mlx-community/whisper-medium-mlx-q4",''),
     'large': ("mlx-community/whisper-large-v3-turbo-q4",''),
+
+    # CPU(faster-whisper int8)用。言語の別名をこちらに向ければ、その言語だけCPUで認識する
+    'kotoba.cpu': ("cpu:kotoba-tech/kotoba-whisper-v1.0-faster",'ja'),
+    'tiny.ja.cpu': ("cpu:tiny",'ja'),
+    'base.ja.cpu': ("cpu:base",'ja'),
+    'small.ja.cpu': ("cpu:small",'ja'),
+    'medium.ja.cpu': ("cpu:medium",'ja'),
+    'large.ja.cpu': ("cpu:large-v3-turbo",'ja'),
+
+    'tiny.en.cpu': ("cpu:tiny.en",'en'),
+    'base.en.cpu': ("cpu:base.en",'en'),
+    'small.en.cpu': ("cpu:small.en",'en'),
+
+    'tiny.cpu': ("cpu:tiny",''),
+    'base.cpu': ("cpu:base",''),
+    'small.cpu': ("cpu:small",''),
+    'medium.cpu': ("cpu:medium",''),
+    'large.cpu': ("cpu:large-v3-turbo",''),
 }
 
-def lang_to_model(lang:str|None)->tuple[str,str]:
+def _model_key(lang:str|None) ->tuple[str,tuple]:
+    """言語(かWMのキー)の別名を辿って、WMのキーと値を返す"""
+    key = 'tiny.en'
+    ret:str|tuple|None = (WHISPER_MODEL_TINY_EN,'off')
     if lang is not None and lang.strip()!='' and lang!='off':
         ret = lang.lower()
         if ret.startswith('en-'):
@@ -63,10 +93,67 @@ def lang_to_model(lang:str|None)->tuple[str,str]:
         elif ret.startswith('ja-'):
             ret='ja'
         while isinstance(ret,str):
+            key = ret
             ret = WM.get(ret)
-        if isinstance(ret,tuple):
-            return ret
-    return WHISPER_MODEL_TINY_EN,'off'
+    if not isinstance(ret,tuple):
+        key = 'tiny.en'
+        ret = (WHISPER_MODEL_TINY_EN,'off')
+    return key, ret
+
+def lang_to_model(lang:str|None, backend:str|None=None)->tuple[str,str]:
+    """言語(かWMのキー)からモデルと言語を決める
+        backend: セッションで選んだエンジン。Noneなら、WMの指定か既定のエンジン(default_backend)
+    """
+    if backend is None and default_backend()!='mlx':
+        backend = default_backend()
+    key, ret = _model_key(lang)
+    if backend is not None and backend in BACKENDS:
+        # 同じモデルの別エンジン版に置き換える
+        base = key.removesuffix('.cpu')
+        if backend=='fake':
+            alt = WM.get(base)
+            return join_model('fake', alt[0] if isinstance(alt,tuple) else ret[0]), ret[1]
+        alt = WM.get( base if backend=='mlx' else f"{base}.{backend}" )
+        if isinstance(alt,tuple):
+            return alt[0], ret[1]
+    return ret[0], ret[1]
+
+# 負荷が高いときに下げていくモデルの大きさの順(kotobaはlarge-v3の蒸留なのでlargeの段とする)
+MODEL_SIZES:list[str] = ['large','medium','small','base','tiny']
+MODEL_SIZE_ALIAS:dict[str,str] = { 'kotoba': 'large.ja' }
+
+def ladder_keys(lang:str|None) ->list[str]:
+    """言語(かWMのキー)で選ばれるWMのキーと、同じ言語の小さいモデルのキーを大きい順に並べたリスト"""
+    key, _ = _model_key(lang)
+    cpu = key.endswith('.cpu')
+    base = key.removesuffix('.cpu')
+    size, _, suffix = MODEL_SIZE_ALIAS.get(base,base).partition('.')
+    ret:list[str] = [key]
+    if size not in MODEL_SIZES:
+        return ret
+    for smaller in MODEL_SIZES[MODEL_SIZES.index(size)+1:]:
+        k = f"{smaller}.{suffix}" if suffix else smaller
+        if cpu:
+            k += '.cpu'
+        if isinstance(WM.get(k),tuple):
+            ret.append(k)
+    return ret
+
+def model_size(key:str) ->str|None:
+    """WMのキーのモデルの大きさ(MODEL_SIZESのどれか)"""
+    base = key.removesuffix('.cpu')
+    size = MODEL_SIZE_ALIAS.get(base,base).partition('.')[0]
+    return size if size in MODEL_SIZES else None
+
+def model_ladder(lang:str|None, backend:str|None=None) ->list[tuple[str,str]]:
+    """言語(かWMのキー)で選ばれるモデルから、同じ言語の小さいモデルへ順に並べた(モデル,言語)のリスト"""
+    top = lang_to_model(lang,backend)
+    ret:list[tuple[str,str]] = [top]
+    for k in ladder_keys(lang)[1:]:
+        m = lang_to_model(k,backend)
+        if all( m[0]!=r[0] for r in ret ):
+            ret.append( (m[0],top[1]) )
+    return ret
 
 SAMPLE_RATE=16000
 _pcm_counter = 0
@@ -121,8 +208,9 @@ Example Output:
 """
 
 class Seg:
-    """transcribeの結果にisFixedフラグを追加したクラス"""
-    def __init__(self, id:int, seek:int, start:float, end:float, text:str, avg_logprob:float, compression_ratio:float, no_speech_prob:float, audio:NDArray[np.float32]):
+    """transcribeの結果にisFixedフラグを追加したクラス。音声は持たず、時刻からセッションの音声を引く"""
+    __slots__ = ('tid','seek','start','end','text','isFixed','avg_logprob','compression_ratio','no_speech_prob')
+    def __init__(self, id:int, seek:int, start:float, end:float, text:str, avg_logprob:float, compression_ratio:float, no_speech_prob:float):
         self.tid:int =id
         self.seek: int = seek
         self.start:float = start
@@ -132,7 +220,10 @@ class Seg:
         self.avg_logprob = avg_logprob
         self.compression_ratio:float = compression_ratio
         self.no_speech_prob:float = no_speech_prob
-        self.audio:NDArray[np.float32] = audio
+    def shift(self, sec:float):
+        """バッファの移動に合わせて時刻をずらす"""
+        self.start += sec
+        self.end += sec
     def json(self):
         return {'seek': self.seek, 'start':self.start, 'end':self.end, 'isFixed':self.isFixed, 'text': self.text,
                  'prob':self.avg_logprob, 'comp':self.compression_ratio, 'no_speech':self.no_speech_prob }
@@ -166,29 +257,20 @@ class Seg:
         
 class TextSeg(NamedTuple):
     seq:int
-    start:float
+    start:float # セッションの音声の先頭からの秒数
     end:float
     text:str
-    audio:NDArray[np.float32]
+    s0:int # 音声の範囲(前後に0.1秒の余白を付けた、セッションの先頭からのサンプル数)。MlxWhisperProcess.segment_audio()で取り出す
+    s1:int
 
 def transcribe(audio:np.ndarray, *, model:str=WHISPER_MODEL_TINY_EN, lang:str='', prompt:str|None=None,logger:Logger|None=None) -> list[Seg]:
-
-    if not USE_MLX_WHISPER:
-        return []
+    """modelの接頭辞で選んだエンジン(asr_backend)で推論する。モデルはレジストリのロード済みのものを使う"""
     xlang = lang if lang!='' else None
     t0 = time.time()
-    result = mlx_whisper.transcribe(
-        audio, path_or_hf_repo=model,
-        language=xlang,
-        prompt=prompt,
-        #hallucination_silence_threshold=0.5,
-        no_speech_threshold=0.2,
-        fp16=False,
-        verbose=None)
+    segs = get_registry().transcribe( model, audio, lang=xlang, prompt=prompt )
     if logger is not None:
         t0 = time.time()-t0
         logger.info(f"[transcribe] elaps time {t0:.3f}/{len(audio)/SAMPLE_RATE:.3f}sec")
-    segs = result.get("segments") if isinstance(result,dict) else None
     ret = []
     if isinstance(segs,list):
         for seg in segs:
@@ -201,12 +283,22 @@ def transcribe(audio:np.ndarray, *, model:str=WHISPER_MODEL_TINY_EN, lang:str=''
             compression_ratio=seg.get('compression_ratio')
             no_speech_prob=seg.get('no_speech_prob')
             if Seg.is_recog_success(text,avg_logprob,compression_ratio,no_speech_prob):
-                s = max(0,int((start-0.1)*SAMPLE_RATE))
-                e = max(int((end+0.1)*SAMPLE_RATE),len(audio))
-                b = audio[s:e].copy()
-                ret.append(Seg(id,seek,start,end,text,avg_logprob,compression_ratio,no_speech_prob,b))
-    else:
-        print(f"ERROR:result={result}")
+                ret.append(Seg(id,seek,start,end,text,avg_logprob,compression_ratio,no_speech_prob))
+    return ret
+
+def merge_window_segments( keep:list[Seg], window:list[Seg], offset_sec:float ) ->list[Seg]:
+    """ウィンドウだけデコードした結果を、再利用する前回の仮説の後ろに繋げる
+        keep: 再利用する前回のセグメント(バッファ先頭基準の時刻)
+        window: ウィンドウ先頭基準の時刻のセグメント
+        offset_sec: バッファ先頭からウィンドウ先頭までの秒数
+    """
+    boundary:float = keep[-1].end if keep else 0.0
+    ret:list[Seg] = list(keep)
+    for seg in window:
+        seg.shift(offset_sec)
+        # オーバーラップ部分は前回の仮説を優先する
+        if (seg.start+seg.end)*0.5 > boundary:
+            ret.append(seg)
     return ret
 
 async def async_ffmpeg() ->SubProcess:
@@ -244,7 +336,99 @@ def popen_ffmpeg() ->Popen:
     ffmpeg_process = Popen(cmdline,bufsize=bufsz,pipesize=bufsz, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return ffmpeg_process
 
+class PcmPipe:
+    """ffmpegを通さずに16kHz mono int16のPCMを受け渡すパイプ(ffmpegのstdin/stdoutの代わり)"""
+    def __init__(self):
+        self._buf:bytearray = bytearray()
+        self._cv:threading.Condition = threading.Condition()
+        self._eof:bool = False
+        self.closed:bool = False
+
+    def write(self, data:bytes) ->int:
+        with self._cv:
+            self._buf.extend(data)
+            self._cv.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """書き込み側を閉じる。読み込み側は残りを読み終えたらEOF(b'')になる"""
+        with self._cv:
+            self._eof = True
+            self._cv.notify_all()
+
+    def read(self, size:int) ->bytes:
+        """sizeバイト揃うかEOFになるまで待つ"""
+        with self._cv:
+            while len(self._buf)<size and not self._eof:
+                self._cv.wait()
+            ret = bytes(self._buf[:size])
+            del self._buf[:size]
+            return ret
+
+class PcmBuffer:
+    """
+    ffmpeg(かPcmPipe)の出力を読み続けるスレッドと、デコードループの間の有界のPCMバッファ
+    読み込みスレッドはデコード中も読み続けるので、ffmpegのパイプが詰まって入力が止まることが無い
+    一杯になったら読み込みスレッドが待つ(capacityはデコードが追いつかないときに溜める上限)
+    """
+    def __init__(self, capacity:int):
+        self.capacity:int = capacity
+        self._buf:bytearray = bytearray()
+        self._cv:threading.Condition = threading.Condition()
+        self._eof:bool = False
+        self.peak:int = 0 # 溜まったバイト数の最大
+
+    def used(self) ->int:
+        return len(self._buf)
+
+    def put(self, data:bytes):
+        """読み込みスレッドから追加する。空きが無ければ空くか閉じられるまで待つ"""
+        with self._cv:
+            while len(self._buf)+len(data)>self.capacity and not self._eof:
+                self._cv.wait()
+            if self._eof:
+                return
+            self._buf.extend(data)
+            self.peak = max(self.peak,len(self._buf))
+            self._cv.notify_all()
+
+    def close(self):
+        """EOF。残りを取り出し終えたらtake()はb''を返す"""
+        with self._cv:
+            self._eof = True
+            self._cv.notify_all()
+
+    def wait(self, min_size:int):
+        """min_sizeバイト溜まるかEOFになるまで待つ"""
+        with self._cv:
+            while len(self._buf)<min_size and not self._eof:
+                self._cv.wait()
+
+    def readinto(self, b:memoryview) ->int:
+        """溜まっている分をbの長さまでコピーして取り出す(待たない。サンプルの途中では切らない)"""
+        with self._cv:
+            n = min(len(self._buf),len(b)) & ~1
+            b[:n] = memoryview(self._buf)[:n]
+            del self._buf[:n]
+            if self._eof and len(self._buf)<2:
+                self._buf.clear() # EOFの前の半端なバイトは捨てる
+            self._cv.notify_all()
+            return n
+
 async def check_audio(audio:bytes,size:int) ->str:
+    """音声を受け付けるか判定する。return: ''なら受け付ける、それ以外はエラーメッセージ
+        ヘッダでコンテナとコーデックが分かればffmpegを起動しない
+    """
+    fmt = sniff_audio(audio)
+    if fmt is not None:
+        return fmt.error
+    return await check_audio_ffmpeg(audio,size)
+
+async def check_audio_ffmpeg(audio:bytes,size:int) ->str:
+    """ffmpegで実際に変換して判定する(遅い)"""
     try:
         proc:SubProcess = await async_ffmpeg()
         if proc is None:
@@ -286,34 +470,101 @@ async def check_audio(audio:bytes,size:int) ->str:
         return f"Exception:{str(ex)}"
 
 class MlxWhisperProcess:
-    def __init__(self, *, logfile:str|None=None):
+    """
+    incremental: Trueなら確定位置以降の一定幅(window_sec)とオーバーラップ(overlap_sec)だけをデコードし、
+                 それより前は前回の仮説を再利用する
+    service: 共有の推論サービス。指定するとセッション毎のプロセスを起動せず、
+             デコードループをスレッドで動かしてモデル呼び出しだけをserviceに投げる(別のマシンのノードならRemoteAsrService)
+    vad: Trueなら発話検出で無音区間のデコードを省き、発話の切れ目を確定位置の判定に使う
+    policy: 確定位置を決める方針の名前(stabilization.POLICIES)。Noneなら従来の判定
+    on_event: デコードループからの通知(使っているモデルの変更等)を受け取る関数 (msg,data)。read()の中から呼ぶ
+    pool: serviceを使わない場合に、起動済みのワーカー(WhisperPool)を借りてデコードループを動かす。
+          共有メモリとキューはstart()からstop()までワーカーのものを使う
+    """
+    def __init__(self, *, logfile:str|None=None, incremental:bool=False, window_sec:float=10.0, overlap_sec:float=1.0, service:"AsrService|RemoteAsrService|None"=None, vad:bool=True,
+                 policy:str|None=None, on_event:Callable[[str,dict],None]|None=None, pool:"WhisperPool|None"=None):
         self._transcribe_closed:bool = False
-        self._whisper_process = None
-        self._share_bufsz = Array('i',4)
+        self._whisper_process:"Process|Thread|PooledWorker|None" = None
+        self._service:"AsrService|RemoteAsrService|None" = service
+        self._pool:"WhisperPool|None" = pool if service is None else None
+        self._worker:"PooledWorker|None" = None
+        # 音声のリングと、デコードした音声の直近を保持するストアはstart()で用意する(接続しただけのセッションはメモリを使わない)
+        self._audio_ring:ShmRing|None = None
+        self._audio_store:ShmAudioStore|None = None
+        # リングに書き込むのは1つのスレッドだけにする(stop()の後は書き込まない)
+        self._input_lock:threading.Lock = threading.Lock()
+        self._input_closed:bool = True
+        self._overruns:int = 0
+        self._share_stop = Value('i',0)
         self._share_id = Value('i',0)
+        self._share_vad = Array('d',2) if vad else None # デコードを省いた秒数, デコードした秒数
+        self._policy:str|None = policy
+        self._on_event:Callable[[str,dict],None]|None = on_event
         self._transcribe_queue:Queue[tuple[list[TextSeg],list[str]]] = Queue()
-        self._audio_queue:Queue = Queue()
+        self._ctrl_queue:Queue = Queue()
+        self._bridge_thread:Thread|None = None
+        self._bridge_queue:asyncio.Queue|None = None
         self._logfile:str|None = logfile
         self._language = 'off'
+        self._backend:str|None = None
+        self._record_dir:str|None = None
+        self._incremental:bool = incremental
+        self._window_sec:float = window_sec
+        self._overlap_sec:float = overlap_sec
+        self._t_start:float = 0.0
+        self._first_result:float|None = None
 
-    def set_language(self, lang: str):
-        """言語設定を更新する"""
+    def set_language(self, lang: str, backend:str|None=None):
+        """言語設定を更新する
+            backend: 音声認識エンジン(asr_backend)。Noneなら言語毎の既定
+        """
         self._language = lang
+        self._backend = backend
         if self._whisper_process and self._whisper_process.is_alive():
             # 言語設定を更新するためにキューに特別なメッセージを送信
-            print(f"request lang={lang}")
-            self._audio_queue.put(('set_language', lang))
+            print(f"request lang={lang} backend={backend}")
+            self._ctrl_queue.put(('set_language', lang, backend))
         else:
             print(f"set lang={lang}")
 
-    def append_audio(self, seq:int, typ:str, data: bytes) ->float:
-        if isinstance(data,bytes) and len(data)>0 and self._whisper_process and self._whisper_process.is_alive():
-            #print(f"[AUdio]{seq},{typ}")
-            self._audio_queue.put(data)
-            self._share_bufsz[0] += len(data)
-            time.sleep(0.01)
+    def set_recording(self, path:str|None):
+        """録音先のディレクトリを設定する(Noneなら録音しない)。次のstart()から有効"""
+        self._record_dir = path
+
+    def set_next_seq(self, seq:int):
+        """次に確定するセグメントの番号(録音の索引の番号)。次のstart()から有効"""
+        if self._whisper_process is None or not self._whisper_process.is_alive():
+            self._share_id.value = seq
+
+    @property
+    def vad_stats(self) ->tuple[float,float]:
+        """(発話が無いのでデコードしなかった音声の秒数, デコードした音声の秒数)"""
+        if self._share_vad is None:
+            return (0.0,0.0)
+        return (self._share_vad[0],self._share_vad[1])
+
+    @property
+    def first_result_sec(self) ->float|None:
+        """start()から最初の結果が届くまでの秒数(まだ届いていなければNone)"""
+        return self._first_result
+
+    @property
+    def overruns(self) ->int:
+        """リングが一杯で捨てた音声の数"""
+        return self._overruns
+
+    def append_audio(self, seq:int, typ:str, data:bytes|memoryview) ->float:
+        """音声をリングに書き込む。ワーカーが追いつかずに空きが無ければ待たずに捨てる(overrunsが増える)
+            return: 未処理の音声のサイズ(MB)
+        """
+        with self._input_lock:
+            if isinstance(data,(bytes,memoryview)) and len(data)>0 and not self._input_closed and self._whisper_process and self._whisper_process.is_alive() and self._audio_ring is not None:
+                #print(f"[AUdio]{seq},{typ}")
+                if not self._audio_ring.put(data, timeout=0.0):
+                    self._overruns += 1
+                    print(f"[Whisper]audio overrun {self._overruns} used:{self._audio_ring.used()}")
         try:
-            b = self._share_bufsz[0] - self._share_bufsz[1]
+            b = self._audio_ring.used()
             if b<=0:
                 return 0
             elif b<1049:
@@ -325,73 +576,211 @@ class MlxWhisperProcess:
             return 0.0
 
     def close_audio(self):
-        if self._whisper_process and self._whisper_process.is_alive():
-            self._audio_queue.put(b'')
-            time.sleep(0.01)
+        """入力の終わり(EOF)を書き込む。append_audio()と同じスレッドから呼ぶ"""
+        with self._input_lock:
+            if not self._input_closed and self._whisper_process and self._whisper_process.is_alive() and self._audio_ring is not None:
+                self._input_closed = True
+                self._audio_ring.put(b'', timeout=1.0)
+
+    def close(self):
+        """停止して共有メモリを解放する(以後は使えない)"""
+        self.stop()
+        if self._pool is None and self._audio_ring is not None and self._audio_store is not None:
+            self._audio_ring.close()
+            self._audio_store.close()
+
+    def segment_audio(self, seg:TextSeg) ->NDArray[np.float32]|None:
+        """確定セグメントの音声を取り出す。保持期間(ASR_AUDIO_STORE_SEC)を過ぎているか、プールのワーカーを返した後ならNone"""
+        if self._audio_store is None:
+            return None
+        pcm = self._audio_store.read(seg.s0,seg.s1)
+        if pcm is None:
+            return None
+        return pcm.astype(np.float32) / 32768.0
+
+    def _start_bridge(self):
+        """結果キューをブロッキングで読み、asyncioのキューへ通知するスレッドを起動する"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        aqueue:asyncio.Queue = asyncio.Queue()
+        def bridge():
+            while True:
+                data = self._transcribe_queue.get()
+                loop.call_soon_threadsafe( aqueue.put_nowait, data )
+                if isinstance(data,str):
+                    break # 終了マーカー
+        self._bridge_queue = aqueue
+        self._bridge_thread = Thread( target=bridge, name='whisper_result', daemon=True )
+        self._bridge_thread.start()
+
+    def _stop_bridge(self):
+        if self._bridge_thread is not None:
+            if self._bridge_thread.is_alive():
+                self._transcribe_queue.put( "None" )
+                self._bridge_thread.join(1.0)
+            self._bridge_thread = None
 
-    async def read(self,*,timeout:float=3.0) ->tuple[list[str],list[str]]|None:
-        while not self._transcribe_closed:
+    async def read(self,*,timeout:float=3.0,segments:bool=False) ->tuple[list[str],list[str]]|tuple[list[TextSeg],list[str]]|None:
+        """結果が届くまで待つ。timeout毎に終了フラグを確認する
+            segments: Trueなら確定した文をTextSeg(番号と時刻付き)で返す
+        """
+        if self._bridge_queue is None:
+            self._start_bridge()
+        aqueue = self._bridge_queue
+        while not self._transcribe_closed and aqueue is not None:
             try:
-                data = self._transcribe_queue.get_nowait()
-                if data is not None:
-                    if isinstance(data,tuple):
-                        a,b = data
-                        aa = [ x.text for x in a]
-                        return (aa,b)
-                    else:
-                        self._transcribe_closed = True
-            except Empty:
-                pass
-            await asyncio.sleep(0.2)
+                data = await asyncio.wait_for( aqueue.get(), timeout )
+            except asyncio.TimeoutError:
+                continue
+            if isinstance(data,tuple):
+                a,b = data
+                if self._first_result is None:
+                    self._first_result = time.time()-self._t_start
+                    mode = ('warm' if self._worker.warm else 'cold') if self._worker is not None else ('thread' if self._service else 'process')
+                    print(f"[Whisper]first result {self._first_result:.2f}sec {mode}")
+                    if self._pool is not None and self._worker is not None:
+                        self._pool.record_first_result( self._worker, self._first_result )
+                if segments:
+                    return (a,b)
+                aa = [ x.text for x in a]
+                return (aa,b)
+            elif isinstance(data,dict):
+                # デコードループからの通知 {'ev':msg, 'data':data}
+                if self._on_event is not None:
+                    try:
+                        self._on_event( data.get('ev',''), data.get('data',{}) )
+                    except Exception as ex:
+                        print(f"[Whisper]on_event {str(ex)}")
+            else:
+                self._transcribe_closed = True
         return None
 
-    def start(self):
+    def start(self, *, pcm:bool=False):
+        """pcm: Trueなら16kHz mono int16のPCMを受け取り、ffmpegを起動しない"""
         # start whisper
         if self._whisper_process is None or not self._whisper_process.is_alive():
-            print(f"[Whisper]start process")
-            self._share_bufsz[0] = 0
-            self._share_bufsz[1] = 0
-            self._share_bufsz[2] = 0
-            self._share_bufsz[3] = 0
-            try:
-                while True:
-                    self._audio_queue.get_nowait()
-            except:
-                pass
-            self._whisper_process = Process(target=self._th_transcribe, name='mlxwhisper', args=(self._share_id, self._share_bufsz,self._audio_queue,self._transcribe_queue, self._language, self._logfile))
-            self._whisper_process.start()
+            print(f"[Whisper]start {'thread' if self._service else 'pool' if self._pool else 'process'} {'pcm' if pcm else 'ffmpeg'}")
+            self._transcribe_closed = False
+            self._stop_bridge()
+            if self._pool is not None:
+                self._lease()
+            elif self._audio_ring is None:
+                # デコードループを子プロセスで動かす場合だけ共有メモリにする(スレッドなら同じプロセスのメモリで足りる)
+                shared = self._service is None
+                self._audio_ring = ShmRing( 4*1024*1024, shared=shared )
+                # デコードした音声の直近を保持して、確定セグメントの音声は位置だけを渡す
+                self._audio_store = ShmAudioStore( SAMPLE_RATE*int(os.getenv('ASR_AUDIO_STORE_SEC','120')), shared=shared )
+            self._share_stop.value = 0
+            self._overruns = 0
+            if self._share_vad is not None:
+                self._share_vad[0] = self._share_vad[1] = 0.0
+            if self._audio_ring is not None and self._audio_store is not None:
+                self._audio_ring.reset()
+                self._audio_store.reset()
+            for q in (self._ctrl_queue,self._transcribe_queue):
+                try:
+                    while True:
+                        q.get_nowait()
+                except:
+                    pass
+            self._bridge_queue = None
+            self._start_bridge()
+            self._input_closed = False
+            self._t_start = time.time()
+            self._first_result = None
+            window = (self._window_sec,self._overlap_sec) if self._incremental else None
+            if self._service is not None:
+                # モデルは共有サービスが持つので、セッションの状態だけをスレッドで処理する
+                self._whisper_process = Thread(target=self._th_transcribe, name='mlxwhisper', daemon=True,
+                                               args=(self._share_id, self._share_stop, self._share_vad, self._audio_ring, self._ctrl_queue,self._transcribe_queue, self._language, self._logfile, window, pcm, self._record_dir, partial(self._service.transcribe,session=f"{id(self)}"), self._service),
+                                               kwargs={'backend': self._backend, 'policy': self._policy, 'audio_store': self._audio_store, 'session': f"{id(self)}"})
+                self._whisper_process.start()
+            elif self._worker is not None:
+                # 待機していたワーカーでデコードループを始める(importとモデルのロードは済んでいる)
+                self._worker.run( f"{id(self)}", self._language, self._logfile, window, pcm, self._record_dir, self._backend, self._policy, self._share_vad is not None )
+                self._whisper_process = self._worker
+            else:
+                self._whisper_process = Process(target=self._th_transcribe, name='mlxwhisper',
+                                                args=(self._share_id, self._share_stop, self._share_vad, self._audio_ring, self._ctrl_queue,self._transcribe_queue, self._language, self._logfile, window, pcm, self._record_dir),
+                                                kwargs={'backend': self._backend, 'policy': self._policy, 'audio_store': self._audio_store, 'session': f"{id(self)}"})
+                self._whisper_process.start()
+
+    def _lease(self):
+        """プールからワーカーを借りて、共有メモリとキューをワーカーのものに切り替える"""
+        if self._pool is None:
+            return
+        if self._worker is not None:
+            # 借りたままのワーカーが終了していた
+            self._release(clean=False)
+        w = self._pool.acquire()
+        w.share_id.value = self._share_id.value # 確定セグメントの番号はセッションで続ける
+        self._worker = w
+        self._audio_ring = w.audio_ring
+        self._audio_store = w.audio_store
+        self._share_stop = w.share_stop
+        if self._share_vad is not None:
+            self._share_vad = w.share_vad
+        self._ctrl_queue = w.ctrl_queue
+        self._transcribe_queue = w.stdout
+
+    def _release(self, clean:bool):
+        """ワーカーをプールに返す。共有メモリは次のセッションが使うので、このセッションからは見えなくする"""
+        w = self._worker
+        if self._pool is None or w is None:
+            return
+        self._worker = None
+        self._share_id.value = w.share_id.value
+        self._audio_ring = None
+        self._audio_store = None
+        self._share_stop = Value('i',1)
+        if self._share_vad is not None:
+            vad = Array('d',2)
+            vad[0],vad[1] = w.share_vad[0],w.share_vad[1]
+            self._share_vad = vad
+        self._ctrl_queue = Queue()
+        self._transcribe_queue = Queue()
+        self._pool.release( w, clean=clean )
+
+    def _wait_end(self, timeout:float) ->bool:
+        """デコードループの終了マーカーが届くまで待つ(届いていれば、キューにこのセッションの結果は残っていない)"""
+        if self._bridge_thread is not None:
+            self._bridge_thread.join(timeout)
+            return not self._bridge_thread.is_alive()
+        t_end = time.time()+timeout
+        try:
+            while (remain := t_end-time.time())>0:
+                if isinstance( self._transcribe_queue.get(timeout=remain), str ):
+                    return True
+        except Empty:
+            pass
+        return False
 
     @staticmethod
-    def segment_split( previous:list[Seg], current:list[Seg], secs ) ->int:
+    def segment_split( previous:list[Seg], current:list[Seg], secs, speech_end:float|None=None ) ->int:
         """確定した位置を決定する
+            speech_end: 発話検出で最後に発話が終わった位置(秒)。セグメントの終了時刻より正確なので、末尾の無音の判定に使う
             return: currentで確定したインデックス(インデックス位置を含む)
         """
-        if not isinstance(previous,list) or not isinstance(current,list):
-            return -1
-        pre_size = len(previous)
-        cur_size = len(current)
-        regex = r'[a-zA-Z][.!?][ ]*$'
-        #---step.1
-        tail_blank_sec = secs-(current[-1].end) if cur_size>0 else 0
-        if tail_blank_sec>1.2:
-            return cur_size-1 # テキストの最後と音声の最後が1.2秒あれば、全部確定
-
-        if cur_size <=1:
-            return -1 # セグメントが1以下の場合は、確定しない
-        elif cur_size==2:
-            if re.search(regex,current[0].text):
-                if re.search(regex,current[1].text):
-                    if (secs-current[1].end)>0.4:
-                        return 0 # セグメントが2個の場合、時間感覚が0.4秒以上あれば確定する
-            return -1
-        else:
-            return cur_size-3 # セグメントが3個以上あったら、最後の二つ以外は確定
+        return HeuristicPolicy('en').split(previous,current,secs,speech_end)
 
-    def _th_transcribe(self,share_id, share_bufsz, audio_queue:Queue, stdout:Queue, lang:str, logfile:str|None=None):
+    @staticmethod
+    def _th_transcribe(share_id, share_stop, share_vad, audio_ring:ShmRing, ctrl_queue:Queue, stdout:Queue, lang:str, logfile:str|None=None, window:tuple[float,float]|None=None,
+                       pcm:bool=False, record_dir:str|None=None, transcribe_fn:Callable[...,list[Seg]]=transcribe, models:"ModelRegistry|AsrService|RemoteAsrService|None"=None,
+                       backend:str|None=None, policy:str|None=None, audio_store:ShmAudioStore|None=None, session:str='', pooled:bool=False ):
+        """デコードループ
+            session: セッションを区別するキー(ログと負荷の集計に使う)
+            pooled: Trueならプールのワーカーで動いていて、終わっても共有メモリを閉じない(次のセッションで使う)
+        """
         run:bool = True
         acnt:int = 0
+        fh:FileHandler|None = None
+        sink:RecordingSink|None = None
+        pcm_buffer:PcmBuffer|None = None
         try:
-            logger = getLogger( __name__ )
+            # スレッドで動く場合は他のセッションとログが混ざらないようにloggerを分ける
+            logger = getLogger( __name__ if transcribe_fn is transcribe else f"{__name__}.{session}" )
             if logfile is not None:
                 logger.setLevel(LV_DEBUG)
                 fh = FileHandler(logfile)
@@ -400,10 +789,24 @@ class MlxWhisperProcess:
                 fh.setFormatter(formatter)
                 logger.addHandler(fh)
             logger.info(f"[Whisper] Start")
+            if record_dir is not None:
+                # デコードしたPCMを録音する(書き込みは録音スレッドで行う)
+                sink = RecordingSink(record_dir)
+                sink.start()
+                logger.info(f"[Whisper] recording {record_dir} from {sink.base_sample}")
             #--------------------
             # start ffmpeg
             #--------------------
-            ffmpeg_process = popen_ffmpeg()
+            ffmpeg_process:Popen|None = None
+            pcm_pipe:PcmPipe|None = None
+            if pcm:
+                # PCMはそのままバッファに書き込むのでffmpegは起動しない
+                pcm_pipe = PcmPipe()
+                audio_in = audio_out = pcm_pipe
+            else:
+                ffmpeg_process = popen_ffmpeg()
+                audio_in = ffmpeg_process.stdin
+                audio_out = ffmpeg_process.stdout
 
             #--------------------
             #--------------------
@@ -412,7 +815,6 @@ class MlxWhisperProcess:
                 try:
                     # copy input audio
                     while run and ffmpeg_process and ffmpeg_process.stderr:
-                        time.sleep(0.01)
                         b = ffmpeg_process.stderr.read()
                         if b: # and not ffmpeg_closed:
                             print(f"[FFMPEG]{b.decode()}")
@@ -422,48 +824,79 @@ class MlxWhisperProcess:
                 except Exception as ex:
                     traceback.print_exc()
             
-            err_thread = Thread( target=to_stderr, name='ffmpeg_stderr', daemon=True )
-            err_thread.start()
+            if ffmpeg_process is not None:
+                err_thread = Thread( target=to_stderr, name='ffmpeg_stderr', daemon=True )
+                err_thread.start()
         
             #--------------------
             #--------------------
-            model,lang = lang_to_model(lang)
+            # 負荷が高ければladderの段を下げる(段0がセッションで選んだモデル)
+            load = get_load_controller()
+            load_key = session
+            load.reset(load_key)
+            ladder:list[tuple[str,str]] = model_ladder(lang,backend)
+            level:int = 0
+            model,lang = ladder[0]
             print(f"[Whisper] Language {model} {lang}")
             bmodel = model
             blang = lang
+            def send_model(reason:str):
+                stdout.put( {'ev': 'asrModel', 'data': {'model': model, 'lang': lang, 'level': level, 'levels': len(ladder), 'reason': reason}} )
+            send_model('start')
+            swap_reason:str = 'select' # モデルを切り替える理由(select:セッションの設定, load:負荷)
+            # モデルを持つ側(このプロセスのレジストリか共有サービス)に先読みさせる
+            if models is None:
+                models = get_registry()
+            models.prefetch(model)
+            def from_ctrl():
+                try:
+                    while run:
+                        # 制御メッセージが届くまでブロックして待つ
+                        data = ctrl_queue.get()
+                        if isinstance(data, tuple) and data[0] == 'set_language':
+                            # 言語設定の更新
+                            nonlocal bmodel, blang, ladder, level, swap_reason
+                            swap_reason = 'select'
+                            ladder = model_ladder(data[1],data[2])
+                            level = 0
+                            load.reset(load_key)
+                            bmodel,blang = ladder[0]
+                            models.prefetch(bmodel)
+                            logger.info(f"[CP] Language changed to {bmodel} {blang}")
+                            print(f"[CP] Language changed to {bmodel} {blang}")
+                        elif data is None:
+                            break
+                except Exception as ex:
+                    logger.info(f"[CTRL] {str(ex)}")
+
+            ctrl_thread = Thread( target=from_ctrl, name='whisper_ctrl', daemon=True )
+            ctrl_thread.start()
+
             def to_ffmpeg():
                 logger.info("[CP]start")
                 try:
                     seq:int = 0
                     # copy input audio
-                    while run and ffmpeg_process and ffmpeg_process.stdin:
-                        time.sleep(0.01)
-                        if not audio_queue.empty():
-                            data = audio_queue.get()
-                            if isinstance(data, tuple) and data[0] == 'set_language':
-                                # 言語設定の更新
-                                nonlocal bmodel
-                                nonlocal blang
-                                bmodel,blang = lang_to_model(data[1])
-                                logger.info(f"[CP] Language changed to {bmodel} {blang}")
-                                print(f"[CP] Language changed to {bmodel} {blang}")
-                            elif isinstance(data,bytes) and len(data)>0 :
-                                if seq==0:
-                                    print(f"[CP]write data")
-                                share_bufsz[1] += len(data)
-                                ffmpeg_process.stdin.write( data )
-                                fname = f'tmp/dump/webm{seq:06d}.webm'
-                                os.makedirs('tmp/dump',exist_ok=True)
-                                with open( fname, 'wb') as f:
-                                    f.write(data)
-                                seq+=1
-                            else:
-                                logger.info("[CP]close")
-                                print(f"[CP]close")
-                                nonlocal ffmpeg_closed
-                                ffmpeg_closed = True
-                                ffmpeg_process.stdin.close()
-                                break
+                    while run and audio_in:
+                        # 届くまでブロックして待つ(Noneはwakeup)
+                        data = audio_ring.get()
+                        if data is None:
+                            if not audio_ring.stopped:
+                                continue
+                            data = b'' # stop()された。未読のレコードは読み終えたので入力を閉じる
+                        if len(data)>0 :
+                            if seq==0:
+                                print(f"[CP]write data")
+                            audio_in.write( data )
+                            audio_in.flush()
+                            seq+=1
+                        else:
+                            logger.info("[CP]close")
+                            print(f"[CP]close")
+                            nonlocal ffmpeg_closed
+                            ffmpeg_closed = True
+                            audio_in.close()
+                            break
                 except Exception as ex:
                     logger.info(f"[CP] {str(ex)}")
                 finally:
@@ -472,73 +905,154 @@ class MlxWhisperProcess:
             copy_thread = Thread( target=to_ffmpeg, name='ffmpeg_stdin', daemon=True )
             copy_thread.start()
 
-            #--------------------
-            #--------------------
-            def is_split(text:str) ->bool:
-                if text and re.search( r'[a-zA-Z][.!?]$',text):
-                    return True
-                return False
+            # ffmpegの出力はデコードと別のスレッドで読み続け、デコードループは溜まった分をまとめて取り出す
+            read_unit=int(SAMPLE_RATE*0.2)
+            pcm_buffer = PcmBuffer( int(float(os.getenv('ASR_PCM_BUFFER_SEC','30'))*SAMPLE_RATE)*2 )
+            def from_ffmpeg():
+                try:
+                    while run and audio_out and not audio_out.closed:
+                        b = audio_out.read(read_unit*2)
+                        if not b:
+                            break # EOF
+                        pcm_buffer.put(b)
+                except Exception as ex:
+                    logger.info(f"[RD] {str(ex)}")
+                finally:
+                    pcm_buffer.close()
+            read_thread = Thread( target=from_ffmpeg, name='ffmpeg_stdout', daemon=True )
+            read_thread.start()
+
             #--------------------
             #--------------------
             seg_sec = 1.0
             minimum_buf_size = int( seg_sec * SAMPLE_RATE )
-            buffer:NDArray[np.float32] = np.zeros( SAMPLE_RATE*30, dtype=np.float32)
-            buffer_len:int = 0
+            # デコードする音声(30秒)。確定した分は先頭を進めるだけでメモリは移動しない
+            ring = AudioRingBuffer( SAMPLE_RATE*30, chunk=minimum_buf_size )
+            buffer_len:int = 0 # = len(ring)
+            base_sample:int = 0 # バッファ先頭のサンプル位置(今回の音声の先頭から) = ring.head
             prev_segments:list[Seg] = []
             blanktime = SAMPLE_RATE *0.8
-            read_unit=int(SAMPLE_RATE*0.2)
+            # 増分デコードのウィンドウ幅とオーバーラップ
+            incremental:bool = window is not None
+            window_size:int = int(window[0]*SAMPLE_RATE) if window else ring.capacity
+            overlap_size:int = int(window[1]*SAMPLE_RATE) if window else 0
+            # 発話検出(位置は今回の音声の先頭からのサンプル数)
+            vad:EnergyVad|None = EnergyVad( sample_rate=SAMPLE_RATE ) if share_vad is not None else None
+            last_speech:int = -1 # 最後に発話を検出した位置
+            decoded_to:int = -1  # 前回デコードしたバッファの終端
+            audio_t0:float = 0.0 # 最初の音声が届いた時刻(実時間の入力に対する遅れを測る)
+            stabilizer = make_policy(policy,lang)
+            logger.info(f"[Whisper] policy {type(stabilizer).__name__}")
+            # promptは確定したテキストの末尾をトークン数の上限までに切り詰めたもの
+            tokenizer = get_tokenizer(model)
+            context = PromptContext( tokenizer, int(os.getenv('ASR_PROMPT_TOKENS','128')) )
+            # ロード(ダウンロード)前で作れなければ、ロードが終わってから1回だけ作り直す
+            tokenizer_retry:bool = tokenizer is None
             #
-            while run and ffmpeg_process and ffmpeg_process.stdout:
-                time.sleep(0.01)
-                if model!=bmodel or lang!=blang:
+            while run and share_stop.value==0 and audio_out:
+                # 新しいモデルのロードが終わるまでは前のモデルで続ける
+                if (model!=bmodel or lang!=blang) and models.ready(bmodel):
                     model = bmodel
                     lang = blang
-                    logger.info(f"[Whisper] Language {model} {lang}")
-                    print(f"[Whisper] Language {model} {lang}")
+                    stabilizer.lang = lang
+                    context.set_tokenizer( get_tokenizer(model) )
+                    tokenizer_retry = False
+                    logger.info(f"[Whisper] Language {model} {lang} level {level}")
+                    print(f"[Whisper] Language {model} {lang} level {level}")
+                    send_model( swap_reason )
+                elif tokenizer_retry and models.ready(model):
+                    tokenizer_retry = False
+                    if (tokenizer := get_tokenizer(model)) is not None:
+                        context.set_tokenizer( tokenizer )
                 # get audio segment
                 if acnt==0:
                     print(f"[Whisper]wait audio")
 
+                # 前回のデコードの間に溜まった音声をまとめて取り出す(1秒分溜まるまでは待つ)
                 read_frames=0
-                read_buf_sec = 0.0
-                while not ffmpeg_closed and not ffmpeg_process.stdout.closed:
-                    frames=min(read_unit,len(buffer)-buffer_len)
-                    if frames==0:
-                        break
-                    read_buf_sec=time.time()
-                    buf:bytes = ffmpeg_process.stdout.read(frames*2)
-                    read_buf_sec=time.time()-read_buf_sec
-                    # convert bytes to np.ndarray
-                    audio_seg = np.frombuffer(buf,dtype=np.int16).astype(np.float32) / 32768.0
-                    audio_len=len(audio_seg)
-                    read_frames+=audio_len
-                    # add to buffer
-                    buffer[buffer_len:buffer_len+audio_len] = audio_seg
-                    buffer_len+=audio_len
-                    if read_frames>=minimum_buf_size and read_buf_sec>0.1:
-                        break
+                eof:bool = False
+                space = ring.space()
+                if space>0:
+                    pcm_buffer.wait( min(minimum_buf_size,space)*2 )
+                    while (pcm := ring.readinto( pcm_buffer, space-read_frames )):
+                        if audio_t0==0.0:
+                            audio_t0 = time.time()
+                        if sink is not None:
+                            sink.write(bytes(pcm))
+                        if audio_store is not None:
+                            audio_store.write(pcm)
+                        read_frames += len(pcm)//2
+                    eof = read_frames==0
+                    if vad is not None and read_frames>0:
+                        pos = vad.process( ring.view(buffer_len) )
+                        if pos>=0:
+                            last_speech = base_sample+buffer_len+pos
+                    buffer_len = len(ring)
 
                 if acnt==0:
                     print(f"[Whisper]started audio")
                 acnt+=1
 
+                # 前回のデコードから発話が無ければ、デコードしても結果は変わらないので省く
+                reuse:bool = False
+                if vad is not None and buffer_len>0 and last_speech<=decoded_to:
+                    share_vad[0] += read_frames/SAMPLE_RATE
+                    reuse = len(prev_segments)>0
+                    segments = list(prev_segments) # 仮説が無ければ空のまま(無音として扱う)
                 # transcrib
-                if buffer_len>0:
-                    prompt = ' '.join( [s.text for s in prev_segments] ) if len(prev_segments)>0 else None
+                elif buffer_len>0:
+                    # 増分モードでは、ウィンドウより前で終わっている前回の仮説はデコードせずに再利用する
+                    keep_segments:list[Seg] = []
+                    win_start:int = 0
+                    if incremental and buffer_len>window_size:
+                        limit_sec = (buffer_len-window_size)/SAMPLE_RATE
+                        keep_segments = [ s for s in prev_segments if s.end<=limit_sec ]
+                        if len(keep_segments)>0:
+                            win_start = max( 0, int(keep_segments[-1].end*SAMPLE_RATE) - overlap_size )
+                        # 区切りの無い長い発話でも、デコードするのはウィンドウとオーバーラップまで
+                        # ウィンドウより前から始まる前回の仮説は、そのまま引き継ぐ
+                        min_start = buffer_len-window_size-overlap_size
+                        if win_start<min_start:
+                            win_start = min_start
+                            keep_segments = [ s for s in prev_segments if s.start*SAMPLE_RATE<win_start ]
+                    prompt, prompt_tokens = context.prompt()
                     trans_sec = time.time()
-                    segments = transcribe(buffer[:buffer_len], model=model,lang=lang, prompt=prompt, logger=logger)
+                    segments = transcribe_fn(ring.view(win_start,buffer_len), model=model,lang=lang, prompt=prompt, logger=logger)
                     trans_sec = time.time() - trans_sec
+                    if win_start>0:
+                        segments = merge_window_segments( keep_segments, segments, win_start/SAMPLE_RATE )
+                    dec_sec = (buffer_len-win_start)/SAMPLE_RATE
                     buf_sec = buffer_len/SAMPLE_RATE
-                    rate = trans_sec/buf_sec
+                    rate = trans_sec/dec_sec
+                    logger.info(f"[Step] decoded {dec_sec:.2f}/{buf_sec:.2f}sec wall {trans_sec:.3f}sec rtf {rate:.2f} reuse {len(keep_segments)} prompt {prompt_tokens}tok"
+                                f" queue ring {audio_ring.used()/1024:.0f}KB pcm {pcm_buffer.used()/(SAMPLE_RATE*2):.2f}sec")
+                    if vad is not None:
+                        decoded_to = base_sample+buffer_len
+                        share_vad[1] += read_frames/SAMPLE_RATE
                     if rate>1.0:
-                        print(f"elaps {trans_sec:.1f}/{buf_sec:.1f} = {rate:.2f} lang:{lang}")
+                        print(f"elaps {trans_sec:.1f}/{dec_sec:.1f} = {rate:.2f} lang:{lang}")
+                    # 入力は実時間で届くので、経過時間と読み込んだ音声の差がデコードの遅れ
+                    queue_sec = max( 0.0, (time.time()-audio_t0) - (base_sample+buffer_len)/SAMPLE_RATE )
+                    nlevel = load.update( load_key, trans_sec, dec_sec, queue_sec, len(ladder), model=model )
+                    if nlevel!=level and nlevel<len(ladder):
+                        logger.info(f"[Load] level {level}->{nlevel} rtf {rate:.2f} queue {queue_sec:.1f}sec host {load.host_duty():.2f}")
+                        print(f"[Load] level {level}->{nlevel} rtf {rate:.2f} queue {queue_sec:.1f}sec")
+                        level = nlevel
+                        swap_reason = 'load'
+                        bmodel,blang = ladder[level]
+                        models.prefetch(bmodel)
                 else:
                     segments = []
 
                 out1:list[TextSeg] = []
                 out2:list[str] = []
                 if segments and len(segments)>0:
-                    fixed_pos = MlxWhisperProcess.segment_split(prev_segments,segments,buffer_len/SAMPLE_RATE)
+                    speech_end = (last_speech-base_sample)/SAMPLE_RATE if vad is not None and last_speech>=0 else None
+                    if reuse:
+                        # 前回の仮説を使い回したときは一致を数えない(無音が続いたら確定するだけ)
+                        fixed_pos = stabilizer.settle(segments,buffer_len/SAMPLE_RATE,speech_end)
+                    else:
+                        fixed_pos = stabilizer.split(prev_segments,segments,buffer_len/SAMPLE_RATE,speech_end)
                     logstr = '\n'.join( [f"  {x.json()}" for x in segments])
                     logger.debug( f"# transcribe results split:{fixed_pos}\n{logstr}")
 
@@ -549,39 +1063,48 @@ class MlxWhisperProcess:
                             logger.info( f"[Text] fix {seg.text}")
                             seq = share_id.value
                             share_id.value += 1
-                            ts = TextSeg(seq,0.0,1.0,seg.text,seg.audio)
+                            ts = TextSeg(seq,base_sample/SAMPLE_RATE+seg.start,base_sample/SAMPLE_RATE+seg.end,seg.text,
+                                         base_sample+max(0,int((seg.start-0.1)*SAMPLE_RATE)), base_sample+min(int((seg.end+0.1)*SAMPLE_RATE),buffer_len))
                             out1.append(ts)
+                            context.commit(ts.text)
+                            if sink is not None:
+                                sink.mark( seq, base_sample+int(seg.start*SAMPLE_RATE), base_sample+int(seg.end*SAMPLE_RATE) )
                         # 最後の確定セグメントの終了位置（サンプル数）を計算
                         last_end_sample = int(segments[fixed_pos].end * SAMPLE_RATE)               
-                        # バッファをシフト
-                        remaining_samples = buffer_len - last_end_sample
-                        if remaining_samples > 0:
-                            np.copyto(buffer[0:remaining_samples], buffer[last_end_sample:buffer_len])
-                            buffer_len = remaining_samples
-                        else:
-                            buffer_len = 0
+                        # バッファの先頭を進める(メモリは移動しない)
+                        ring.drop( last_end_sample )
+                        buffer_len = len(ring)
+                        base_sample = ring.head
                         segments = segments[fixed_pos+1:]
+                        # 残りのセグメントの時刻をシフト後のバッファに合わせる
+                        for seg in segments:
+                            seg.shift( -last_end_sample/SAMPLE_RATE )
                     for seg in segments:
                         logger.info( f"[Text] tmp {seg.text}")
                         out2.append(seg.text)
                 else:
                     logger.debug( f"# transcribe result: []")
                     # no result
+                    stabilizer.reset()
                     for seg in prev_segments:
                         if not seg.isFixed:
                             seq = share_id.value
                             share_id.value += 1
-                            ts = TextSeg(seq,0.0,1.0,seg.text,seg.audio)
+                            ts = TextSeg(seq,base_sample/SAMPLE_RATE+seg.start,base_sample/SAMPLE_RATE+seg.end,seg.text,
+                                         base_sample+max(0,int((seg.start-0.1)*SAMPLE_RATE)), base_sample+min(int((seg.end+0.1)*SAMPLE_RATE),buffer_len))
                             out1.append(ts)
+                            context.commit(ts.text)
+                            if sink is not None:
+                                sink.mark( seq, base_sample+int(seg.start*SAMPLE_RATE), base_sample+int(seg.end*SAMPLE_RATE) )
                     if buffer_len>minimum_buf_size:
-                        x = buffer_len - minimum_buf_size
-                        np.copyto( buffer[0:minimum_buf_size], buffer[x:buffer_len] )
-                        buffer_len = minimum_buf_size
-                if out1 or out2:
+                        ring.drop( buffer_len - minimum_buf_size )
+                        buffer_len = len(ring)
+                        base_sample = ring.head
+                if out1 or (out2 and not reuse):
                     stdout.put( (out1,out2) )
                 # 次の比較用に現在のセグメントを保存
                 prev_segments = segments
-                if len(buf)==0:
+                if eof:
                     print("endwh")
                     break
 
@@ -589,30 +1112,71 @@ class MlxWhisperProcess:
             traceback.print_exc()
             logger.info(f"[Whisper] {str(ex)}")
         finally:
-            stdout.put( "None" )
             run = False
             try:
+                ctrl_queue.put( None )
+                if copy_thread.is_alive():
+                    audio_ring.wakeup() # ブロックしているto_ffmpegを起こす
                 copy_thread.join(0.2)
+                ctrl_thread.join(0.2)
             except:
                 pass
             try:
                 if ffmpeg_process is not None:
                     ffmpeg_process.terminate()
+                if pcm_pipe is not None:
+                    pcm_pipe.close() # 読み込みスレッドを終わらせる
             except:
                 pass
+            if sink is not None:
+                sink.close()
+            try:
+                load.remove(load_key)
+            except:
+                pass
+            if pcm_buffer is not None:
+                pcm_buffer.close() # 一杯で待っている読み込みスレッドを起こす
+                logger.info(f"[Queue] pcm peak {pcm_buffer.peak/(SAMPLE_RATE*2):.2f}sec")
+            if share_vad is not None:
+                logger.info(f"[VAD] skipped {share_vad[0]:.1f}sec decoded {share_vad[1]:.1f}sec")
             logger.info(f"[Whisper] End")
+            if fh is not None:
+                logger.removeHandler(fh)
+                fh.close()
+            # 終了マーカーは後始末の後に送る(プールではこれを受け取ったらワーカーを次のセッションに渡せる)
+            stdout.put( "None" )
+            if parent_process() is not None and not pooled:
+                audio_ring.close() # 子プロセスなら共有メモリから切り離す
+                if audio_store is not None:
+                    audio_store.close()
 
     def stop(self):
+        """デコードループを止める。スレッドから呼んでよい(リングには書き込まず、consumerに停止を知らせる)"""
         self._transcribe_closed = True
+        # 書き込み中のappend_audio()が終わるのを待って、以後の書き込みを止める
+        with self._input_lock:
+            self._input_closed = True
+        self._share_stop.value = 1
+        clean:bool = False
         try:
-            if self._whisper_process and self._whisper_process.is_alive():
+            if self._worker is not None:
+                # 入力を閉じてデコードループの終了を待ち、ワーカーはプールに返す
+                if self._whisper_process is not None and self._whisper_process.is_alive() and self._audio_ring is not None:
+                    self._audio_ring.request_stop()
+                    clean = self._wait_end(2.0)
+            elif isinstance(self._whisper_process,Thread):
+                # スレッドは強制終了できないので、ffmpegを閉じて終了を待つ
+                if self._whisper_process.is_alive() and self._audio_ring is not None:
+                    self._audio_ring.request_stop()
+                    self._whisper_process.join(2.0)
+            elif self._whisper_process and self._whisper_process.is_alive():
                 self._whisper_process.terminate()
-                for i in range(10):
-                    time.sleep(0.2)
-                    if self._whisper_process is None or not self._whisper_process.is_alive():
-                        return
-                self._whisper_process.kill()
+                self._whisper_process.join(2.0)
+                if self._whisper_process.is_alive():
+                    self._whisper_process.kill()
         except Exception as ex:
             print(f"[Whisp]stop {str(ex)}")
         finally:
             self._whisper_process = None
+            self._stop_bridge()
+            self._release(clean)
@@ -0,0 +1,96 @@
+import sys,os
+import time
+import asyncio
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess
+from asr_backend import BACKENDS, FakeBackend
+from asr_service import AsrService
+from load_controller import get_load_controller
+from admission import AdmissionController
+
+"""
+推論ワーカー2つの共有サービスに、セッションを1秒毎に増やしていき、
+受け付けの制御(admission.py)が無い場合とある場合で
+    - 各セッションが使ったモデルと、受け付けを待った秒数
+    - 結果が届く間隔(p90)と、入力の最後から最後の結果が届くまでの遅れ(ワーカーが埋まると全員の更新が遅れる)
+を比べ、最後にWMのモデル毎の容量の見積もりを表示する
+エンジンはfakeで、モデルが大きいほど推論が遅い。負荷による段の切り替え(load_controller)は止めて、受け付けだけを比べる
+"""
+
+SIZE_RTF:dict[str,float] = { 'large': 0.2, 'medium': 0.15, 'small': 0.08, 'base': 0.04, 'tiny': 0.02 }
+WORKERS = 2
+SESSIONS = 8
+AUDIO_SEC = 30
+
+class SizedFake(FakeBackend):
+    """モデルの名前の大きさに応じて推論時間を変える"""
+    def transcribe(self, model, path:str, audio, *, lang, prompt):
+        self.rtf = next( (r for k,r in SIZE_RTF.items() if k in path), 0.1 )
+        return super().transcribe(model, path, audio, lang=lang, prompt=prompt)
+
+async def session( idx:int, service:AsrService, admission:AdmissionController, pcm:bytes ) ->tuple[str,float,float,float]:
+    t0 = time.perf_counter()
+    adm = await admission.acquire( f"s{idx}", 'en', 'fake' )
+    wait = time.perf_counter()-t0
+    if adm.action=='reject':
+        return f"reject ({adm.reason})", wait, 0.0, 0.0
+    proc = MlxWhisperProcess( service=service, incremental=True, policy='local_agreement' )
+    proc.set_language( adm.key, 'fake' )
+    proc.start(pcm=True)
+    last = 0.0
+    gaps:list[float] = []
+    async def reader():
+        nonlocal last
+        while (await proc.read(timeout=1.0)) is not None:
+            t = time.perf_counter()
+            if last>0:
+                gaps.append(t-last)
+            last = t
+    task = asyncio.create_task( reader() )
+    t0 = time.perf_counter()
+    chunk = 6400
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+        await asyncio.sleep( max(0.0, t0+(i+chunk)/32000-time.perf_counter()) )
+    t_end = time.perf_counter()
+    proc.close_audio()
+    await task
+    await asyncio.to_thread(proc.stop)
+    proc.close()
+    admission.release( f"s{idx}" )
+    gaps.sort()
+    return f"{adm.action:7s} {adm.model.split('/')[-1]}", wait, gaps[int(len(gaps)*0.9)] if gaps else 0.0, last-t_end
+
+async def run( service:AsrService, pcm:bytes, enabled:bool ) ->AdmissionController:
+    admission = AdmissionController( workers=lambda: service.workers, shared_models=True, model_stats=service.model_stats, model_rtf=service.model_rtf,
+                                     queue_max=2, queue_sec=40.0, enabled=enabled )
+    async def delayed(i:int):
+        await asyncio.sleep(i*1.0)
+        return await session( i, service, admission, pcm )
+    results = await asyncio.gather( *[ delayed(i) for i in range(SESSIONS) ] )
+    print(f"admission {'on ' if enabled else 'off'} workers {WORKERS} sessions {SESSIONS} audio {AUDIO_SEC}sec  {admission.stats()['counts']}")
+    for i,(what,wait,gap,lag) in enumerate(results):
+        print(f"  session {i} wait {wait:5.1f}sec  result interval p90 {gap:5.2f}sec  tail lag {lag:6.2f}sec  {what}")
+    return admission
+
+async def main():
+    load = get_load_controller()
+    load.enabled = False
+    BACKENDS['fake'] = SizedFake()
+    service = AsrService( workers=WORKERS )
+    service.start()
+    audio, _ = FakeBackend().synthesize()
+    audio = np.concatenate( [audio,audio] )[:AUDIO_SEC*16000]
+    pcm = (audio*32767).astype(np.int16).tobytes() + bytes(2*32000)
+    await run( service, pcm, False )
+    admission = await run( service, pcm, True )
+    print("capacity (sessions per model on this host)")
+    for key,x in admission.report('fake')['models'].items():
+        if not key.endswith('.cpu'):
+            print(f"  {key:10s} rtf {x['rtf'] or 0.0:6.4f} duty {x['duty']:5.2f} {x['source']:8s} sessions {x['sessions']}")
+    service.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import sys,os
+import time
+import base64
+import random
+import zlib
+import numpy as np
+
+sys.path.append('app')
+from audio_frame import pack_frame, parse_frame, FrameError, FrameStream, HEADER, CODEC_PCM, CODEC_WEBM
+
+"""
+音声のフレーム(audio_frame.py)について
+    - 検査のコスト: 以前のXORチェックサム(Pythonの1バイト毎のループ)とCRC32+ヘッダの解析
+    - 送るサイズ: base64(audio_b64/audio_dict)とバイナリのフレーム
+    - 欠けと入れ替わり: PCMの時刻がずれないこと、WebMはクラスタの先頭から送り直すこと
+"""
+
+SAMPLE_RATE = 16000
+CHUNK_MS = 200
+
+def calculate_xor_checksum(data: bytes) -> int:
+    checksum = 0
+    for byte in data:
+        checksum ^= byte
+    return checksum
+
+def bench_check():
+    pcm = (np.random.default_rng(0).normal(0,3000,SAMPLE_RATE*CHUNK_MS//1000)).astype(np.int16).tobytes()
+    frame = pack_frame(0,0.0,CODEC_PCM,pcm)
+    n = 200
+    t0 = time.perf_counter()
+    for _ in range(n):
+        calculate_xor_checksum(pcm)
+    t_xor = (time.perf_counter()-t0)/n
+    t0 = time.perf_counter()
+    for _ in range(n):
+        parse_frame(frame)
+    t_frame = (time.perf_counter()-t0)/n
+    print(f"check {len(pcm)}B chunk: xor loop {t_xor*1e6:8.1f}us  parse_frame(crc32) {t_frame*1e6:6.1f}us")
+    b64 = base64.b64encode(pcm)
+    print(f"size  {len(pcm)}B chunk: base64 {len(b64)}B (+{(len(b64)/len(pcm)-1)*100:.0f}%)  frame {len(frame)}B (+{HEADER.size}B)")
+    bad = bytearray(frame)
+    bad[-1] ^= 1
+    try:
+        parse_frame(bytes(bad))
+        print("crc NG")
+    except FrameError as ex:
+        print(f"crc   {ex}")
+
+def bench_pcm_gaps():
+    """0.2秒のチャンクを、一部を入れ替え・欠落させて送り、並べ直した結果の長さと中身を確かめる"""
+    rng = random.Random(1)
+    n = 300
+    chunk = SAMPLE_RATE*CHUNK_MS//1000
+    ref = (np.arange(n*chunk) % 30000).astype(np.int16)
+    frames = [ pack_frame(i, i*CHUNK_MS, CODEC_PCM, ref[i*chunk:(i+1)*chunk].tobytes()) for i in range(n) ]
+    lost = set( rng.sample(range(1,n-1), 6) )
+    order = [ i for i in range(n) if i not in lost ]
+    for _ in range(20): # 隣り合うフレームを入れ替える
+        k = rng.randrange(len(order)-3)
+        order[k],order[k+2] = order[k+2],order[k]
+    stream = FrameStream( sample_rate=SAMPLE_RATE )
+    out:list[bytes] = []
+    for i in order:
+        chunks,_ = stream.push( parse_frame(frames[i]) )
+        out += [ bytes(c[2]) for c in chunks ]
+    chunks,_ = stream.flush()
+    out += [ bytes(c[2]) for c in chunks ]
+    got = np.frombuffer(b''.join(out),dtype=np.int16)
+    expect = ref.copy()
+    for i in lost:
+        expect[i*chunk:(i+1)*chunk] = 0
+    ok = len(got)==len(ref) and np.array_equal(got,expect)
+    print(f"pcm   {stream.stats()}  samples {len(got)}/{len(ref)}  {'timeline ok' if ok else 'NG'}")
+
+def bench_webm_resync():
+    """クラスタの途中のチャンクが欠けたら、次のクラスタの先頭から送る"""
+    cluster = b'\x1f\x43\xb6\x75'
+    header = b'\x1a\x45\xdf\xa3' + bytes(60)
+    body = b''.join( cluster + bytes([i])*500 for i in range(6) )
+    data = header + body
+    chunks = [ data[i:i+400] for i in range(0,len(data),400) ]
+    frames = [ pack_frame(i, i*CHUNK_MS, CODEC_WEBM, c) for i,c in enumerate(chunks) ]
+    stream = FrameStream()
+    out:list[bytes] = []
+    for i,f in enumerate(frames):
+        if i==3:
+            continue # 欠落
+        c,_ = stream.push( parse_frame(f) )
+        out += [ bytes(x[2]) for x in c ]
+    c,_ = stream.flush()
+    out += [ bytes(x[2]) for x in c ]
+    sent = b''.join(out)
+    cut = len(b''.join(chunks[:3]))
+    resumed = sent[cut:]
+    ok = resumed.startswith(cluster) and data.endswith(resumed)
+    print(f"webm  {stream.stats()}  resumed at cluster {'ok' if ok else 'NG'}")
+
+def main():
+    bench_check()
+    bench_pcm_gaps()
+    bench_webm_resync()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import sys,os
+import time
+import asyncio
+import shutil
+import struct
+
+sys.path.append('app')
+from audio_format import sniff_audio
+
+"""
+録音の最初のチャンクの判定にかかる時間を、ヘッダの解析とffmpegの起動で比べる
+MediaRecorderが出力するのと同じ構造のヘッダを組み立てて使う
+"""
+
+def ebml( eid:int, payload:bytes, *, unknown:bool=False ) ->bytes:
+    ib = eid.to_bytes( (eid.bit_length()+7)//8, 'big' )
+    if unknown:
+        return ib + b'\x01\xff\xff\xff\xff\xff\xff\xff' + payload
+    return ib + (0x0100000000000000 | len(payload)).to_bytes(8,'big') + payload
+
+def make_webm( codec:str ) ->bytes:
+    header = ebml(0x1A45DFA3, ebml(0x4286,b'\x01') + ebml(0x4282,b'webm') )
+    info = ebml(0x1549A966, ebml(0x2AD7B1,b'\x0f\x42\x40') )
+    track = ebml(0xAE, ebml(0xD7,b'\x01') + ebml(0x86,codec.encode()) + ebml(0x83,b'\x02') )
+    cluster = ebml(0x1F43B675, ebml(0xE7,b'\x00') + os.urandom(2000), unknown=True )
+    return header + ebml(0x18538067, info + ebml(0x1654AE6B,track) + cluster, unknown=True )
+
+def box( typ:bytes, payload:bytes ) ->bytes:
+    return struct.pack('>I4s',8+len(payload),typ) + payload
+
+def make_mp4( fmt:bytes ) ->bytes:
+    entry = box( fmt, bytes(28) )
+    stsd = box( b'stsd', b'\x00\x00\x00\x00' + struct.pack('>I',1) + entry )
+    moov = box( b'moov', box( b'trak', box( b'mdia', box( b'minf', box( b'stbl', stsd ) ) ) ) )
+    return box( b'ftyp', b'isom\x00\x00\x02\x00isomiso6mp41' ) + moov + box( b'moof', bytes(100) )
+
+def make_ogg( packet:bytes ) ->bytes:
+    return b'OggS' + bytes(22) + bytes([1]) + bytes([len(packet)]) + packet
+
+def make_wav( tag:int ) ->bytes:
+    fmt = struct.pack('<HHIIHH', tag, 1, 16000, 32000, 2, 16)
+    return b'RIFF' + struct.pack('<I',36+3200) + b'WAVE' + b'fmt ' + struct.pack('<I',16) + fmt + b'data' + struct.pack('<I',3200) + bytes(3200)
+
+SAMPLES:list[tuple[str,bytes,str]] = [
+    ('webm/opus', make_webm('A_OPUS'), ''),
+    ('webm/unknown', make_webm('A_UNKNOWN'), 'unsupported'),
+    ('mp4/opus', make_mp4(b'Opus'), ''),
+    ('mp4/aac', make_mp4(b'mp4a'), ''),
+    ('ogg/opus', make_ogg(b'OpusHead\x01\x01'), ''),
+    ('wav/pcm', make_wav(1), ''),
+    ('wav/0x0011', make_wav(0x11), 'unsupported'),
+    ('cluster only', make_webm('A_OPUS')[-1500:], None),
+]
+
+async def bench_ffmpeg( data:bytes, count:int ) ->float:
+    from whisper_transcribe import check_audio_ffmpeg
+    t0 = time.perf_counter()
+    for _ in range(count):
+        await check_audio_ffmpeg(data,16000)
+    return (time.perf_counter()-t0)/count
+
+def main():
+    for name,data,expect in SAMPLES:
+        fmt = sniff_audio(data)
+        if expect is None:
+            assert fmt is None, f"{name} {fmt}"
+        else:
+            assert fmt is not None and fmt.error.startswith(expect), f"{name} {fmt}"
+        count = 20000
+        t0 = time.perf_counter()
+        for _ in range(count):
+            sniff_audio(data)
+        t = (time.perf_counter()-t0)/count
+        print(f"{name:14s} {str(fmt):60s} sniff {t*1e6:7.2f}us")
+    if shutil.which('ffmpeg'):
+        t = asyncio.run( bench_ffmpeg( SAMPLES[5][1], 20 ) )
+        print(f"ffmpeg check {t*1000:7.2f}ms")
+    else:
+        print("ffmpeg not found")
+
+if __name__ == "__main__":
+    main()
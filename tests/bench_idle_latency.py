@@ -0,0 +1,113 @@
+import sys,os
+import time
+import asyncio
+import threading
+from threading import Thread
+from queue import Queue, Empty
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess, Seg
+
+"""
+接続しているが無音のセッションがN個あるときのCPU使用率と、
+結果キューからread()が戻るまでの遅延を、旧方式(sleepによるポーリング)と比べる
+"""
+
+class NullService:
+    """モデルを呼ばないダミーの推論サービス(無音なので呼ばれない)"""
+    def transcribe(self, audio, *, model:str, lang:str='', prompt:str|None=None, logger=None, session:str='') ->list[Seg]:
+        return []
+    def prefetch(self, model:str):
+        pass
+    def ready(self, model:str) ->bool:
+        return True
+
+async def idle_event( sessions:int, sec:float ) ->float:
+    """イベント駆動: セッションを起動して、音声が来ないまま待つ"""
+    procs = [ MlxWhisperProcess( service=NullService() ) for _ in range(sessions) ]
+    for p in procs:
+        p.start(pcm=True)
+    tasks = [ asyncio.create_task( p.read() ) for p in procs ]
+    await asyncio.sleep(0.5)
+    c0 = time.process_time()
+    await asyncio.sleep(sec)
+    cpu = time.process_time()-c0
+    for p in procs:
+        p.stop()
+    await asyncio.gather( *tasks, return_exceptions=True )
+    return cpu/sec
+
+async def idle_polling( sessions:int, sec:float ) ->float:
+    """旧方式: to_ffmpegの10msポーリングとread()の200msポーリング"""
+    run = True
+    queues = [ Queue() for _ in range(sessions) ]
+    def to_ffmpeg(q:Queue):
+        while run:
+            time.sleep(0.01)
+            if not q.empty():
+                q.get()
+    async def read(q:Queue):
+        while run:
+            try:
+                q.get_nowait()
+            except Empty:
+                pass
+            await asyncio.sleep(0.2)
+    ths = [ Thread( target=to_ffmpeg, args=(q,), daemon=True ) for q in queues ]
+    for th in ths:
+        th.start()
+    tasks = [ asyncio.create_task( read(Queue()) ) for _ in range(sessions) ]
+    await asyncio.sleep(0.5)
+    c0 = time.process_time()
+    await asyncio.sleep(sec)
+    cpu = time.process_time()-c0
+    run = False
+    await asyncio.gather( *tasks )
+    return cpu/sec
+
+async def latency_event( count:int ) ->list[float]:
+    """ワーカーが結果を置いてからread()が戻るまで"""
+    proc = MlxWhisperProcess( service=NullService() )
+    proc.start(pcm=True)
+    ret = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        proc._transcribe_queue.put( ([],[f"{i}"]) )
+        await proc.read()
+        ret.append( time.perf_counter()-t0 )
+        await asyncio.sleep(0.05)
+    proc.stop()
+    return ret
+
+async def latency_polling( count:int ) ->list[float]:
+    q:Queue = Queue()
+    ret = []
+    for i in range(count):
+        # ポーリングの位相に対して結果が届く時刻をずらす
+        Thread( target=lambda: (time.sleep( (i%10)*0.02 ), q.put(i)), daemon=True ).start()
+        t0 = time.perf_counter()+(i%10)*0.02
+        while True:
+            try:
+                q.get_nowait()
+                break
+            except Empty:
+                pass
+            await asyncio.sleep(0.2)
+        ret.append( time.perf_counter()-t0 )
+    return ret
+
+def fmt( lat:list[float] ) ->str:
+    lat = sorted(lat)
+    return f"p50:{lat[len(lat)//2]*1000:7.2f}ms max:{lat[-1]*1000:7.2f}ms"
+
+async def main():
+    sec = 5.0
+    for n in (1,10,30):
+        cpu_p = await idle_polling(n,sec)
+        cpu_e = await idle_event(n,sec)
+        print(f"idle sessions:{n:3d}  polling cpu:{cpu_p*100:6.2f}%  event cpu:{cpu_e*100:6.2f}%")
+    print(f"result->read polling {fmt(await latency_polling(20))}")
+    print(f"result->read event   {fmt(await latency_event(20))}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
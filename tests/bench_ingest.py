@@ -0,0 +1,61 @@
+import sys,os
+import time
+import asyncio
+import subprocess
+from subprocess import Popen
+import numpy as np
+
+sys.path.append('app')
+import whisper_transcribe
+from whisper_transcribe import MlxWhisperProcess, Seg, transcribe
+from asr_backend import BACKENDS, FakeBackend
+
+"""
+ffmpegの代わりにcat(同じ8KBのパイプ)を通して、推論が遅いときに
+音声がリング(親プロセス→ワーカー)に溜まる秒数を数える。入力が詰まらなければ0付近のまま
+"""
+
+def popen_cat() ->Popen:
+    bufsz = 8192
+    return Popen(['cat'],bufsize=bufsz,pipesize=bufsz, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+class FakeService:
+    def transcribe(self, audio, *, model:str, lang:str='', prompt:str|None=None, logger=None, session:str='') ->list[Seg]:
+        return transcribe(audio, model=model, lang=lang, prompt=prompt, logger=logger)
+    def prefetch(self, model:str):
+        pass
+    def ready(self, model:str) ->bool:
+        return True
+
+async def run( rtf:float ):
+    fake = FakeBackend( rtf=rtf, overhead=0.2 )
+    BACKENDS['fake'] = fake
+    audio, _ = fake.synthesize()
+    proc = MlxWhisperProcess( service=FakeService(), incremental=True, policy='local_agreement' )
+    proc.set_language('en','fake')
+    proc.start(pcm=False)
+    pcm = (audio*32767).astype(np.int16).tobytes()
+    async def reader():
+        while (await proc.read(timeout=1.0)) is not None:
+            pass
+    task = asyncio.create_task( reader() )
+    backlog:list[float] = []
+    t0 = time.perf_counter()
+    chunk = 3200 # 100ms
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'webm',pcm[i:i+chunk])
+        backlog.append( proc._audio_ring.used()/32000 )
+        await asyncio.sleep( max(0.0, t0+(i+chunk)/32000-time.perf_counter()) )
+    proc.close_audio()
+    await task
+    proc.close()
+    b = sorted(backlog)
+    print(f"rtf {rtf:.2f}  ring backlog p50 {b[len(b)//2]:5.2f}sec  p90 {b[int(len(b)*0.9)]:5.2f}sec  max {b[-1]:5.2f}sec  overruns {proc.overruns}")
+
+async def main():
+    whisper_transcribe.popen_ffmpeg = popen_cat
+    for rtf in (0.05,0.2,0.4):
+        await run( rtf )
+
+if __name__ == "__main__":
+    asyncio.run(main())
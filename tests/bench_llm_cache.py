@@ -0,0 +1,65 @@
+import sys,os
+import time
+import asyncio
+
+sys.path.append('app')
+from llm_cache import ResultCache, cache_key
+
+"""
+/process_audioの結果のキャッシュ(llm_cache.py)について、LLMの代わりにLLM_SEC秒かかる関数で
+    - 画面の更新のように同じテキストの要求が重なって(同時にCONCURRENT個)、繰り返し(ROUNDS回)届くときの、LLMの呼び出し回数と応答時間
+    - 空白や全角半角だけが違うテキストが同じキーになること
+    - TTLとLRUで捨てられること
+を確かめる
+"""
+
+LLM_SEC = 0.5
+CONCURRENT = 10
+ROUNDS = 5
+
+class FakeLLM:
+    def __init__(self):
+        self.calls = 0
+    async def __call__(self, mode:str, text:str) ->str:
+        self.calls += 1
+        await asyncio.sleep(LLM_SEC)
+        return f"{mode}:{len(text)}"
+
+async def refresh( cache:ResultCache|None, llm:FakeLLM, text:str ) ->list[float]:
+    """同じテキストの要求をCONCURRENT個同時に送るのをROUNDS回"""
+    lat:list[float] = []
+    async def one():
+        t0 = time.perf_counter()
+        if cache is None:
+            await llm('summary',text)
+        else:
+            await cache.get_or_run( cache_key('summary',1,text), lambda: llm('summary',text) )
+        lat.append( time.perf_counter()-t0 )
+    for _ in range(ROUNDS):
+        await asyncio.gather( *[ one() for _ in range(CONCURRENT) ] )
+    return sorted(lat)
+
+async def main():
+    text = "今日の会議では 来期の予算について話し合いました。 " * 20
+    for name,cache in (('no cache',None),('cache',ResultCache())):
+        llm = FakeLLM()
+        t0 = time.perf_counter()
+        lat = await refresh( cache, llm, text )
+        sec = time.perf_counter()-t0
+        print(f"{name:8s} requests {len(lat)} llm calls {llm.calls:3d}  total {sec:5.2f}sec  p50 {lat[len(lat)//2]*1000:6.1f}ms max {lat[-1]*1000:6.1f}ms")
+        if cache is not None:
+            print(f"         {cache.stats()}")
+    same = cache_key('summary',1,"Hello  world\n") == cache_key('summary',1,"Ｈｅｌｌｏ world")
+    other = cache_key('summary',1,"Hello world") != cache_key('summary',2,"Hello world") != cache_key('translation',2,"Hello world")
+    print(f"key   normalized text same {same}  mode/version differ {other}")
+    cache = ResultCache( max_entries=3, ttl_sec=0.2 )
+    llm = FakeLLM()
+    for i in range(5):
+        await cache.get_or_run( cache_key('summary',1,str(i)), lambda: llm('summary','x') )
+    await asyncio.sleep(0.3)
+    await cache.get_or_run( cache_key('summary',1,'4'), lambda: llm('summary','x') )
+    st = cache.stats()
+    print(f"evict entries {st['entries']} evicted {st['evicted']} expired {st['expired']}  {'ok' if st['evicted']==2 and st['expired']==1 else 'NG'}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import sys,os
+import time
+import asyncio
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess, Seg, transcribe
+from asr_backend import BACKENDS, FakeBackend
+from load_controller import get_load_controller
+
+"""
+推論ワーカー1つ(レジストリのロックで直列)を複数のセッションで共有し、
+負荷によるモデルの段の切り替えがある場合と無い場合で、
+    - 入力の最後から最後の結果が届くまでの遅れ
+    - 受け取ったモデルの変更の通知
+を比べる。エンジンはfakeで、モデルが大きいほど推論が遅い
+"""
+
+SIZE_RTF:dict[str,float] = { 'large': 0.5, 'medium': 0.3, 'small': 0.15, 'base': 0.08, 'tiny': 0.04 }
+
+class SizedFake(FakeBackend):
+    """モデルの名前の大きさに応じて推論時間を変える"""
+    def transcribe(self, model, path:str, audio, *, lang, prompt):
+        self.rtf = next( (r for k,r in SIZE_RTF.items() if k in path), 0.1 )
+        return super().transcribe(model, path, audio, lang=lang, prompt=prompt)
+
+class FakeService:
+    def transcribe(self, audio, *, model:str, lang:str='', prompt:str|None=None, logger=None, session:str='') ->list[Seg]:
+        return transcribe(audio, model=model, lang=lang, prompt=prompt, logger=logger)
+    def prefetch(self, model:str):
+        pass
+    def ready(self, model:str) ->bool:
+        return True
+
+async def session( audio:np.ndarray, events:list ) ->float:
+    proc = MlxWhisperProcess( service=FakeService(), incremental=True, policy='local_agreement',
+                              on_event=lambda msg,data: events.append( (time.perf_counter(),msg,data) ) )
+    proc.set_language('large','fake')
+    proc.start(pcm=True)
+    pcm = (audio*32767).astype(np.int16).tobytes() + bytes(3*32000)
+    last = 0.0
+    async def reader():
+        nonlocal last
+        while (await proc.read(timeout=1.0)) is not None:
+            last = time.perf_counter()
+    task = asyncio.create_task( reader() )
+    t0 = time.perf_counter()
+    chunk = 6400
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+        await asyncio.sleep( max(0.0, t0+(i+chunk)/32000-time.perf_counter()) )
+    t_end = time.perf_counter()
+    proc.close_audio()
+    await task
+    proc.close()
+    return last-t_end
+
+async def run( sessions:int, enabled:bool ):
+    load = get_load_controller()
+    load.enabled = enabled
+    load.hold_sec = 3.0
+    fake = SizedFake()
+    BACKENDS['fake'] = fake
+    audio, _ = fake.synthesize()
+    audio = np.concatenate( [audio,audio] )
+    events:list[list] = [ [] for _ in range(sessions) ]
+    t0 = time.perf_counter()
+    lags = await asyncio.gather( *[ session(audio,ev) for ev in events ] )
+    print(f"load control {'on ' if enabled else 'off'} sessions {sessions} audio {len(audio)/16000:.1f}sec")
+    for i,(lag,ev) in enumerate(zip(lags,events)):
+        changes = ' '.join( f"{t-t0:.1f}s:{d['model'].split('/')[-1]}({d['reason']})" for t,m,d in ev if m=='asrModel' )
+        print(f"  session {i} tail lag {lag:6.2f}sec  {changes}")
+
+async def main():
+    for enabled in (False,True):
+        await run( 3, enabled )
+
+if __name__ == "__main__":
+    asyncio.run(main())
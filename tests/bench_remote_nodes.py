@@ -0,0 +1,100 @@
+import sys,os
+import time
+import signal
+import asyncio
+import subprocess
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess
+from asr_remote import RemoteAsrService
+from asr_backend import FakeBackend
+
+"""
+ローカルに起動した複数のワーカーノード(asr_node.py)をマシンの代わりにして、
+RemoteAsrServiceがセッションをノードに振り分け、途中でdrainしたノードのセッションを別のノードへ移すことを確かめる
+    - NODES個のノードにSESSIONS個のセッションを同時に流し、ノード毎のセッション数と要求数を数える
+    - 途中で1つのノードにSIGTERMを送り(drain)、そのセッションが止まらずに別のノードで続くこと、
+      確定した文がdrainしない場合と同じであることを確かめる
+エンジンはfake
+usage: python tests/bench_remote_nodes.py [ノード数] [セッション数]
+"""
+
+BASE_PORT = 5201
+SPEED = 4.0 # 実時間の何倍で音声を送るか
+CHUNK = 3200
+
+def start_nodes( n:int ) ->list[subprocess.Popen]:
+    procs = []
+    for i in range(n):
+        env = dict(os.environ, ASR_NODE_PORT=str(BASE_PORT+i), ASR_WORKERS='1', ASR_PRELOAD='', ASR_NODE_NAME=f'node{i}')
+        procs.append( subprocess.Popen( [sys.executable, 'app/asr_node.py'], env=env, stdout=subprocess.DEVNULL ) )
+    return procs
+
+def stop_nodes( procs:list[subprocess.Popen] ):
+    for p in procs:
+        if p.poll() is None:
+            p.send_signal(signal.SIGTERM)
+    for p in procs:
+        try:
+            p.wait(10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+async def session( service:RemoteAsrService, pcm:bytes ) ->list[str]:
+    proc = MlxWhisperProcess( incremental=True, policy='local_agreement', service=service )
+    proc.set_language('en','fake')
+    proc.start(pcm=True)
+    fixed:list[str] = []
+    async def feed():
+        for i in range(0,len(pcm),CHUNK):
+            proc.append_audio(0,'pcm',pcm[i:i+CHUNK])
+            await asyncio.sleep( CHUNK/2/16000/SPEED )
+        proc.close_audio()
+    task = asyncio.create_task( feed() )
+    while (res := await proc.read(timeout=1.0)) is not None:
+        fixed += res[0]
+    await task
+    proc.stop()
+    proc.close()
+    return fixed
+
+async def run( nodes:int, sessions:int, pcm:bytes, drain_at:float|None ) ->list[list[str]]:
+    procs = start_nodes(nodes)
+    service = RemoteAsrService( [ f'127.0.0.1:{BASE_PORT+i}' for i in range(nodes) ], timeout=5.0 )
+    service.start()
+    while service.node_stats()['nodes'] and not all( x['connected'] for x in service.node_stats()['nodes'].values() ):
+        await asyncio.sleep(0.2)
+    t0 = time.time()
+    tasks = [ asyncio.create_task( session(service,pcm) ) for _ in range(sessions) ]
+    placed:dict = {}
+    if drain_at is not None:
+        await asyncio.sleep(drain_at)
+        placed = { k:v['sessions'] for k,v in service.node_stats()['nodes'].items() }
+        procs[0].send_signal(signal.SIGTERM)
+    results = await asyncio.gather( *tasks, return_exceptions=True )
+    sec = time.time()-t0
+    st = service.node_stats()
+    service.stop()
+    stop_nodes(procs)
+    name = f"drain node0 at {drain_at:.0f}s" if drain_at is not None else "no drain"
+    errors = [ r for r in results if isinstance(r,BaseException) ]
+    print(f"{name:18s} {sessions} sessions {sec:5.1f}sec  moved {st['moved']} retried {st['retried']}  errors {len(errors)} {errors[:1]}")
+    for addr,x in st['nodes'].items():
+        before = f"sessions before drain {placed.get(addr,0)}  " if placed else ''
+        print(f"    {addr} {before}sessions {x['sessions']} requests {x['requests']}")
+    return [ r if isinstance(r,list) else [] for r in results ]
+
+async def main():
+    nodes = int(sys.argv[1]) if len(sys.argv)>1 else 3
+    sessions = int(sys.argv[2]) if len(sys.argv)>2 else 6
+    audio, _ = FakeBackend().synthesize()
+    audio = audio[:30*16000]
+    pcm = (audio*32767).astype(np.int16).tobytes()
+    ref = await run( nodes, sessions, pcm, None )
+    got = await run( nodes, sessions, pcm, len(audio)/16000/SPEED/2 )
+    same = sum( 1 for a,b in zip(ref,got) if a==b and a )
+    print(f"fixed text same as no drain: {same}/{sessions} sessions")
+
+if __name__ == "__main__":
+    asyncio.run(main())
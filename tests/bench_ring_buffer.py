@@ -0,0 +1,89 @@
+import sys,os
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.append('app')
+from rec_util import AudioRingBuffer
+from whisper_transcribe import PcmBuffer
+
+"""
+デコードループの1ステップ分(1秒分のPCMを取り出してバッファに追加し、確定した先頭を捨てる)の
+メモリ確保の量と時間を、旧方式(bytes→frombuffer→astype→/32768→コピー、先頭はnp.copytoで詰める)と比べる
+確保の量はtracemallocで、ステップ中に増えたメモリのピークを数える
+"""
+
+SAMPLE_RATE=16000
+STEP = SAMPLE_RATE      # 1ステップで届く音声
+UNIT = SAMPLE_RATE//5   # 読み込みの単位(0.2秒)
+KEEP = SAMPLE_RATE*5    # 確定していない音声の長さ(これを超えたら1ステップ分を確定する)
+
+def feed( pcm_buffer:PcmBuffer, pcm:bytes ):
+    for i in range(0,len(pcm),UNIT*2):
+        pcm_buffer.put( pcm[i:i+UNIT*2] )
+
+def old_step( pcm_buffer:PcmBuffer, state:dict ):
+    buffer = state['buffer']
+    buffer_len = state['len']
+    with pcm_buffer._cv:
+        n = min(len(pcm_buffer._buf),(len(buffer)-buffer_len)*2) & ~1
+        buf = bytes(pcm_buffer._buf[:n])
+        del pcm_buffer._buf[:n]
+    audio_seg = np.frombuffer(buf,dtype=np.int16).astype(np.float32) / 32768.0
+    buffer[buffer_len:buffer_len+len(audio_seg)] = audio_seg
+    buffer_len += len(audio_seg)
+    decode = buffer[0:buffer_len]
+    if buffer_len>KEEP:
+        remaining = buffer_len-STEP
+        np.copyto( buffer[0:remaining], buffer[STEP:buffer_len] )
+        buffer_len = remaining
+    state['len'] = buffer_len
+
+def ring_step( pcm_buffer:PcmBuffer, ring:AudioRingBuffer ):
+    space = ring.space()
+    read = 0
+    while (pcm := ring.readinto( pcm_buffer, space-read )):
+        read += len(pcm)//2
+    decode = ring.view()
+    if len(ring)>KEEP:
+        ring.drop(STEP)
+
+def measure( name:str, step, steps:int=200 ):
+    pcm_buffer = PcmBuffer( 30*SAMPLE_RATE*2 )
+    pcm = (np.sin( np.arange(STEP)*0.05 )*10000).astype(np.int16).tobytes()
+    # 先にバッファを半分ほど埋めておく
+    for _ in range(10):
+        feed( pcm_buffer, pcm )
+        step( pcm_buffer )
+    peaks:list[int] = []
+    t = 0.0
+    tracemalloc.start()
+    for _ in range(steps):
+        feed( pcm_buffer, pcm )
+        base,_ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        step( pcm_buffer )
+        t += time.perf_counter()-t0
+        _,peak = tracemalloc.get_traced_memory()
+        peaks.append( peak-base )
+    tracemalloc.stop()
+    peaks.sort()
+    print(f"{name:8s} allocated/step p50 {peaks[len(peaks)//2]/1024:7.1f}KB max {peaks[-1]/1024:7.1f}KB  time/step {t/steps*1e6:7.1f}us (with tracemalloc)")
+
+def main():
+    state = { 'buffer': np.zeros( SAMPLE_RATE*30, dtype=np.float32 ), 'len': 0 }
+    measure( 'old', lambda pb: old_step(pb,state) )
+    ring = AudioRingBuffer( SAMPLE_RATE*30, chunk=STEP )
+    measure( 'ring', lambda pb: ring_step(pb,ring) )
+    # 旧方式と同じ値になること
+    ring2 = AudioRingBuffer( 100, chunk=7 )
+    ref = (np.arange(-300,300,3)*100).astype(np.int16)
+    ring2.write( ref[:90].tobytes() )
+    ring2.drop(60)
+    ring2.write( ref[90:150].tobytes() )
+    assert np.array_equal( ring2.view(), ref[60:150].astype(np.float32)/32768.0 )
+    print("ring values ok")
+
+if __name__ == "__main__":
+    main()
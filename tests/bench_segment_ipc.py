@@ -0,0 +1,79 @@
+import sys,os
+import time
+import asyncio
+import pickle
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess, Seg, transcribe
+from asr_backend import BACKENDS, FakeBackend
+
+"""
+fakeエンジンのセッションで、デコード1回あたりの
+    - セグメントの音声のために確保したバイト数
+    - 結果キューに入れたデータをpickleしたバイト数(プロセス間で送るサイズ)
+を数える。確定したセグメントの音声が後から取り出せることも確かめる
+"""
+
+class FakeService:
+    def __init__(self):
+        self.calls:int = 0
+        self.audio_bytes:int = 0
+    def transcribe(self, audio, *, model:str, lang:str='', prompt:str|None=None, logger=None, session:str='') ->list[Seg]:
+        segs = transcribe(audio, model=model, lang=lang, prompt=prompt, logger=logger)
+        self.calls += 1
+        self.audio_bytes += sum( s.audio.nbytes for s in segs if getattr(s,'audio',None) is not None )
+        return segs
+    def prefetch(self, model:str):
+        pass
+    def ready(self, model:str) ->bool:
+        return True
+
+class CountQueue:
+    """結果キューに入れたデータのpickleのサイズを数える"""
+    def __init__(self, q):
+        self.q = q
+        self.bytes:int = 0
+        self.items:list = []
+    def put(self, data):
+        self.bytes += len(pickle.dumps(data))
+        self.items.append(data)
+        self.q.put(data)
+    def get(self, *args, **kwargs):
+        return self.q.get(*args, **kwargs)
+    def get_nowait(self):
+        return self.q.get_nowait()
+
+async def main():
+    fake = FakeBackend()
+    BACKENDS['fake'] = fake
+    audio, timeline = fake.synthesize()
+    svc = FakeService()
+    proc = MlxWhisperProcess( service=svc, incremental=True, policy='local_agreement' )
+    cq = CountQueue( proc._transcribe_queue )
+    proc._transcribe_queue = cq
+    proc.set_language('en','fake')
+    proc.start(pcm=True)
+    pcm = (audio*32767).astype(np.int16).tobytes() + bytes(3*32000)
+    async def reader():
+        while (await proc.read(timeout=1.0)) is not None:
+            pass
+    task = asyncio.create_task( reader() )
+    t0 = time.perf_counter()
+    chunk = 6400
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+        await asyncio.sleep( max(0.0, t0+(i+chunk)/32000-time.perf_counter()) )
+    proc.close_audio()
+    await task
+    fixed = [ ts for item in cq.items if isinstance(item,tuple) for ts in item[0] ]
+    print(f"steps {svc.calls}  segment audio alloc {svc.audio_bytes/svc.calls/1024:8.1f}KB/step  ipc {cq.bytes/svc.calls/1024:8.2f}KB/step  fixed {len(fixed)}")
+    get_audio = getattr(proc,'segment_audio',None)
+    if get_audio is not None:
+        for ts in fixed:
+            a = get_audio(ts)
+            print(f"  {ts.seq} {ts.start:6.2f}-{ts.end:6.2f} {0 if a is None else len(a)/16000:5.2f}sec {ts.text}")
+    proc.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+import sys,os
+import time
+import asyncio
+import numpy as np
+import socketio
+
+sys.path.append('app')
+from audio_frame import pack_frame, CODEC_PCM
+
+"""
+起動しているtranscribe_serverに、音声を実時間で送り続けるクライアントを段階的に増やして接続し、
+1ノードで何クライアントまで受け付けられるかを測る
+    - 各クライアントは audioStart(pcm) の後、100ms毎に3200バイトのPCMを audio_frame で送り、応答(ack)を待つ
+    - ackの遅れ(送信から応答まで)と、送信の予定時刻からの遅れ(ackが遅いと次の送信が遅れる)を数える
+    - 音声は無音なので発話検出でデコードは省かれ、推論ではなくサーバの受信の処理を測る
+全てのチャンクにackが返り、送信の遅れがMAX_LAG秒未満(サーバの処理が実時間に追いついている)の間を「受け付けられた」とする
+usage: python tests/bench_server_load.py [url] [クライアント数,...]
+"""
+
+CHUNK_SEC = 0.1
+DURATION = 10.0
+MAX_LAG = 1.0
+
+async def client( url:str, ack:list[float], lag:list[float], errors:list[str], start:asyncio.Event ):
+    sio = socketio.AsyncClient( reconnection=False )
+    @sio.on('ev')
+    async def on_ev(data):
+        if isinstance(data,dict) and data.get('msg')=='audioError':
+            errors.append( str(data.get('data')) )
+    try:
+        await sio.connect( url, transports=['websocket'] )
+        await sio.emit( 'ev', {'msg': 'configure', 'data': {'recogLang': 'en', 'asrBackend': 'fake', 'llmMode': 'off'}} )
+        await sio.emit( 'ev', {'msg': 'audioStart', 'data': {'audioFormat': 'pcm'}} )
+        await start.wait()
+        pcm = bytes( int(16000*CHUNK_SEC)*2 )
+        t0 = time.perf_counter()
+        n = int(DURATION/CHUNK_SEC)
+        for i in range(n):
+            t1 = time.perf_counter()
+            lag.append( t1-(t0+i*CHUNK_SEC) )
+            await sio.call( 'audio_frame', pack_frame(i,i*CHUNK_SEC*1000,CODEC_PCM,pcm), timeout=10 )
+            ack.append( time.perf_counter()-t1 )
+            await asyncio.sleep( max(0.0, t0+(i+1)*CHUNK_SEC-time.perf_counter()) )
+        await sio.emit( 'ev', {'msg': 'audioStop'} )
+    except Exception as ex:
+        errors.append( f"{type(ex).__name__} {str(ex)}" )
+    finally:
+        await sio.disconnect()
+
+async def run( url:str, n:int ) ->bool:
+    ack:list[float] = []
+    lag:list[float] = []
+    errors:list[str] = []
+    start = asyncio.Event()
+    tasks = [ asyncio.create_task( client(url,ack,lag,errors,start) ) for _ in range(n) ]
+    await asyncio.sleep( 1.0+n*0.02 ) # 接続と開始を待つ
+    start.set()
+    await asyncio.gather( *tasks )
+    if not ack:
+        print(f"clients {n:4d}  no ack  errors {len(errors)} {errors[:1]}")
+        return False
+    ack.sort()
+    p50 = ack[len(ack)//2]
+    p99 = ack[int(len(ack)*0.99)]
+    max_lag = max(lag)
+    expected = n*int(DURATION/CHUNK_SEC)
+    ok = len(ack)==expected and max_lag<MAX_LAG and not errors
+    print(f"clients {n:4d}  ack p50 {p50*1000:7.1f}ms p99 {p99*1000:7.1f}ms  send lag max {max_lag*1000:7.1f}ms  chunks {len(ack)}/{expected}  errors {len(errors)}  {'ok' if ok else 'NG'}")
+    if errors:
+        print(f"    {errors[0]}")
+    return ok
+
+async def main():
+    url = sys.argv[1] if len(sys.argv)>1 else 'http://127.0.0.1:5008'
+    levels = [ int(x) for x in sys.argv[2].split(',') ] if len(sys.argv)>2 else [10,25,50,100,200]
+    held = 0
+    for n in levels:
+        if not await run( url, n ):
+            break
+        held = n
+        await asyncio.sleep(2.0)
+    print(f"{url} held {held} streaming clients")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import sys,os
+import time
+from multiprocessing import Process, Queue
+
+sys.path.append('app')
+from shm_ring import ShmRing
+
+"""
+セッションの音声を別プロセスへ渡すときのスループットを、mp.QueueとShmRingで比べる
+producer(このプロセス)からconsumer(子プロセス)へ固定サイズのチャンクを送り、
+consumerが全部受け取るまでの時間から chunks/s を出す
+1チャンクあたりのコピー回数:
+    mp.Queue: pickle → pipeへwrite → pipeからread → unpickle (4回、feederスレッド経由)
+    ShmRing:  共有メモリへ書き込み → 共有メモリからbytesへ読み出し (2回)
+"""
+
+COPIES = { 'queue': 4, 'ring': 2 }
+
+def consume_queue(q:Queue, done:Queue):
+    n = 0
+    while True:
+        data = q.get()
+        if not data:
+            break
+        n += len(data)
+    done.put(n)
+
+def consume_ring(ring:ShmRing, done:Queue):
+    n = 0
+    while True:
+        data = ring.get()
+        if data is None:
+            continue
+        if len(data)==0:
+            break
+        n += len(data)
+    done.put(n)
+    ring.close()
+
+def bench_queue( chunk:bytes, count:int ) ->float:
+    q:Queue = Queue()
+    done:Queue = Queue()
+    p = Process( target=consume_queue, args=(q,done) )
+    p.start()
+    t0 = time.perf_counter()
+    for _ in range(count):
+        q.put(chunk)
+    q.put(b'')
+    n = done.get()
+    t = time.perf_counter()-t0
+    p.join()
+    assert n==len(chunk)*count
+    return count/t
+
+def bench_ring( chunk:bytes, count:int ) ->tuple[float,int]:
+    ring = ShmRing()
+    done:Queue = Queue()
+    p = Process( target=consume_ring, args=(ring,done) )
+    p.start()
+    t0 = time.perf_counter()
+    for _ in range(count):
+        ring.put(chunk, timeout=None) # 溢れさせずに待つ
+    ring.put(b'', timeout=None)
+    n = done.get()
+    t = time.perf_counter()-t0
+    p.join()
+    overruns = ring.overruns
+    ring.close()
+    assert n==len(chunk)*count
+    return count/t, overruns
+
+def bench_overrun( chunk:bytes, count:int ) ->int:
+    """consumerが居ないときにtimeout=0で書き込んで、溢れた数を数える"""
+    ring = ShmRing( capacity=len(chunk)*8 )
+    ok = sum( 1 for _ in range(count) if ring.put(chunk, timeout=0.0) )
+    overruns = ring.overruns
+    ring.close()
+    assert ok+overruns==count
+    return overruns
+
+def main():
+    # 200ms(6400byte)は16kHz int16のAudioWorkletのチャンク、大きい方はMediaRecorderのまとめ送り相当
+    for size,count in ((6400,20000),(65536,5000),(1024*1024,300)):
+        chunk = os.urandom(size)
+        q = bench_queue(chunk,count)
+        r,ov = bench_ring(chunk,count)
+        print(f"chunk:{size:8d}B  queue:{q:9.0f} chunks/s ({COPIES['queue']} copies)  ring:{r:9.0f} chunks/s ({COPIES['ring']} copies)  x{r/q:4.2f}  overruns:{ov}")
+    print(f"overrun without consumer: {bench_overrun(os.urandom(6400),100)}/100 dropped")
+
+if __name__ == "__main__":
+    main()
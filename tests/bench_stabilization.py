@@ -0,0 +1,113 @@
+import sys,os
+import time
+import asyncio
+import re
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess, Seg, transcribe
+from asr_backend import BACKENDS, FakeBackend
+from stabilization import POLICIES
+
+"""
+台本を読み上げた音声(FakeBackend.synthesize)を実時間でセッションに流し、確定方針毎に
+    - 文の音声が終わってから、その文の単語が全部確定するまでの時間
+    - 同じ音声を何秒分デコードし直したか(デコードした秒数の合計 - 音声の長さ)
+    - 確定したテキストが台本と一致するか
+を比べる。エンジンはfake(モデル不要)
+"""
+
+SCRIPT:list[str] = [
+    "Good morning everyone.",
+    "Let's start with the status of the release.",
+    "The build is green and the tests pass.",
+    "We still need to review the open issues.",
+    "Security fixes go first and documentation comes after that.",
+    "Any questions before we move on?",
+]
+
+# 単語の間に空白を入れた日本語の台本(fakeエンジンは空白で単語を分ける)
+SCRIPT_JA:list[str] = [
+    "皆さん おはよう ございます。",
+    "まず リリースの 状況から 始めます。",
+    "ビルドは 成功していて テストも 通っています",
+    "残っている 課題を 確認する 必要が あります。",
+    "セキュリティの 修正を 先に して ドキュメントは その後です",
+    "次に 進む 前に 質問は ありますか？",
+]
+
+class FakeService:
+    """fakeエンジンで推論して、デコードした音声の秒数を数える"""
+    def __init__(self):
+        self.decoded_sec:float = 0.0
+        self.calls:int = 0
+    def transcribe(self, audio, *, model:str, lang:str='', prompt:str|None=None, logger=None, session:str='') ->list[Seg]:
+        self.decoded_sec += len(audio)/16000
+        self.calls += 1
+        return transcribe(audio, model=model, lang=lang, prompt=prompt, logger=logger)
+    def prefetch(self, model:str):
+        pass
+    def ready(self, model:str) ->bool:
+        return True
+
+def words(text:str) ->list[str]:
+    return [ re.sub(r'[^\w]','',w.lower()) for w in text.split() ]
+
+async def replay( policy:str, audio:np.ndarray, timeline:list[tuple[float,float,str]], lang:str ) ->dict:
+    svc = FakeService()
+    proc = MlxWhisperProcess( service=svc, incremental=True, policy=policy )
+    proc.set_language(lang,'fake')
+    proc.start(pcm=True)
+    # マイクは話し終わっても無音を送り続けるので、最後の文が確定するまで無音を流す
+    pcm = (audio*32767).astype(np.int16).tobytes() + bytes(3*32000)
+    fixed:list[tuple[float,str]] = []
+    t0 = time.perf_counter()
+    async def reader():
+        while (res := await proc.read(timeout=1.0)) is not None:
+            now = time.perf_counter()-t0
+            for text in res[0]:
+                fixed.append( (now,text) )
+    task = asyncio.create_task( reader() )
+    chunk = 6400 # 200ms
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+        await asyncio.sleep( max(0.0, t0+(i+chunk)/32000-time.perf_counter()) )
+    proc.close_audio()
+    await task
+    proc.close()
+    # 文毎に、全部の単語が確定した時刻
+    lat:list[float] = []
+    got:list[str] = []
+    n = 0
+    need = 0
+    for start,end,line in timeline:
+        need += len(words(line))
+        while n<len(fixed) and len(got)<need:
+            got += words(fixed[n][1])
+            n += 1
+        if len(got)>=need:
+            lat.append( fixed[n-1][0]-end )
+    expect = [ w for _,_,line in timeline for w in words(line) ]
+    return {
+        'latency': lat,
+        'fixed': len(lat), 'sentences': len(timeline),
+        'redecoded': svc.decoded_sec - len(audio)/16000,
+        'calls': svc.calls,
+        'match': got[:len(expect)]==expect,
+    }
+
+async def main():
+    for lang,script in (('en',SCRIPT),('ja',SCRIPT_JA)):
+        fake = FakeBackend( script=script )
+        BACKENDS['fake'] = fake
+        audio, timeline = fake.synthesize()
+        print(f"{lang} audio {len(audio)/16000:.1f}sec sentences:{len(timeline)}")
+        for name in POLICIES.keys():
+            r = await replay( name, audio, timeline, lang )
+            lat = sorted(r['latency'])
+            p50 = lat[len(lat)//2] if lat else float('nan')
+            mx = lat[-1] if lat else float('nan')
+            print(f"{lang} {name:16s} fixed {r['fixed']}/{r['sentences']}  time-to-fixed p50:{p50:5.2f}s max:{mx:5.2f}s  re-decoded:{r['redecoded']:6.1f}s  calls:{r['calls']:3d}  text match:{r['match']}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+import sys,os
+import json
+import random
+import asyncio
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess
+from asr_backend import FakeBackend
+from asr_service import AsrService
+from transcript_stream import TranscriptStream
+
+"""
+fakeのエンジンで起こした結果(確定した文, 仮の文)の列を、文字起こしの差分(transcript_stream.py)で送ったときに
+    - 送るバイト数を、全文を毎回送る場合と、前の方式(新しく確定した文と仮の文の全体)と比べる
+      (fakeは仮の文が短いので、仮の文が1語ずつ伸びる列でも比べる)
+    - 差分をDROP_RATEの割合で落としたクライアントが、送り直し(transcriptSync)で追いついて全文が一致するか
+    - 途中から見るクライアントと、切断して再接続したクライアントが、版から送り直して一致するか
+を確かめる。クライアントはspeech_mlxwhisper.jsのonTranscriptと同じ手順で差分を当てる(仮の文の位置はUTF-16の単位)
+"""
+
+AUDIO_SEC = 30
+DROP_RATE = 0.2
+MULTIBYTE = [ "会議の議事録です。", "😀予算の件", "次回は来週。" ]
+
+def ev_bytes( msg:str, data ) ->int:
+    """Socket.IOで送るJSONの大きさ"""
+    return len( json.dumps( {'msg': msg, 'data': data}, ensure_ascii=False, separators=(',',':') ).encode('utf-8') )
+
+def u16_slice( text:str, n:int ) ->str:
+    return text.encode('utf-16-le')[:n*2].decode('utf-16-le')
+
+class Client:
+    """onTranscriptと同じ手順"""
+    def __init__(self, stream:str|None=None):
+        self.stream:str|None = stream
+        self.v = 0
+        self.segs:list[str] = []
+        self.tmp = ''
+        self.syncing = False
+        self.syncs = 0
+
+    def on_transcript(self, data:dict, server:TranscriptStream):
+        if data.get('full'):
+            if data['stream']!=self.stream or data['since']==0:
+                self.stream = data['stream']
+                self.segs = []
+            self.syncing = False
+        else:
+            # 差分にはstreamが無い(見ている履歴のルームにだけ届く)
+            if self.stream is None or self.syncing or data['v']<=self.v:
+                return
+            if data['v']!=self.v+1:
+                self.syncing = True
+                self.syncs += 1
+                self.on_transcript( server.snapshot(self.v), server )
+                return
+        self.v = data['v']
+        add = data.get('add',[])
+        self.segs += add[ max(0,len(self.segs)-data.get('seg',0)): ]
+        if 'tmp' in data:
+            offset, text = data['tmp']
+            self.tmp = u16_slice(self.tmp,offset) + text
+
+    def text(self) ->str:
+        return ' '.join(self.segs)
+
+async def results() ->list[tuple[list[str],list[str]]]:
+    service = AsrService( workers=1 )
+    service.start()
+    audio, _ = FakeBackend().synthesize()
+    audio = np.concatenate( [audio,audio] )[:AUDIO_SEC*16000]
+    pcm = (audio*32767).astype(np.int16).tobytes() + bytes(2*32000)
+    proc = MlxWhisperProcess( service=service, incremental=True, policy='local_agreement' )
+    proc.set_language( 'en', 'fake' )
+    proc.start(pcm=True)
+    seq:list[tuple[list[str],list[str]]] = []
+    async def reader():
+        while (res := await proc.read(timeout=1.0)) is not None:
+            if res:
+                seq.append( (list(res[0]),list(res[1])) )
+    task = asyncio.create_task( reader() )
+    chunk = 3200
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+        await asyncio.sleep(0.1)
+    proc.close_audio()
+    await task
+    await asyncio.to_thread(proc.stop)
+    proc.close()
+    service.stop()
+    return seq
+
+def word_by_word( sentences:list[str], pending:int=2 ) ->list[tuple[list[str],list[str]]]:
+    """仮の文が1語ずつ伸び、文がpending個たまったら先頭の文を確定する(実際のエンジンの仮説の伸び方)"""
+    seq:list[tuple[list[str],list[str]]] = []
+    tmp:list[str] = []
+    for sent in sentences:
+        words = sent.split()
+        for n in range(1,len(words)+1):
+            fixed = [ tmp.pop(0) ] if n==1 and len(tmp)>=pending else []
+            seq.append( (fixed, tmp+[' '.join(words[:n])]) )
+        tmp.append(sent)
+    seq.append( (tmp,[]) )
+    return seq
+
+def replay( name:str, seq:list[tuple[list[str],list[str]]] ):
+    server = TranscriptStream()
+    rnd = random.Random(1)
+    full_bytes = old_bytes = new_bytes = 0
+    msgs = 0
+    fixed:list[str] = []
+    steady, lossy, late, reconnect = Client(), Client(), None, Client()
+    # 接続したら送り直しで自分の履歴のidを受け取る
+    for c in (steady,lossy,reconnect):
+        c.on_transcript( server.snapshot(0), server )
+    for step,(f,t) in enumerate(seq):
+        fixed += [ x for x in f if x ]
+        full_bytes += ev_bytes( 'transcription', {'text': ' '.join(fixed), 'tmp': ' '.join(t)} )
+        if f or t:
+            old_bytes += ev_bytes( 'transcription', {'text': ' '.join(f), 'tmp': ' '.join(t)} )
+        delta = server.update( f, t )
+        if delta is None:
+            continue
+        msgs += 1
+        new_bytes += ev_bytes( 'transcript', delta )
+        steady.on_transcript( delta, server )
+        if rnd.random()>=DROP_RATE:
+            lossy.on_transcript( delta, server )
+        if step==len(seq)//2:
+            # 途中から見る
+            late = Client( server.stream_id )
+            late.on_transcript( server.snapshot(0), server )
+        elif late is not None:
+            late.on_transcript( delta, server )
+        # 1/3から2/3の間は切断していて、戻ったら持っている版から送り直してもらう
+        if len(seq)//3<=step<len(seq)*2//3:
+            continue
+        if step==len(seq)*2//3:
+            reconnect.on_transcript( server.snapshot(reconnect.v), server )
+        else:
+            reconnect.on_transcript( delta, server )
+    # 最後の差分を落としていたら、次の差分が来ないので、送り直しを頼むまで追いつかない
+    lossy.on_transcript( server.snapshot(lossy.v), server )
+    print(f"{name}: steps {len(seq)} messages {msgs} segments {len(fixed)} version {server.version}")
+    print(f"  bytes full text every step {full_bytes:8d}")
+    print(f"        fixed+tmp (previous) {old_bytes:8d}")
+    print(f"        delta                {new_bytes:8d}  {new_bytes/max(1,old_bytes):5.1%} of previous  {new_bytes/max(1,full_bytes):5.1%} of full")
+    expect = ' '.join(fixed)
+    for cname,c in (('steady',steady),('lossy',lossy),('late',late),('reconnect',reconnect)):
+        ok = c is not None and c.text()==expect==server.text() and c.tmp==server.snapshot()['tmp'][1]
+        print(f"  client {cname:9s} v {c.v if c else 0:4d} resyncs {c.syncs if c else 0:3d}  {'ok' if ok else 'NG'}")
+
+def main():
+    seq = asyncio.run( results() )
+    # 仮の文の位置がUTF-16の単位で合うことも確かめるため、サロゲートペアを含む文を混ぜる
+    seq += [ ([], [MULTIBYTE[0]]), ([], [MULTIBYTE[0]+MULTIBYTE[1]]), ([MULTIBYTE[0]], [MULTIBYTE[1]+MULTIBYTE[2]]), ([MULTIBYTE[1]+MULTIBYTE[2]], []) ]
+    replay( 'fake engine', seq )
+    sentences = [ t for f,_ in seq for t in f if t.isascii() ]
+    replay( 'word by word', word_by_word(sentences) )
+
+if __name__ == "__main__":
+    main()
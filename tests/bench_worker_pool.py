@@ -0,0 +1,65 @@
+import sys,os
+import time
+import asyncio
+import numpy as np
+
+sys.path.append('app')
+from whisper_transcribe import MlxWhisperProcess, lang_to_model
+from whisper_pool import WhisperPool
+from asr_backend import BACKENDS, FakeBackend
+
+"""
+セッションの開始(start)から最初の結果が届くまでの秒数を、
+開始の度にプロセスを起動する場合と、モデルをロード済みのプロセスをプールから借りる場合で比べる
+エンジンはfakeで、モデルのロードにLOAD_SEC秒かかるものとする
+"""
+
+LOAD_SEC = 1.5
+
+class SlowLoadFake(FakeBackend):
+    def load(self, path:str):
+        time.sleep(LOAD_SEC)
+        return super().load(path)
+
+async def session( pcm:bytes, pool:WhisperPool|None ) ->tuple[float,float]:
+    proc = MlxWhisperProcess( incremental=True, policy='local_agreement', pool=pool )
+    proc.set_language('en','fake')
+    t0 = time.perf_counter()
+    proc.start(pcm=True)
+    t_start = time.perf_counter()-t0
+    chunk = 6400
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio(0,'pcm',pcm[i:i+chunk])
+    proc.close_audio()
+    while (await proc.read(timeout=1.0)) is not None:
+        pass
+    t0 = time.perf_counter()
+    proc.stop()
+    t_stop = time.perf_counter()-t0
+    proc.close()
+    return proc.first_result_sec or -1.0, t_start+t_stop
+
+async def run( pool:WhisperPool|None, n:int ):
+    fake = SlowLoadFake( rtf=0.02, overhead=0.05 )
+    audio, _ = fake.synthesize()
+    pcm = (audio[:SAMPLE_SEC*16000]*32767).astype(np.int16).tobytes()
+    name = f"pool {pool.size}" if pool else 'process'
+    for i in range(n):
+        first, ctl = await session( pcm, pool )
+        print(f"{name:8s} session {i} first result {first:5.2f}sec  start+stop {ctl*1000:6.1f}ms")
+    if pool is not None:
+        print(f"{name:8s} {pool.stats()}")
+
+SAMPLE_SEC = 6
+
+async def main():
+    BACKENDS['fake'] = SlowLoadFake()
+    await run( None, 3 )
+    pool = WhisperPool( size=1, preload=[lang_to_model('en','fake')[0]] )
+    pool.start()
+    await asyncio.sleep( LOAD_SEC+1.0 ) # 待機中のワーカーがロードを終えるまで
+    await run( pool, 3 )
+    pool.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
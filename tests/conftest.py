@@ -0,0 +1,4 @@
+import sys,os
+
+# テストはリポジトリのルートから実行する(python -m pytest tests)。app/のモジュールを直接importする
+sys.path.insert( 0, os.path.join( os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app' ) )
@@ -9,19 +9,22 @@ from logging import getLogger, Logger, StreamHandler, FileHandler, Formatter,  D
 import mlx_whisper
 
 sys.path.append('app')
-from whisper_transcribe import WHISPER_MODEL_NAME, MlxWhisperProcess, transcribe, Seg
+from whisper_transcribe import MlxWhisperProcess, lang_to_model
+from asr_backend import split_model
 
 async def write_to_tp(tp:MlxWhisperProcess, file_path,chunk,size_limit):
     """
     非同期タスクでファイルを読み込み、tp.write にデータを送信する。
     """
     sz=0
+    seq=0
     with open(file_path, "rb") as f:
         while sz<=size_limit:
             data = f.read(chunk)
             if not data:
                 break
-            tp.append_audio(data)
+            tp.append_audio(seq,'webm',data)
+            seq+=1
             sz+=len(data)
             await asyncio.sleep(0)  # 他のタスクに制御を渡す
         tp.close_audio()
@@ -71,7 +74,9 @@ async def main():
     chunk = 8192
 
     # 非同期タスクを作成
-    tp = MlxWhisperProcess( logfile=log_file)
+    model, _ = lang_to_model('en','mlx')
+    tp = MlxWhisperProcess( logfile=log_file, incremental=True )
+    tp.set_language('en','mlx')
     tp.start()
     logger.debug("Created and started MlxWhisperProcess")
 
@@ -85,7 +90,7 @@ async def main():
     result = await read_task
     logger.debug("Read task completed")
     result_text = ' '.join(result)
-    tp.stop()
+    tp.close()
     logger.info("MlxWhisperProcess stopped")
     result_text = '\n'.join( text_split( result_text ) )
     with open('tmp/result.txt','w') as f:
@@ -100,7 +105,7 @@ async def main():
         temp_file.flush()
 
         result = mlx_whisper.transcribe(
-            temp_file.name, path_or_hf_repo=WHISPER_MODEL_NAME,
+            temp_file.name, path_or_hf_repo=split_model(model)[1],
             language='en',
             #hallucination_silence_threshold=0.5,
             #no_speech_threshold=0.2,
@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+
+from admission import AdmissionController
+from whisper_transcribe import lang_to_model, ladder_keys
+
+TOP = lang_to_model('en','fake')[0]
+LADDER = [ lang_to_model(k,'fake')[0] for k in ladder_keys('en') ]
+
+def controller(rtfs:dict[str,float], **kw) ->AdmissionController:
+    """推論ワーカー1つ(dutyの上限1.0)。CPUとメモリの余裕では断らない"""
+    args:dict = dict( workers=lambda: 1, model_rtf=lambda: rtfs, decode_ratio=10.0, target=1.0,
+                      cpu_max=1e9, mem_reserve_mb=-1e9, session_mem_mb=0.0, queue_sec=5.0 )
+    return AdmissionController( **(args|kw) )
+
+def test_admit_then_degrade():
+    adm = controller( { TOP: 0.06 } )
+    assert adm.predict(TOP) == (pytest.approx(0.6),'measured')
+    assert adm.decide('a','en','fake').action == 'admit'
+    # 2つ目は選んだモデルでは入らないので、測ったモデルから見積もった小さいモデルで受け付ける
+    second = adm.decide('b','en','fake')
+    assert second.action == 'degrade' and second.model in LADDER[1:]
+    assert adm.host_duty() <= 1.0
+    assert adm.stats()['active'] == 2
+
+def test_same_session_is_counted_once():
+    adm = controller( { TOP: 0.06 } )
+    adm.decide('a','en','fake')
+    # 録音をやり直すと前の分を外してから決める
+    assert adm.decide('a','en','fake').action == 'admit'
+    assert adm.stats()['active'] == 1
+
+def test_queue_until_release():
+    adm = controller( { m: 0.08 for m in LADDER } )
+    async def run():
+        assert (await adm.acquire('a','en','fake')).action == 'admit'
+        positions:list[int] = []
+        waiter = asyncio.create_task( adm.acquire('b','en','fake', on_queued=lambda x: positions.append(x.position)) )
+        await asyncio.sleep(0.1)
+        assert not waiter.done() and positions == [1]
+        adm.release('a')
+        got = await asyncio.wait_for( waiter, 2.0 )
+        assert got.action == 'admit'
+        assert adm.stats()['queued'] == 0
+    asyncio.run( run() )
+
+def test_reject_when_queue_full_or_timeout():
+    adm = controller( { m: 0.08 for m in LADDER }, queue_max=0 )
+    adm.decide('a','en','fake')
+    assert adm.decide('b','en','fake').action == 'reject'
+    adm = controller( { m: 0.08 for m in LADDER }, queue_sec=0.0 )
+    async def run():
+        await adm.acquire('a','en','fake')
+        return await adm.acquire('b','en','fake')
+    assert asyncio.run( run() ).action == 'reject'
+    assert adm.stats()['counts']['reject'] == 1
+
+def test_cancelled_waiter_holds_no_slot():
+    """受け付け待ちを止めた(audioStartのやり直し)ら、待ちから外れて枠も持たない。やり直した要求は普通に受け付けられる"""
+    adm = controller( { m: 0.08 for m in LADDER } )
+    async def run():
+        await adm.acquire('a','en','fake')
+        old = asyncio.create_task( adm.acquire('b','en','fake') )
+        await asyncio.sleep(0.05)
+        old.cancel()
+        await asyncio.gather( old, return_exceptions=True )
+        assert adm.stats()['queued'] == 0 and adm.stats()['active'] == 1
+        new = asyncio.create_task( adm.acquire('b','en','fake') )
+        await asyncio.sleep(0.05)
+        adm.release('a')
+        assert (await asyncio.wait_for(new,2.0)).action == 'admit'
+        assert adm.stats()['active'] == 1
+    asyncio.run( run() )
+
+def test_disabled_admits_everything():
+    adm = controller( { m: 10.0 for m in LADDER }, enabled=False )
+    assert all( adm.decide(f"s{i}",'en','fake').action == 'admit' for i in range(5) )
@@ -0,0 +1,116 @@
+import time
+import socket
+import asyncio
+import threading
+import pytest
+import numpy as np
+
+from asr_node import AsrNode, pack_msg, recv_msg, allowed_models
+from asr_remote import RemoteAsrService, NodeUnavailable
+from asr_backend import FakeBackend
+from whisper_transcribe import lang_to_model
+
+PORT = 5291
+SECRET = 'test-secret'
+
+def test_public_bind_requires_secret():
+    with pytest.raises(ValueError):
+        AsrNode( host='0.0.0.0', port=PORT )
+    assert lang_to_model('en','fake')[0] in allowed_models()
+    assert 'cpu:/etc' not in allowed_models()
+
+def connect(secret:str|None) ->socket.socket:
+    sock = socket.create_connection( ('127.0.0.1',PORT), timeout=5.0 )
+    if secret is not None:
+        sock.sendall( pack_msg({'op':'hello','secret':secret}) )
+    return sock
+
+def client_checks():
+    # 秘密が違えば切断される
+    sock = connect('wrong')
+    header, _ = recv_msg(sock)
+    assert header['op']=='error' and header['rid'] is None
+    assert recv_msg(sock) is None
+    sock.close()
+    # helloの前に要求を送っても受け付けない
+    sock = connect(None)
+    sock.sendall( pack_msg({'op':'prefetch','model':'x'}) )
+    assert recv_msg(sock)[0]['op']=='error'
+    sock.close()
+    # 不正な要求はエラーを返し、接続は続く
+    sock = connect(SECRET)
+    assert recv_msg(sock)[0]['op']=='status'
+    audio = np.zeros(1600,dtype=np.float32).tobytes()
+    sock.sendall( pack_msg({'op':'transcribe','rid':1,'model':'cpu:/tmp/evil','lang':'en'}, audio) )
+    sock.sendall( pack_msg({'op':'transcribe','model':lang_to_model('en','fake')[0]}, audio) ) # ridが無い
+    sock.sendall( pack_msg([1,2,3]) )
+    errors = []
+    while len(errors)<3:
+        header, _ = recv_msg(sock)
+        if header['op']=='error':
+            errors.append(header)
+    assert errors[0]['rid']==1 and 'not allowed' in errors[0]['error']
+    assert errors[1]['rid'] is None and 'rid' in errors[1]['error']
+    assert errors[2]['rid'] is None
+    sock.close()
+    # フロントから推論できる
+    service = RemoteAsrService( [f'127.0.0.1:{PORT}'], timeout=5.0, secret=SECRET )
+    service.start()
+    try:
+        t_end = time.time()+10
+        while not service.node_stats()['nodes'][f'127.0.0.1:{PORT}']['connected'] and time.time()<t_end:
+            time.sleep(0.05)
+        audio, _ = FakeBackend().synthesize()
+        segs = service.transcribe( audio, model=lang_to_model('en','fake')[0], lang='en', session='s1' )
+        assert len(segs)>0
+    finally:
+        service.stop()
+
+def test_node_authenticates_and_validates():
+    async def run():
+        node = AsrNode( port=PORT, secret=SECRET, workers=1, status_interval=0.2, hello_timeout=1.0 )
+        task = asyncio.create_task( node.serve(drain_timeout=5.0) )
+        try:
+            t_end = time.time()+10
+            while time.time()<t_end:
+                try:
+                    socket.create_connection( ('127.0.0.1',PORT), timeout=1.0 ).close()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+            await asyncio.to_thread( client_checks )
+            assert node.status()['rejected']>=3
+        finally:
+            node.drain()
+            await task
+    asyncio.run( run() )
+
+def test_request_timeout_fails_over():
+    """結果を返さないノードは、request_timeoutで諦めて別のノードでやり直す(ここではノードが1つなのでNodeUnavailable)"""
+    srv = socket.create_server( ('127.0.0.1',PORT+1) )
+    stop = threading.Event()
+    def stuck_node():
+        conn, _ = srv.accept()
+        recv_msg(conn) # hello
+        while not stop.is_set():
+            conn.sendall( pack_msg({'op':'status','node':'stuck','workers':1,'pending':0,'draining':False}) )
+            time.sleep(0.1)
+        conn.close()
+    th = threading.Thread( target=stuck_node, daemon=True )
+    th.start()
+    service = RemoteAsrService( [f'127.0.0.1:{PORT+1}'], timeout=5.0, request_timeout=0.3, retry=1, secret='' )
+    service.start()
+    try:
+        t_end = time.time()+10
+        while not service.node_stats()['nodes'][f'127.0.0.1:{PORT+1}']['connected'] and time.time()<t_end:
+            time.sleep(0.05)
+        t0 = time.time()
+        with pytest.raises(NodeUnavailable):
+            service.transcribe( np.zeros(1600,dtype=np.float32), model=lang_to_model('en','fake')[0], lang='en', session='s1' )
+        assert time.time()-t0 < 3.0
+        assert service.node_stats()['timeouts']==1
+    finally:
+        stop.set()
+        service.stop()
+        th.join(2.0)
+        srv.close()
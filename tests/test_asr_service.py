@@ -0,0 +1,57 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+from asr_backend import BACKENDS, FakeBackend
+from asr_service import AsrService
+from whisper_transcribe import lang_to_model
+
+MODEL = lang_to_model('en','fake')[0]
+
+@pytest.fixture
+def slow_fake(monkeypatch):
+    """ワーカーはforkで起動するので、差し替えたエンジンを引き継ぐ"""
+    monkeypatch.setitem( BACKENDS, 'fake', FakeBackend( overhead=1.0 ) )
+
+def audio() ->np.ndarray:
+    return FakeBackend().synthesize()[0][:16000]
+
+def test_result_timeout(slow_fake):
+    service = AsrService( workers=1, preload=[MODEL], request_timeout=0.3 )
+    service.start()
+    try:
+        t0 = time.time()
+        with pytest.raises(TimeoutError):
+            service.transcribe( audio(), model=MODEL, lang='en' )
+        assert time.time()-t0 < 0.8
+        assert service.pending() == 0
+    finally:
+        service.stop()
+
+def test_worker_exit_fails_request_and_restarts(slow_fake):
+    service = AsrService( workers=1, preload=[MODEL] )
+    service.start()
+    try:
+        err:list[Exception] = []
+        def call():
+            try:
+                service.transcribe( audio(), model=MODEL, lang='en' )
+            except Exception as ex:
+                err.append(ex)
+        th = threading.Thread( target=call )
+        th.start()
+        # 推論中に終了させる
+        t_end = time.time()+5.0
+        while not service._busy and time.time()<t_end:
+            time.sleep(0.05)
+        t0 = time.time()
+        service._procs[0].kill()
+        th.join(5.0)
+        assert not th.is_alive() and time.time()-t0 < 2.0
+        assert isinstance(err[0],RuntimeError) and 'exited' in str(err[0])
+        assert service.restarts == 1 and service.pending() == 0
+        # 起動し直したワーカーで続けられる
+        assert isinstance( service.transcribe( audio(), model=MODEL, lang='en' ), list )
+    finally:
+        service.stop()
@@ -0,0 +1,103 @@
+import os
+import struct
+import pytest
+
+from audio_format import sniff_audio, resync_offset, AudioFormat
+
+"""MediaRecorderが出力するのと同じ構造のヘッダを組み立てて判定する"""
+
+def ebml( eid:int, payload:bytes, *, unknown:bool=False ) ->bytes:
+    ib = eid.to_bytes( (eid.bit_length()+7)//8, 'big' )
+    if unknown:
+        return ib + b'\x01\xff\xff\xff\xff\xff\xff\xff' + payload
+    return ib + (0x0100000000000000 | len(payload)).to_bytes(8,'big') + payload
+
+def make_webm( *codecs:str, doctype:bytes=b'webm' ) ->bytes:
+    header = ebml(0x1A45DFA3, ebml(0x4286,b'\x01') + ebml(0x4282,doctype) )
+    info = ebml(0x1549A966, ebml(0x2AD7B1,b'\x0f\x42\x40') )
+    tracks = b''.join( ebml(0xAE, ebml(0xD7,bytes([i+1])) + ebml(0x86,c.encode())) for i,c in enumerate(codecs) )
+    cluster = ebml(0x1F43B675, ebml(0xE7,b'\x00') + os.urandom(200), unknown=True )
+    return header + ebml(0x18538067, info + ebml(0x1654AE6B,tracks) + cluster, unknown=True )
+
+def box( typ:bytes, payload:bytes ) ->bytes:
+    return struct.pack('>I4s',8+len(payload),typ) + payload
+
+def make_mp4( *fmts:bytes ) ->bytes:
+    traks = b''
+    for fmt in fmts:
+        stsd = box( b'stsd', b'\x00\x00\x00\x00' + struct.pack('>I',1) + box( fmt, bytes(28) ) )
+        traks += box( b'trak', box( b'mdia', box( b'minf', box( b'stbl', stsd ) ) ) )
+    return box( b'ftyp', b'isom\x00\x00\x02\x00isomiso6mp41' ) + box( b'moov', traks ) + box( b'moof', bytes(100) )
+
+def make_ogg( packet:bytes ) ->bytes:
+    return b'OggS' + bytes(22) + bytes([1]) + bytes([len(packet)]) + packet
+
+def make_wav( tag:int, *, ch:int=1, rate:int=16000, extra:bytes=b'' ) ->bytes:
+    fmt = struct.pack('<HHIIHH', tag, ch, rate, rate*2*ch, 2*ch, 16) + extra
+    chunks = b'LIST' + struct.pack('<I',3) + b'abc\x00' # 奇数長のチャンクは詰め物が付く
+    chunks += b'fmt ' + struct.pack('<I',len(fmt)) + fmt + b'data' + struct.pack('<I',320) + bytes(320)
+    return b'RIFF' + struct.pack('<I',4+len(chunks)) + b'WAVE' + chunks
+
+@pytest.mark.parametrize( 'data,expected', [
+    ( make_webm('A_OPUS'), ('webm','opus') ),
+    ( make_webm('V_VP8','A_VORBIS'), ('webm','vorbis') ), # 映像トラックは飛ばす
+    ( make_webm('A_AAC/MPEG4/LC',doctype=b'matroska'), ('matroska','aac') ),
+    ( make_mp4(b'mp4a'), ('mp4','aac') ),
+    ( make_mp4(b'avc1',b'Opus'), ('mp4','opus') ),
+    ( make_ogg(b'OpusHead\x01\x01'), ('ogg','opus') ),
+    ( make_ogg(b'\x01vorbis\x00\x00'), ('ogg','vorbis') ),
+    ( make_wav(1), ('wav','pcm') ),
+    ( make_wav(7), ('wav','mulaw') ),
+    ( make_wav(0xFFFE, extra=struct.pack('<HHI',22,16,4)+struct.pack('<H',3)+bytes(14)), ('wav','pcm') ),
+])
+def test_accepts_supported_headers(data:bytes, expected:tuple[str,str]):
+    assert sniff_audio(data) == AudioFormat(*expected,'')
+
+@pytest.mark.parametrize( 'data,codec', [
+    ( make_webm('A_UNKNOWN'), 'A_UNKNOWN' ),
+    ( make_mp4(b'ac-3'), 'ac-3' ),
+    ( make_ogg(b'Speex   \x01'), 'speex' ),
+    ( make_wav(0x11), '0x0011' ),
+])
+def test_rejects_unsupported_codecs(data:bytes, codec:str):
+    fmt = sniff_audio(data)
+    assert fmt is not None and fmt.codec == codec
+    assert fmt.error.startswith('unsupported codec')
+
+def test_invalid_wav_format():
+    fmt = sniff_audio( make_wav(1,rate=0) )
+    assert fmt is not None and fmt.codec == 'pcm' and fmt.error.startswith('invalid wav format')
+
+@pytest.mark.parametrize( 'data', [ make_webm('A_OPUS'), make_mp4(b'Opus'), make_ogg(b'OpusHead\x01\x01'), make_wav(1) ] )
+def test_truncated_header_is_undecided(data:bytes):
+    """コーデックが分かる前に切れていれば判定しない(Noneで、次のチャンクを待つ)"""
+    full = sniff_audio(data)
+    assert full is not None and full.error == ''
+    for n in range(len(data)):
+        fmt = sniff_audio( data[:n] )
+        if fmt is not None:
+            # 判定できたなら、全体を見た時と同じ
+            assert fmt == full
+    assert sniff_audio( data[:8] ) is None
+
+def test_unknown_and_broken_headers():
+    assert sniff_audio(b'') is None
+    assert sniff_audio(b'ID3\x04' + bytes(100)) is None
+    # 続きの無い、クラスタの途中からのデータ
+    assert sniff_audio( make_webm('A_OPUS')[-150:] ) is None
+    # 壊れたヘッダは判定できないのではなく、エラーで返す
+    fmt = sniff_audio( b'\x1a\x45\xdf\xa3' + b'\x00' + bytes(20) )
+    assert fmt is not None and fmt.error.startswith('broken audio header')
+    fmt = sniff_audio( box(b'ftyp',b'isom') + struct.pack('>I4s',4,b'moov') )
+    assert fmt is not None and fmt.error.startswith('broken audio header')
+
+def test_resync_offset():
+    data = make_webm('A_OPUS')
+    cluster = data.find(b'\x1f\x43\xb6\x75')
+    assert resync_offset( 'webm', data ) == cluster
+    mp4 = make_mp4(b'Opus')
+    assert resync_offset( 'mp4', mp4 ) == mp4.find(b'moof')-4
+    assert resync_offset( 'ogg', b'xx'+make_ogg(b'OpusHead') ) == 2
+    assert resync_offset( 'webm', b'\x00'*10 ) == -1
+    assert resync_offset( 'mp4', b'moof' ) == -1
+    assert resync_offset( 'wav', b'\x00'*10 ) == 0
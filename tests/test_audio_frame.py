@@ -0,0 +1,113 @@
+import pytest
+import numpy as np
+
+from audio_frame import pack_frame, parse_frame, FrameError, FrameOrder, FrameStream, CODEC_PCM, CODEC_WEBM
+
+SAMPLE_RATE = 16000
+CHUNK = 3200 # 0.2秒
+
+def frame(seq:int, ts:float=0.0, codec:int=CODEC_PCM, payload:bytes=b'ab'):
+    return parse_frame( pack_frame(seq,ts,codec,payload) )
+
+def test_parse_rejects_corrupt_frames():
+    data = bytearray( pack_frame(7,1.5,CODEC_PCM,b'\x01\x02\x03\x04') )
+    f = parse_frame(bytes(data))
+    assert (f.seq,f.ts,bytes(f.payload)) == (7,1.5,b'\x01\x02\x03\x04')
+    bad = bytearray(data)
+    bad[-1] ^= 1
+    with pytest.raises(FrameError):
+        parse_frame(bytes(bad))
+    with pytest.raises(FrameError):
+        parse_frame(bytes(data[:-1]))
+    with pytest.raises(FrameError):
+        parse_frame(b'XX'+bytes(data[2:]))
+
+def seqs(out) ->list[tuple[int,int]]:
+    return [ (f.seq,missing) for f,missing in out ]
+
+def test_order_reorders_within_window():
+    order = FrameOrder( window=4 )
+    assert seqs(order.push(frame(0))) == [(0,0)]
+    assert seqs(order.push(frame(2))) == []
+    assert seqs(order.push(frame(1))) == [(1,0),(2,0)]
+    assert order.stats() == { 'received': 3, 'reordered': 1, 'lost': 0, 'dropped': 0 }
+
+def test_order_gives_up_after_window():
+    order = FrameOrder( window=2 )
+    order.push(frame(0))
+    assert seqs(order.push(frame(3))) == []
+    assert seqs(order.push(frame(4))) == []
+    # 3個待っても1,2が届かないので欠けとして進む
+    assert seqs(order.push(frame(5))) == [(3,2),(4,0),(5,0)]
+    assert order.lost == 2
+    # 遅れて届いたものと重複は捨てる
+    assert order.push(frame(1)) == [] and order.push(frame(5)) == []
+    assert order.dropped == 2
+
+def test_order_flush_skips_gaps():
+    order = FrameOrder( window=4 )
+    order.push(frame(0))
+    order.push(frame(2))
+    order.push(frame(5))
+    assert seqs(order.flush()) == [(2,1),(5,2)]
+    assert order.lost == 3
+
+def pcm_frames(n:int, jitter:list[float]|None=None) ->tuple[np.ndarray,list[bytes]]:
+    ref = (np.arange(n*CHUNK) % 30000).astype(np.int16)
+    ts = [ i*200.0 + (jitter[i] if jitter else 0.0) for i in range(n) ]
+    return ref, [ pack_frame(i, ts[i], CODEC_PCM, ref[i*CHUNK:(i+1)*CHUNK].tobytes()) for i in range(n) ]
+
+def run(stream:FrameStream, frames:list[bytes], order:list[int]) ->np.ndarray:
+    out:list[bytes] = []
+    for i in order:
+        chunks,_ = stream.push( parse_frame(frames[i]) )
+        out += [ bytes(c[2]) for c in chunks ]
+    chunks,_ = stream.flush()
+    out += [ bytes(c[2]) for c in chunks ]
+    return np.frombuffer(b''.join(out),dtype=np.int16)
+
+def test_pcm_gap_filled_by_frame_count_despite_jitter():
+    """キャプチャの時刻が揺れても、欠けたフレームの数だけ無音で埋めて以後の位置がずれない"""
+    n = 20
+    jitter = [ 0.0 ]*n
+    jitter[5] = 35.0 # 欠けの前後の時刻が揺れている
+    jitter[8] = -40.0
+    ref, frames = pcm_frames(n, jitter)
+    lost = {6,7}
+    got = run( FrameStream( sample_rate=SAMPLE_RATE ), frames, [ i for i in range(n) if i not in lost ] )
+    expect = ref.copy()
+    for i in lost:
+        expect[i*CHUNK:(i+1)*CHUNK] = 0
+    assert len(got)==len(ref)
+    assert np.array_equal(got,expect)
+
+def test_pcm_fill_bounded_by_timestamps():
+    """欠けた数が時刻の差と合わない(番号が飛んだ)ときは、時刻の差+1フレームまでしか埋めない"""
+    ref, frames = pcm_frames(3)
+    stream = FrameStream( window=0, sample_rate=SAMPLE_RATE )
+    stream.push( parse_frame(frames[0]) )
+    chunks,lost = stream.push( parse_frame( pack_frame(50, 400.0, CODEC_PCM, ref[:CHUNK].tobytes()) ) )
+    assert lost == 49
+    assert len(chunks[0][2]) == 2*CHUNK*2 # 200ms+1フレーム
+    # 時刻が戻っていれば欠けた数で埋めるが、max_fill_msまで
+    stream = FrameStream( window=0, sample_rate=SAMPLE_RATE, max_fill_ms=1000.0 )
+    stream.push( parse_frame(frames[2]) )
+    chunks,_ = stream.push( parse_frame( pack_frame(20, 0.0, CODEC_PCM, ref[:CHUNK].tobytes()) ) )
+    assert len(chunks[0][2]) == SAMPLE_RATE*2
+    assert stream.stats()['filled_ms'] == 1000.0
+
+def test_webm_resumes_at_cluster():
+    cluster = b'\x1f\x43\xb6\x75'
+    data = b'\x1a\x45\xdf\xa3' + bytes(60) + b''.join( cluster + bytes([i+1])*500 for i in range(6) )
+    chunks = [ data[i:i+400] for i in range(0,len(data),400) ]
+    stream = FrameStream( window=0 )
+    out:list[bytes] = []
+    for i,c in enumerate(chunks):
+        if i==3:
+            continue
+        got,_ = stream.push( frame(i, i*200.0, CODEC_WEBM, c) )
+        out += [ bytes(x[2]) for x in got ]
+    sent = b''.join(out)
+    resumed = sent[len(b''.join(chunks[:3])):]
+    assert resumed.startswith(cluster) and data.endswith(resumed)
+    assert stream.skipped > 0
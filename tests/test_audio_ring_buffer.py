@@ -0,0 +1,80 @@
+import io
+import numpy as np
+
+from rec_util import AudioRingBuffer
+
+def pcm(start:int, n:int) ->np.ndarray:
+    """通しの位置をそのまま値にしたint16(どこを読んだか分かる)"""
+    return ((np.arange(start,start+n) % 30000) - 15000).astype(np.int16)
+
+def f32(a:np.ndarray) ->np.ndarray:
+    return a.astype(np.float32)/32768.0
+
+def test_write_view_drop():
+    buf = AudioRingBuffer( 100 )
+    assert buf.write( pcm(0,60).tobytes() ) == 60
+    assert len(buf) == 60 and buf.space() == 40 and buf.head == 0
+    np.testing.assert_array_equal( buf.view(), f32(pcm(0,60)) )
+    np.testing.assert_array_equal( buf.view(10,20), f32(pcm(10,10)) )
+    # 範囲外は切り詰める
+    assert len( buf.view(50,999) ) == 10 and len( buf.view(70,80) ) == 0
+    buf.drop(25)
+    assert buf.head == 25 and len(buf) == 35
+    np.testing.assert_array_equal( buf.view(0,5), f32(pcm(25,5)) )
+    # 保持している以上は捨てない
+    buf.drop(1000)
+    assert len(buf) == 0 and buf.head == 60
+
+def test_full_buffer_discards_excess():
+    buf = AudioRingBuffer( 100 )
+    assert buf.write( pcm(0,130).tobytes() ) == 100
+    assert buf.space() == 0 and buf.write( pcm(100,10).tobytes() ) == 0
+    np.testing.assert_array_equal( buf.view(), f32(pcm(0,100)) )
+
+def test_wraparound_view_is_contiguous():
+    """末尾がリングの終わりを越えても、ミラーでview()は連続したままで内容も正しい"""
+    buf = AudioRingBuffer( 100 )
+    pos = 0
+    for n in (70, 45, 33, 90, 17, 100):
+        buf.drop( len(buf)+n-buf.capacity )
+        assert buf.write( pcm(pos,n).tobytes() ) == n
+        pos += n
+        v = buf.view()
+        assert v.flags['C_CONTIGUOUS'] and v.base is not None
+        np.testing.assert_array_equal( v, f32(pcm(buf.head,len(buf))) )
+    # 書き込みがリングの終わりで2つに分かれている
+    assert buf.head % buf.capacity + len(buf) > buf.capacity
+
+def test_view_across_mirror_boundary():
+    buf = AudioRingBuffer( 100 )
+    buf.write( pcm(0,90).tobytes() )
+    buf.drop(80)
+    buf.write( pcm(90,50).tobytes() ) # 90..99と0..39に書く
+    assert buf.head == 80 and len(buf) == 60
+    # 境界(位置100)を挟む範囲
+    np.testing.assert_array_equal( buf.view(15,35), f32(pcm(95,20)) )
+    np.testing.assert_array_equal( buf.view(), f32(pcm(80,60)) )
+    # ビューはコピーではない
+    v = buf.view()
+    assert np.shares_memory( v, buf._data )
+
+def test_readinto_wraps_and_limits_to_chunk():
+    src = pcm(0,500)
+    reader = io.BytesIO( src.tobytes() )
+    buf = AudioRingBuffer( 200, chunk=64 )
+    pos = 0
+    while True:
+        buf.drop( max(0,len(buf)-100) )
+        mv = buf.readinto( reader, 1000 )
+        if len(mv)==0:
+            break
+        # 作業用配列のビューは読み込んだint16そのもの
+        assert len(mv) <= 64*2
+        np.testing.assert_array_equal( np.frombuffer(mv,dtype=np.int16), src[pos:pos+len(mv)//2] )
+        pos += len(mv)//2
+        np.testing.assert_array_equal( buf.view(), f32(src[buf.head:pos]) )
+    assert pos == 500 and buf.head+len(buf) == 500
+    # 空きが無ければ読まない
+    full = AudioRingBuffer( 10 )
+    full.write( pcm(0,10).tobytes() )
+    assert len( full.readinto( io.BytesIO(b'\0\0'*4), 100 ) ) == 0
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import asr_backend
+from asr_backend import NoBackendError, default_backend
+from model_registry import ModelRegistry
+
+def test_default_backend_from_env(monkeypatch):
+    monkeypatch.setenv('ASR_BACKEND','fake')
+    assert default_backend()=='fake'
+
+def test_default_backend_without_engine_raises(monkeypatch):
+    monkeypatch.delenv('ASR_BACKEND',raising=False)
+    monkeypatch.setattr(asr_backend,'USE_MLX_WHISPER',False)
+    monkeypatch.setattr(asr_backend,'USE_FASTER_WHISPER',False)
+    with pytest.raises(NoBackendError):
+        default_backend()
+
+def test_registry_transcribe_without_engine_raises(monkeypatch):
+    """エンジンが無いときに空の結果(無音と同じ)を返さない"""
+    monkeypatch.setattr(asr_backend.CpuBackend,'available',lambda self: False)
+    registry = ModelRegistry( budget_mb=64 )
+    with pytest.raises(NoBackendError):
+        registry.transcribe( 'cpu:tiny', np.zeros(16000,dtype=np.float32), lang=None, prompt=None )
+
+def test_registry_transcribe_fake():
+    registry = ModelRegistry( budget_mb=64, warmup=False )
+    audio, _ = asr_backend.FakeBackend().synthesize()
+    segs = registry.transcribe( 'fake:tiny', audio, lang='en', prompt=None )
+    assert len(segs)>0 and all( s['text'] for s in segs )
+
+def test_tokenizer_failure_is_not_cached(monkeypatch):
+    """モデルのダウンロード前で作れなかったトークナイザは、後で作り直す"""
+    calls:list[int] = []
+    class LateTokenizer(asr_backend.FakeBackend):
+        def tokenizer(self, path:str):
+            calls.append(1)
+            if len(calls)==1:
+                raise FileNotFoundError('tokenizer.json')
+            return asr_backend.SimpleTokenizer()
+    monkeypatch.setitem( asr_backend.BACKENDS, 'late', LateTokenizer() )
+    monkeypatch.setattr( asr_backend, '_tokenizers', {} )
+    assert asr_backend.get_tokenizer('late:m') is None
+    tok = asr_backend.get_tokenizer('late:m')
+    assert tok is not None
+    assert asr_backend.get_tokenizer('late:m') is tok and len(calls)==2
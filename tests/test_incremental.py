@@ -0,0 +1,58 @@
+import time
+import asyncio
+import numpy as np
+
+from whisper_transcribe import MlxWhisperProcess, Seg, merge_window_segments, SAMPLE_RATE
+from asr_backend import BACKENDS, FakeBackend
+from asr_service import AsrService
+from load_controller import get_load_controller
+
+def seg(start:float, end:float, text:str) ->Seg:
+    return Seg(0,0,start,end,text,-0.1,1.0,0.0)
+
+def test_merge_prefers_previous_hypothesis_in_overlap():
+    keep = [ seg(0.0,4.0,'a'), seg(4.5,9.0,'b') ]
+    window = [ seg(0.0,0.8,'b2'), seg(1.0,3.0,'c') ] # ウィンドウは8秒から
+    merged = merge_window_segments( keep, window, 8.0 )
+    assert [ s.text for s in merged ] == ['a','b','c']
+    assert merged[-1].start == 9.0 and merged[-1].end == 11.0
+
+def test_long_monologue_decodes_bounded_window():
+    """区切りの無い長い発話でも、1回にデコードする音声はウィンドウとオーバーラップまで"""
+    window_sec, overlap_sec, audio_sec = 4.0, 1.0, 14
+    load = get_load_controller()
+    load.enabled = False
+    saved = BACKENDS['fake']
+    # 文の間も区切らないので、全体が1つのセグメントになる
+    BACKENDS['fake'] = FakeBackend( rtf=0.01, overhead=0.0, segment_gap=60.0 )
+    service = AsrService( workers=1 )
+    service.start()
+    try:
+        audio, _ = BACKENDS['fake'].synthesize( sentence_gap=0.1 )
+        audio = np.tile( audio, 3 )[:audio_sec*SAMPLE_RATE]
+        pcm = (audio*32767).astype(np.int16).tobytes()
+        proc = MlxWhisperProcess( service=service, incremental=True, window_sec=window_sec, overlap_sec=overlap_sec, vad=False, policy='local_agreement' )
+        proc.set_language( 'en', 'fake' )
+        stats:list[dict] = []
+        async def run():
+            proc.start(pcm=True)
+            async def reader():
+                while (await proc.read(timeout=0.5)) is not None:
+                    stats.extend( load.stats()['sessions'].values() )
+            task = asyncio.create_task( reader() )
+            chunk = SAMPLE_RATE//5*2
+            for i in range(0,len(pcm),chunk):
+                proc.append_audio( 0, 'pcm', pcm[i:i+chunk] )
+                await asyncio.sleep(0.02)
+            proc.close_audio()
+            await asyncio.wait_for( task, 30 )
+            await asyncio.to_thread( proc.stop )
+        asyncio.run( run() )
+        proc.close()
+    finally:
+        service.stop()
+        BACKENDS['fake'] = saved
+        load.enabled = True
+    assert stats, "no decode step"
+    assert max( s['decoded_sec'] for s in stats ) > audio_sec*0.5
+    assert max( s['max_decoded_sec'] for s in stats ) <= window_sec+overlap_sec+0.01
@@ -0,0 +1,73 @@
+import time
+import asyncio
+
+from llm_cache import ResultCache, cache_key, normalize_text
+
+def test_key_normalizes_width_and_spaces():
+    assert normalize_text(' ＡＢＣ　 def\n') == 'ABC def'
+    assert cache_key('summary',1,'ＡＢＣ  def') == cache_key('summary',1,'ABC def')
+    assert cache_key('summary',1,'abc') != cache_key('summary',2,'abc')
+    assert cache_key('summary',1,'abc') != cache_key('translation',1,'abc')
+
+def test_identical_requests_are_coalesced():
+    cache = ResultCache()
+    calls:list[int] = []
+    async def llm() ->str:
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'answer'
+    async def run():
+        res = await asyncio.gather( *[ cache.get_or_run('k',llm) for _ in range(5) ] )
+        res.append( await cache.get_or_run('k',llm) )
+        return res
+    res = asyncio.run( run() )
+    assert len(calls) == 1
+    assert sorted( r[1] for r in res ) == ['coalesced']*4 + ['hit','miss']
+    assert all( r[0]=='answer' for r in res )
+    st = cache.stats()
+    assert (st['misses'],st['coalesced'],st['hits'],st['inflight']) == (1,4,1,0)
+
+def test_failure_is_shared_and_not_cached():
+    cache = ResultCache()
+    calls:list[int] = []
+    async def fail() ->str:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError('llm down')
+    async def ok() ->str:
+        return 'fine'
+    async def run():
+        res = await asyncio.gather( cache.get_or_run('k',fail), cache.get_or_run('k',fail), return_exceptions=True )
+        assert all( isinstance(r,RuntimeError) for r in res )
+        return await cache.get_or_run('k',ok)
+    assert asyncio.run( run() ) == ('fine','miss')
+    assert len(calls) == 1 and cache.stats()['errors'] == 1
+
+def test_cancelled_first_request_does_not_stop_others():
+    """先に来た要求が切断されても、待っている要求には結果が届く"""
+    cache = ResultCache()
+    async def llm() ->str:
+        await asyncio.sleep(0.1)
+        return 'answer'
+    async def run():
+        first = asyncio.create_task( cache.get_or_run('k',llm) )
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task( cache.get_or_run('k',llm) )
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+    assert asyncio.run( run() ) == ('answer','coalesced')
+    assert cache.get('k') == 'answer'
+
+def test_ttl_and_lru_eviction(monkeypatch):
+    cache = ResultCache( max_entries=2, ttl_sec=10.0 )
+    cache.put('a','1')
+    cache.put('b','2')
+    assert cache.get('a') == '1' # aを最後に使った
+    cache.put('c','3')
+    assert cache.get('b') is None and cache.get('a') == '1' and cache.get('c') == '3'
+    now = time.time()
+    monkeypatch.setattr( time, 'time', lambda: now+11.0 )
+    assert cache.get('a') is None
+    st = cache.stats()
+    assert st['evicted'] == 1 and st['expired'] == 1
@@ -0,0 +1,70 @@
+import pytest
+
+import load_controller
+from load_controller import LoadController
+
+LEVELS = 5
+
+class Clock:
+    """load_controllerの時刻を進める"""
+    def __init__(self):
+        self.now = 1000.0
+    def time(self) ->float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) ->Clock:
+    c = Clock()
+    monkeypatch.setattr( load_controller, 'time', c )
+    return c
+
+def feed(ctl:LoadController, clock:Clock, rtf:float, sec:int, *, queue:float=0.0, session:str='s', levels:int=LEVELS) ->list[int]:
+    """1秒毎に1秒分の音声をrtfでデコードしたとして、毎秒の段を返す"""
+    ret:list[int] = []
+    for _ in range(sec):
+        clock.now += 1.0
+        ret.append( ctl.update( session, rtf, 1.0, queue, levels ) )
+    return ret
+
+def test_step_down_and_recover(clock):
+    ctl = LoadController( hold_sec=10.0, host_high=100.0, host_low=100.0 )
+    # 遅い間はhold_sec毎に1段ずつ下げる(切り替えの直後は測り直すので待つ)
+    levels = feed( ctl, clock, 0.8, 25 )
+    assert levels == [0]*10 + [1]*10 + [2]*5
+    # 下げる閾値と戻す閾値の間では変えない
+    assert set( feed( ctl, clock, 0.4, 60 ) ) == {2}
+    # 十分速くなったら(移動平均が下がったら)1段ずつ戻し、段0より上にはしない
+    levels = feed( ctl, clock, 0.1, 40 )
+    assert levels == [2] + [1]*10 + [0]*29
+
+def test_does_not_go_below_last_level(clock):
+    ctl = LoadController( hold_sec=1.0, host_high=100.0, host_low=100.0 )
+    assert max( feed( ctl, clock, 2.0, 30 ) ) == LEVELS-1
+
+def test_queue_steps_down_and_blocks_recovery(clock):
+    ctl = LoadController( hold_sec=10.0, host_high=100.0, host_low=100.0 )
+    # RTFが低くても、追いついていない音声が溜まれば下げる
+    assert feed( ctl, clock, 0.1, 11, queue=5.0 )[-1] == 1
+    # 溜まっている間は戻さない
+    assert set( feed( ctl, clock, 0.1, 30, queue=1.0 ) ) == {1}
+    assert feed( ctl, clock, 0.1, 1, queue=0.0 ) == [0]
+
+def test_host_duty_hysteresis(clock):
+    """他のセッションの推論で共有のワーカーが埋まっていれば速いセッションも下げ、host_lowを下回るまで戻さない"""
+    ctl = LoadController( hold_sec=5.0, host_high=0.9, host_low=0.5 )
+    def run(a_rtf:float, n:int) ->list[int]:
+        # aは段が1つだけ(下げられない)のセッション。2秒毎に1回デコードするのでdutyはa_rtf/2
+        ret:list[int] = []
+        for _ in range(n):
+            feed( ctl, clock, a_rtf, 1, session='a', levels=1 )
+            ret += feed( ctl, clock, 0.1, 1, session='b' )
+        return ret
+    levels = run( 1.9, 8 )
+    assert ctl.host_duty() > 0.9
+    assert levels == [0,0,0,1,1,1,2,2]
+    # 閾値の間では戻さない
+    assert set( run( 1.2, 20 ) ) == {2}
+    assert 0.5 < ctl.host_duty() < 0.9
+    # 重いセッションが抜ければ1段ずつ戻す
+    ctl.remove('a')
+    assert feed( ctl, clock, 0.1, 12, session='b' ) == [1]*5 + [0]*7
@@ -0,0 +1,64 @@
+import threading
+import numpy as np
+import pytest
+
+from asr_backend import BACKENDS, FakeBackend
+from model_registry import ModelRegistry
+
+MB = 1048576
+
+class SizedFake(FakeBackend):
+    """100MBのモデルとして扱い、捨てたモデルを記録する。推論はgateが開くまで待つ"""
+    name = 'sized'
+    def __init__(self):
+        super().__init__()
+        self.unloaded:list[str] = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.running = threading.Event()
+
+    def load(self, path:str):
+        return path, 100*MB
+
+    def unload(self, model):
+        self.unloaded.append(model)
+
+    def transcribe(self, model, path, audio, *, lang, prompt):
+        assert model not in self.unloaded
+        self.running.set()
+        self.gate.wait(5.0)
+        return []
+
+@pytest.fixture
+def fake(monkeypatch) ->SizedFake:
+    backend = SizedFake()
+    monkeypatch.setitem( BACKENDS, 'sized', backend )
+    return backend
+
+def loaded(reg:ModelRegistry) ->list[str]:
+    return [ e['path'] for e in reg.stats() ]
+
+def test_evicts_least_recently_used(fake):
+    reg = ModelRegistry( budget_mb=250, warmup=False )
+    reg.get('sized:a')
+    reg.get('sized:b')
+    reg.transcribe( 'sized:a', np.zeros(160,dtype=np.float32), lang=None, prompt=None ) # aを最後に使った
+    reg.get('sized:c')
+    assert fake.unloaded == ['b']
+    assert loaded(reg) == ['sized:a','sized:c']
+
+def test_model_in_use_is_not_evicted(fake):
+    reg = ModelRegistry( budget_mb=150, warmup=False )
+    fake.gate.clear()
+    th = threading.Thread( target=reg.transcribe, args=('sized:a',np.zeros(160,dtype=np.float32)), kwargs={'lang':None,'prompt':None} )
+    th.start()
+    assert fake.running.wait(5.0)
+    # 推論中のaは予算を超えても捨てない
+    reg.get('sized:b')
+    assert fake.unloaded == []
+    assert loaded(reg) == ['sized:a','sized:b']
+    # 使い終わったら捨てる
+    fake.gate.set()
+    th.join(5.0)
+    assert fake.unloaded == ['a']
+    assert loaded(reg) == ['sized:b']
@@ -0,0 +1,60 @@
+from prompt_context import PromptContext, SimpleTokenizer
+
+def test_simple_tokenizer_roundtrip():
+    tk = SimpleTokenizer()
+    tokens = tk.encode(' Hello, world 会議')
+    assert tokens == [' Hello', ',', ' world', ' 会', '議']
+    assert tk.decode(tokens) == ' Hello, world 会議'
+
+def test_empty_context():
+    ctx = PromptContext( budget=8 )
+    assert ctx.prompt() == (None,0)
+    ctx.commit('   ')
+    assert ctx.prompt() == (None,0)
+
+def test_prompt_keeps_tail_within_budget():
+    ctx = PromptContext( budget=5 )
+    ctx.commit('one two three')
+    assert ctx.prompt() == ('one two three',3)
+    ctx.commit('four five six')
+    # 末尾の5トークンに切り詰める
+    assert ctx.prompt() == ('two three four five six',5)
+    ctx.commit('seven eight nine ten eleven')
+    assert ctx.prompt() == ('seven eight nine ten eleven',5)
+    # 上限に足りるテキストより前は捨てている
+    assert [ t for t,_ in ctx._texts ] == ['seven eight nine ten eleven']
+
+def test_prompt_is_cached_and_text_encoded_once():
+    ctx = PromptContext( budget=16 )
+    ctx.commit('alpha beta')
+    ctx.commit('gamma')
+    assert ctx.encoded == 2
+    first = ctx.prompt()
+    assert ctx.prompt() is first
+    ctx.commit('delta')
+    assert ctx.prompt() == ('alpha beta gamma delta',4)
+    assert ctx.encoded == 3
+
+def test_set_tokenizer_reencodes():
+    class CharTokenizer:
+        def encode(self, text:str) ->list:
+            return list(text)
+        def decode(self, tokens:list) ->str:
+            return ''.join(tokens)
+    ctx = PromptContext( budget=6 )
+    ctx.commit('ab cd')
+    assert ctx.prompt() == ('ab cd',2)
+    ctx.set_tokenizer( CharTokenizer() )
+    # ' ab cd' の6文字がちょうど上限
+    assert ctx.prompt() == ('ab cd',6)
+    ctx.commit('ef')
+    assert ctx.prompt() == ('cd ef',6)
+
+def test_zero_budget_and_reset():
+    ctx = PromptContext( budget=0 )
+    ctx.commit('anything')
+    assert ctx.prompt() == (None,0) and ctx.encoded == 0
+    ctx = PromptContext( budget=4 )
+    ctx.commit('a b')
+    ctx.reset()
+    assert ctx.prompt() == (None,0)
@@ -0,0 +1,106 @@
+import os
+import io
+import wave
+import asyncio
+import numpy as np
+import aiohttp
+from aiohttp import web
+
+from session_recorder import RecordingSink, RecordingReader, SAMPLE_RATE
+from transcribe_server import create_app
+
+PORT = 5294
+
+def tone(sec:float, value:int) ->bytes:
+    return np.full( int(sec*SAMPLE_RATE), value, dtype=np.int16 ).tobytes()
+
+def record(path:str, marks:list[tuple[int,float,float]], pcm:bytes) ->int:
+    sink = RecordingSink(path)
+    sink.start()
+    base = sink.base_sample
+    sink.write(pcm)
+    for seq,s,e in marks:
+        sink.mark( seq, int(s*SAMPLE_RATE), int(e*SAMPLE_RATE) )
+    sink.close()
+    return base
+
+def test_sink_reader_round_trip(tmp_path):
+    path = str(tmp_path/'rec')
+    assert record( path, [(0,0.0,1.0),(1,1.0,1.5)], tone(1.0,100)+tone(1.0,200) ) == 0
+    # 2回目の録音は後ろに追記し、位置は録音の先頭からの通し
+    assert record( path, [(2,0.5,1.0)], tone(1.0,300) ) == 2*SAMPLE_RATE
+    reader = RecordingReader(path)
+    assert reader.segments() == [ (0,0.0,1.0), (1,1.0,1.5), (2,2.5,3.0) ]
+    assert reader.find(1.2) == 1 and reader.find(2.0) == 1 and reader.find(2.7) == 2
+    seg = np.frombuffer( reader.segment_audio(1), dtype=np.int16 )
+    assert len(seg) == SAMPLE_RATE//2 and (seg==200).all()
+    seg = np.frombuffer( reader.segment_audio(2), dtype=np.int16 )
+    assert len(seg) == SAMPLE_RATE//2 and (seg==300).all()
+    assert reader.segment_audio(9) == b''
+    # 書きかけの索引レコードは読まない
+    with open( os.path.join(path,'index.bin'), 'ab' ) as f:
+        f.write(b'\x03\x00')
+    reader.reload()
+    assert len(reader.segments()) == 3
+
+def test_recording_route(tmp_path, monkeypatch):
+    """履歴の録音の一覧と、セグメントの音声(WAV)を引く"""
+    monkeypatch.chdir( tmp_path )
+    os.mkdir('static')
+    for k,v in { 'ASR_BACKEND': 'fake', 'ASR_WORKERS': '0', 'ASR_POOL_SIZE': '0' }.items():
+        monkeypatch.setenv( k, v )
+    record( 'tmp/rec/abc123', [(0,0.0,0.5),(1,0.5,1.0)], tone(0.5,100)+tone(0.5,200) )
+    async def run():
+        app, sio = await create_app()
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite( runner, host='127.0.0.1', port=PORT ).start()
+        try:
+            async with aiohttp.ClientSession( f"http://127.0.0.1:{PORT}" ) as http:
+                async with http.get('/recording/abc123') as res:
+                    assert (await res.json())['segments'] == [ [0,0.0,0.5], [1,0.5,1.0] ]
+                async with http.get('/recording/abc123/1') as res:
+                    assert res.content_type == 'audio/wav'
+                    with wave.open( io.BytesIO(await res.read()) ) as wf:
+                        assert wf.getframerate() == SAMPLE_RATE and wf.getnframes() == SAMPLE_RATE//2
+                        assert (np.frombuffer(wf.readframes(wf.getnframes()),dtype=np.int16)==200).all()
+                for url in ('/recording/abc123/5','/recording/nothing','/recording/..%2Frec'):
+                    async with http.get(url) as res:
+                        assert res.status == 404
+        finally:
+            await runner.cleanup()
+    asyncio.run( run() )
+
+def test_session_marks_match_result_seq(tmp_path):
+    """デコードループの確定セグメントの番号で、録音の索引からその音声を引ける"""
+    from whisper_transcribe import MlxWhisperProcess
+    from asr_service import AsrService
+    from test_session_stop import speech_pcm, feed
+    service = AsrService( workers=1 )
+    service.start()
+    try:
+        proc = MlxWhisperProcess( service=service, incremental=True, policy='local_agreement' )
+        proc.set_language( 'en', 'fake' )
+        proc.set_recording( str(tmp_path/'rec') )
+        proc.set_next_seq( 10 )
+        proc.start( pcm=True )
+        async def run() ->list:
+            segs:list = []
+            async def reader():
+                while (res := await proc.read(timeout=0.5,segments=True)) is not None:
+                    segs.extend( res[0] )
+            task = asyncio.create_task( reader() )
+            await asyncio.to_thread( feed, proc, speech_pcm(6.0) )
+            proc.close_audio()
+            await asyncio.wait_for( task, 20.0 )
+            return segs
+        segs = asyncio.run( run() )
+        proc.stop()
+        proc.close()
+    finally:
+        service.stop()
+    assert segs and segs[0].seq == 10
+    reader = RecordingReader( str(tmp_path/'rec') )
+    assert [ q for q,_,_ in reader.segments() ] == [ x.seq for x in segs ]
+    for x in segs:
+        assert len(reader.segment_audio(x.seq)) == (int(x.end*SAMPLE_RATE)-int(x.start*SAMPLE_RATE))*2
@@ -0,0 +1,48 @@
+import time
+import threading
+import numpy as np
+
+from whisper_transcribe import MlxWhisperProcess, SAMPLE_RATE
+from asr_backend import FakeBackend
+from asr_service import AsrService
+
+def speech_pcm(sec:float) ->bytes:
+    audio, _ = FakeBackend().synthesize()
+    audio = np.tile( audio, 4 )[:int(sec*SAMPLE_RATE)]
+    return (audio*32767).astype(np.int16).tobytes()
+
+def feed(proc:MlxWhisperProcess, pcm:bytes):
+    chunk = SAMPLE_RATE//5*2
+    for i in range(0,len(pcm),chunk):
+        proc.append_audio( 0, 'pcm', pcm[i:i+chunk] )
+        time.sleep(0.01)
+
+def copy_threads() ->int:
+    return sum( 1 for t in threading.enumerate() if t.name in ('ffmpeg_stdin','ffmpeg_stdout','whisper_ctrl') )
+
+def test_stop_without_close_audio_ends_decode_loop():
+    """サーバのaudioStopと切断はclose_audio()を呼ばずにstop()する。入力を閉じてデコードループがすぐ終わること"""
+    service = AsrService( workers=1 )
+    service.start()
+    try:
+        before = copy_threads()
+        proc = MlxWhisperProcess( service=service, incremental=True, policy='local_agreement' )
+        proc.set_language( 'en', 'fake' )
+        proc.start( pcm=True )
+        # 1秒に足りない端数を残して、デコードループが音声の到着待ちで止まっているところでstop()する
+        feed( proc, speech_pcm(2.5) )
+        time.sleep(1.5)
+        loop = proc._whisper_process
+        assert isinstance(loop,threading.Thread) and loop.is_alive()
+        t0 = time.time()
+        proc.stop()
+        assert time.time()-t0 < 1.0
+        loop.join(1.0)
+        assert not loop.is_alive()
+        t_end = time.time()+2.0
+        while copy_threads()>before and time.time()<t_end:
+            time.sleep(0.05)
+        assert copy_threads()==before
+        proc.close()
+    finally:
+        service.stop()
@@ -0,0 +1,149 @@
+import time
+import threading
+import pytest
+import numpy as np
+from multiprocessing import Process, Queue
+
+from shm_ring import ShmRing, ShmAudioStore
+from whisper_transcribe import MlxWhisperProcess
+from asr_service import AsrService
+
+@pytest.fixture(params=[True,False], ids=['shared','local'])
+def ring(request):
+    r = ShmRing( 64, shared=request.param )
+    yield r
+    r.close()
+
+def test_records_wrap_around(ring:ShmRing):
+    # 1レコード = 長さ4バイト + payload。容量64バイトで何周もさせる
+    for i in range(50):
+        data = bytes([i])*(i%20+1)
+        assert ring.put(data)
+        assert ring.get(timeout=0.0) == data
+    assert ring.used() == 0
+
+def test_overrun_when_full(ring:ShmRing):
+    assert ring.put( b'x'*40 )
+    assert not ring.put( b'y'*40, timeout=0.0 )
+    assert ring.overruns == 1
+    assert ring.get(timeout=0.0) == b'x'*40
+
+def test_eof_record(ring:ShmRing):
+    ring.put( b'abc' )
+    ring.put( b'' )
+    assert ring.get(timeout=0.0) == b'abc'
+    assert ring.get(timeout=0.0) == b''
+
+def test_request_stop_wakes_consumer_after_pending(ring:ShmRing):
+    ring.put( b'abc' )
+    ring.request_stop()
+    assert ring.get(timeout=0.0) == b'abc'
+    t0 = time.monotonic()
+    assert ring.get(timeout=5.0) is None
+    assert ring.stopped and time.monotonic()-t0 < 1.0
+    ring.reset()
+    assert not ring.stopped
+
+def test_request_stop_from_other_thread(ring:ShmRing):
+    got:list = []
+    th = threading.Thread( target=lambda: got.append( ring.get(timeout=5.0) ) )
+    th.start()
+    time.sleep(0.1)
+    ring.request_stop()
+    th.join(1.0)
+    assert not th.is_alive() and got == [None]
+
+def _consume(ring:ShmRing, out:Queue):
+    n = 0
+    while (data := ring.get(timeout=5.0)):
+        n += len(data)
+    out.put( (n,data) )
+
+def test_shared_ring_across_process():
+    ring = ShmRing( 1024 )
+    out:Queue = Queue()
+    proc = Process( target=_consume, args=(ring,out) )
+    proc.start()
+    for _ in range(100):
+        assert ring.put( b'z'*100, timeout=5.0 )
+    ring.put( b'', timeout=5.0 )
+    assert out.get(timeout=10.0) == (10000,b'')
+    proc.join(5.0)
+    ring.close()
+
+def test_local_ring_is_not_picklable():
+    ring = ShmRing( 64, shared=False )
+    with pytest.raises(TypeError):
+        ring.__getstate__()
+    ring.close()
+
+@pytest.fixture(params=[True,False], ids=['shared','local'])
+def store(request):
+    s = ShmAudioStore( 100, shared=request.param )
+    yield s
+    s.close()
+
+def pcm(start:int, n:int) ->bytes:
+    """サンプルの値が通しの位置になるPCM"""
+    return np.arange(start,start+n,dtype=np.int16).tobytes()
+
+def test_store_read_across_wraparound(store:ShmAudioStore):
+    for i in range(0,250,30):
+        store.write( pcm(i,30) )
+    assert store.written == 270
+    assert list(store.read(180,260)) == list(range(180,260)) # 先頭に折り返した範囲をまたぐ
+    assert list(store.read(260,400)) == list(range(260,270)) # 書いた所まで
+    assert len(store.read(300,400)) == 0
+
+def test_store_overwritten_range_is_none(store:ShmAudioStore):
+    store.write( pcm(0,150) )
+    assert store.read(0,10) is None
+    assert store.read(49,60) is None
+    assert list(store.read(50,60)) == list(range(50,60))
+
+def test_store_write_larger_than_capacity(store:ShmAudioStore):
+    store.write( pcm(0,30) )
+    store.write( pcm(30,250) )
+    assert store.written == 280
+    assert store.read(179,200) is None
+    assert list(store.read(180,280)) == list(range(180,280))
+    store.reset()
+    assert store.written == 0 and len(store.read(0,10)) == 0
+
+def _read_store(store:ShmAudioStore, out:Queue):
+    out.put( list(store.read(150,160)) )
+    store.close()
+
+def test_shared_store_across_process():
+    store = ShmAudioStore( 100 )
+    store.write( pcm(0,160) )
+    out:Queue = Queue()
+    proc = Process( target=_read_store, args=(store,out) )
+    proc.start()
+    assert out.get(timeout=10.0) == list(range(150,160))
+    proc.join(5.0)
+    store.close()
+
+def test_session_allocates_buffers_on_start_only():
+    """接続しただけのセッションは音声のバッファを持たず、スレッドで動くなら共有メモリを使わない"""
+    service = AsrService( workers=1 )
+    proc = MlxWhisperProcess( service=service )
+    assert proc._audio_ring is None and proc._audio_store is None
+    service.start()
+    try:
+        proc.set_language( 'en', 'fake' )
+        proc.start( pcm=True )
+        assert proc._audio_ring is not None and proc._audio_ring.name == ''
+        assert proc._audio_store is not None
+        # スレッドから止めても、ループ側の書き込みと重ならずに終わる
+        stopper = threading.Thread( target=proc.stop )
+        for i in range(200):
+            proc.append_audio( i, 'pcm', bytes(640) )
+            if i==100:
+                stopper.start()
+        stopper.join(5.0)
+        assert not stopper.is_alive()
+        assert proc.append_audio( 0, 'pcm', bytes(640) ) >= 0
+        proc.close()
+    finally:
+        service.stop()
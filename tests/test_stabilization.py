@@ -0,0 +1,79 @@
+from whisper_transcribe import Seg
+from stabilization import LocalAgreementPolicy, HeuristicPolicy, is_sentence_end
+
+def seg(start:float, end:float, text:str) ->Seg:
+    return Seg(0,0,start,end,text,-0.1,1.0,0.0)
+
+def test_sentence_end():
+    assert is_sentence_end('It works.','en')
+    assert not is_sentence_end('It works','en')
+    assert is_sentence_end('会議を始めます','ja')
+    assert not is_sentence_end('会議を始めます','en')
+    assert is_sentence_end('そうですね','ja') and is_sentence_end('いいですか','ja')
+
+def test_conjunctive_endings_are_not_sentence_end():
+    """「が」「けど」で終わるのは文の途中(後ろに続きがある)"""
+    assert not is_sentence_end('そうですが','ja')
+    assert not is_sentence_end('行きますけど','ja')
+    assert not is_sentence_end('そうでしたが ','ja')
+    # 文末記号があれば文の終わり
+    assert is_sentence_end('そうですけど。','ja')
+
+def test_local_agreement_keeps_conjunctive_ending_open():
+    """「ですが」で終わる最後のセグメントは、文の続きが来るまで確定しない"""
+    policy = LocalAgreementPolicy('ja')
+    hyp = [ seg(0.0,1.0,'そうですが') ]
+    assert policy.split( [], hyp, 1.2 ) == -1
+    assert policy.split( hyp, hyp, 1.2 ) == -1
+    # 文末の言い回しなら、一致した時点で確定する
+    policy = LocalAgreementPolicy('ja')
+    hyp = [ seg(0.0,1.0,'そうですね') ]
+    policy.split( [], hyp, 1.2 )
+    assert policy.split( hyp, hyp, 1.2 ) == 0
+
+def test_local_agreement_needs_two_matching_hypotheses():
+    policy = LocalAgreementPolicy('en')
+    first = [ seg(0.0,1.0,'Hello there.'), seg(1.2,2.0,'How are') ]
+    assert policy.split( [], first, 2.1 ) == -1 # 1回目は比べる相手が無い
+    second = [ seg(0.0,1.0,'Hello there.'), seg(1.2,2.4,'How are you') ]
+    assert policy.split( first, second, 2.5 ) == 0
+    # 確定した単語は履歴から除かれ、残りどうしを比べる
+    third = [ seg(0.0,1.2,'How are you doing') ]
+    assert policy.split( second[1:], third, 1.3 ) == -1
+    fourth = [ seg(0.0,1.2,'How are you doing?') ]
+    assert policy.split( third, fourth, 1.3 ) == 0
+
+def test_local_agreement_keeps_last_segment_mid_sentence():
+    policy = LocalAgreementPolicy('en')
+    cur = [ seg(0.0,1.0,'one two three') ]
+    policy.split( [], cur, 1.1 )
+    assert policy.split( cur, [ seg(0.0,1.0,'one two three') ], 1.1 ) == -1
+    # 後ろに無音があれば文の途中でも確定する
+    assert policy.split( cur, [ seg(0.0,1.0,'one two three') ], 1.6 ) == 0
+
+def test_local_agreement_disagreement_resets_prefix():
+    policy = LocalAgreementPolicy('en')
+    a = [ seg(0.0,1.0,'The cat.'), seg(1.1,2.0,'sat') ]
+    b = [ seg(0.0,1.0,'A cat.'), seg(1.1,2.0,'sat down') ]
+    policy.split( [], a, 2.1 )
+    assert policy.split( a, b, 2.1 ) == -1
+
+def test_settle_does_not_count_reused_hypothesis():
+    """デコードしないで前回の仮説を使い回しても一致にはならず、無音が続いたときだけ確定する"""
+    policy = LocalAgreementPolicy('en')
+    cur = [ seg(0.0,1.0,'Good morning.'), seg(1.2,2.0,'Today we') ]
+    assert policy.split( [], cur, 2.1 ) == -1
+    assert policy.settle( cur, 2.5, 2.0 ) == -1
+    assert policy.settle( cur, 2.9, 2.0 ) == -1
+    # 使い回しは履歴に入らないので、次のデコードで一致を数えるのは新しい仮説とだけ
+    nxt = [ seg(0.0,1.0,'Good morning.'), seg(1.2,2.6,'Today we will') ]
+    assert policy.split( cur, nxt, 2.7 ) == 0
+    assert policy.settle( nxt[1:], 4.0, 2.6 ) == 0
+    assert policy._history == []
+
+def test_heuristic_fixes_all_after_silence():
+    policy = HeuristicPolicy('en')
+    cur = [ seg(0.0,1.0,'a b'), seg(1.2,2.0,'c d') ]
+    assert policy.split( [], cur, 2.2 ) == -1
+    assert policy.split( [], cur, 3.5 ) == 1
+    assert policy.settle( cur, 3.5 ) == 1
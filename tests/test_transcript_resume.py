@@ -0,0 +1,74 @@
+import os
+import asyncio
+import socketio
+from aiohttp import web
+
+from transcribe_server import create_app
+
+PORT = 5293
+
+class Client:
+    """送り直し(ev 'transcript')を受け取るクライアント"""
+    def __init__(self):
+        self.sio = socketio.AsyncClient()
+        self.snapshots:asyncio.Queue = asyncio.Queue()
+        @self.sio.on('ev')
+        async def on_ev(ev):
+            if ev.get('msg')=='transcript' and ev['data'].get('full'):
+                await self.snapshots.put( ev['data'] )
+
+    async def connect(self):
+        await self.sio.connect( f"http://127.0.0.1:{PORT}", transports=['websocket'] )
+
+    async def sync(self, **data) ->dict:
+        await self.sio.emit( 'ev', { 'msg': 'transcriptSync', 'data': data } )
+        return await asyncio.wait_for( self.snapshots.get(), 5.0 )
+
+def test_resume_while_old_connection_is_still_present(tmp_path, monkeypatch):
+    """切断を検知する前に同じクライアントが再接続した。鍵が合えば前の接続を終わらせて引き継ぎ、合わなければ自分の履歴を送る"""
+    monkeypatch.chdir( tmp_path )
+    os.mkdir('static')
+    for k,v in { 'ASR_BACKEND': 'fake', 'ASR_WORKERS': '0', 'ASR_POOL_SIZE': '0' }.items():
+        monkeypatch.setenv( k, v )
+    async def run():
+        app, sio = await create_app()
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite( runner, host='127.0.0.1', port=PORT ).start()
+        clients:list[Client] = []
+        try:
+            old = Client()
+            clients.append(old)
+            await old.connect()
+            own = await old.sync( stream=None, since=0 )
+            assert own['key']
+            # 鍵が違えば引き継がず、その履歴も見ない
+            other = Client()
+            clients.append(other)
+            await other.connect()
+            snap = await other.sync( stream=own['stream'], since=0, resume=True, key='wrong' )
+            assert snap['stream']!=own['stream'] and snap['key'] and snap['key']!=own['key']
+            # 見るだけなら鍵は送らない
+            viewer = Client()
+            clients.append(viewer)
+            await viewer.connect()
+            snap = await viewer.sync( stream=own['stream'], since=0, resume=False )
+            assert snap['stream']==own['stream'] and 'key' not in snap
+            assert old.sio.connected
+            # 再接続
+            new = Client()
+            clients.append(new)
+            await new.connect()
+            snap = await new.sync( stream=own['stream'], since=0, resume=True, key=own['key'] )
+            assert snap['stream']==own['stream'] and snap['key']==own['key']
+            for _ in range(50):
+                if not old.sio.connected:
+                    break
+                await asyncio.sleep(0.1)
+            assert not old.sio.connected
+        finally:
+            for c in clients:
+                if c.sio.connected:
+                    await c.sio.disconnect()
+            await runner.cleanup()
+    asyncio.run( run() )
@@ -0,0 +1,65 @@
+from transcript_stream import TranscriptStream, utf16_len
+
+def test_delta_omits_stream_and_unchanged_tmp():
+    tr = TranscriptStream('s1')
+    assert tr.update( [], [] ) is None
+    assert tr.update( [], ['Hello'] ) == { 'v': 1, 'tmp': [0,'Hello'] }
+    assert tr.update( [], ['Hello world'] ) == { 'v': 2, 'tmp': [5,' world'] }
+    assert tr.update( [], ['Hello world'] ) is None
+    # 確定しても仮の文が変わらなければtmpは送らない
+    assert tr.update( ['Hello world'], ['Hello world'] ) == { 'v': 3, 'seg': 0, 'add': ['Hello world'] }
+    assert tr.update( ['', 'Next.'], [] ) == { 'v': 4, 'seg': 1, 'add': ['Next.'], 'tmp': [0,''] }
+    assert tr.text() == 'Hello world Next.'
+
+def test_tmp_offset_in_utf16_units():
+    tr = TranscriptStream('s1')
+    tr.update( [], ['😀予算'] )
+    assert utf16_len('😀予') == 3
+    assert tr.update( [], ['😀予定'] ) == { 'v': 2, 'tmp': [3,'定'] }
+
+def test_snapshot_since_version():
+    tr = TranscriptStream('s1')
+    tr.update( ['a'], ['b'] )      # v1
+    tr.update( ['b','c'], ['d'] )  # v2
+    tr.update( [], ['d e'] )       # v3
+    tr.update( ['d e'], [] )       # v4
+    full = tr.snapshot()
+    assert full == { 'stream': 's1', 'v': 4, 'full': True, 'since': 0, 'seg': 0, 'add': ['a','b','c','d e'], 'tmp': [0,''] }
+    # v2までを持っているクライアントには、その後に確定した文だけ
+    assert tr.snapshot(2) == full | { 'since': 2, 'seg': 3, 'add': ['d e'] }
+    assert tr.snapshot(4)['add'] == [] and tr.snapshot(4)['seg'] == 4
+    # 範囲外の版なら始めから
+    assert tr.snapshot(99) == full
+    assert tr.snapshot(-1) == full
+
+def test_client_replay_matches_after_resync():
+    """差分を1つ落としたクライアントが、持っている版からの送り直しで追いつく"""
+    tr = TranscriptStream('s1')
+    deltas = [ tr.update( f, t ) for f,t in [ ([],['one']), (['one'],['two']), ([],['two three']), (['two three'],['four']) ] ]
+    segs:list[str] = []
+    tmp = ''
+    v = 0
+    for i,d in enumerate(deltas):
+        if i==2:
+            continue # 落とした
+        if d['v']!=v+1:
+            d = tr.snapshot(v)
+        v = d['v']
+        add = d.get('add',[])
+        segs += add[ max(0,len(segs)-d.get('seg',0)): ]
+        if 'tmp' in d:
+            tmp = tmp[:d['tmp'][0]] + d['tmp'][1]
+    assert ' '.join(segs) == tr.text() == 'one two three'
+    assert tmp == 'four'
+
+def test_segment_numbers_and_times():
+    """確定した文毎のセグメント番号と時刻(録音の索引を引く)。空の文は除く"""
+    tr = TranscriptStream('s1')
+    assert tr.next_seq == 0
+    d = tr.update( ['a','','b'], [], [(0,0.0,1.234),(1,1.3,1.3),(2,1.3,2.5)] )
+    assert d == { 'v': 1, 'seg': 0, 'add': ['a','b'], 'at': [[0,0.0,1.23],[2,1.3,2.5]] }
+    tr.update( ['c'], [], [(3,2.5,3.0)] )
+    assert tr.snapshot(1)['at'] == [[3,2.5,3.0]]
+    assert tr.next_seq == 4
+    # 番号が無ければ省く
+    assert 'at' not in TranscriptStream('s2').snapshot()
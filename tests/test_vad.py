@@ -0,0 +1,61 @@
+import numpy as np
+
+from rec_util import EnergyVad
+
+SR = 16000
+FRAME = 320 # 20ms
+
+def tone(sec:float, vol:float, freq:float=300.0) ->np.ndarray:
+    t = np.arange( int(sec*SR) )/SR
+    return (np.sin(2*np.pi*freq*t)*vol).astype(np.float32)
+
+def silence(sec:float) ->np.ndarray:
+    return np.zeros( int(sec*SR), dtype=np.float32 )
+
+def noise(sec:float, vol:float) ->np.ndarray:
+    return (np.random.default_rng(0).uniform(-vol,vol,int(sec*SR))).astype(np.float32)
+
+def test_silence_and_tone():
+    vad = EnergyVad()
+    assert vad.process( silence(1.0) ) == -1
+    t = tone(0.5,0.1)
+    assert vad.process( t ) == len(t) # 最後まで発話
+
+def test_threshold():
+    # min_levelより小さい音は発話にしない
+    assert EnergyVad().process( tone(0.5,0.004) ) == -1
+    assert EnergyVad().process( tone(0.5,0.05) ) >= 0
+    # 同じくらいのレベルでも、ゼロ交差の多いホワイトノイズは発話にしない。十分大きければ発話とする
+    assert EnergyVad().process( noise(0.5,0.02) ) == -1
+    assert EnergyVad().process( noise(0.5,0.5) ) >= 0
+
+def test_hangover_within_block():
+    """発話の後hang_sec(0.3秒)は発話が続いているとみなす"""
+    vad = EnergyVad( hang_sec=0.3 )
+    audio = np.concatenate( (tone(0.5,0.1), silence(1.0)) )
+    assert vad.process( audio ) == int(0.8*SR)
+
+def test_hangover_across_blocks():
+    """発話がブロックの終わりまで続いたら、ハングオーバーは次のブロックに持ち越す"""
+    vad = EnergyVad( hang_sec=0.3 )
+    t = tone(0.5,0.1)
+    assert vad.process( t ) == len(t)
+    assert vad.process( silence(0.2) ) == int(0.2*SR) # ブロック全体がハングオーバーの中
+    assert vad.process( silence(0.5) ) == int(0.1*SR) # 残りの0.1秒
+    assert vad.process( silence(0.5) ) == -1
+
+def test_partial_frame_is_carried_over():
+    """フレームに満たない端数は次のブロックで判定する"""
+    vad = EnergyVad( hang_sec=0.0 )
+    t = tone(0.1,0.1)
+    assert vad.process( t[:FRAME//2] ) == -1
+    assert vad.process( t[FRAME//2:] ) == len(t)-FRAME//2
+
+def test_noise_floor_follows_background():
+    """背景の音が大きいと閾値が上がり、同じ音量のトーンでも発話にしない"""
+    vad = EnergyVad()
+    for _ in range(50):
+        vad.process( noise(0.2,0.03) )
+    assert vad.floor > 0.01
+    assert vad.process( tone(0.2,0.02) ) == -1
+    assert vad.process( tone(0.2,0.2) ) >= 0
@@ -0,0 +1,30 @@
+import time
+
+from whisper_transcribe import MlxWhisperProcess, lang_to_model
+from whisper_pool import WhisperPool
+from test_session_stop import speech_pcm, feed
+
+def run_session(pool:WhisperPool) ->float:
+    """サーバと同じく、close_audio()を呼ばずにstop()する"""
+    proc = MlxWhisperProcess( incremental=True, policy='local_agreement', pool=pool )
+    proc.set_language( 'en', 'fake' )
+    proc.start( pcm=True )
+    feed( proc, speech_pcm(2.5) )
+    time.sleep(1.0)
+    t0 = time.time()
+    proc.stop()
+    sec = time.time()-t0
+    proc.close()
+    return sec
+
+def test_workers_are_reused_after_stop():
+    pool = WhisperPool( size=2, preload=[lang_to_model('en','fake')[0]] )
+    pool.start()
+    try:
+        for _ in range(4):
+            assert run_session(pool) < 1.0
+        # 返されたワーカーは待機に戻り、新しく起動しない
+        st = pool.stats()
+        assert (st['spawned'],st['retired'],st['idle'],st['busy']) == (2,0,2,0)
+    finally:
+        pool.stop()